@@ -17,7 +17,6 @@
 
 __author__ = 'kpy@google.com (Ka-Ping Yee)'
 
-import calendar
 import cgi
 import csv
 import datetime
@@ -58,10 +57,8 @@ from utils import Struct, validate_email
 
 HARD_MAX_RESULTS = 200  # Clients can ask for more, but won't get more.
 PHOTO_UPLOAD_MAX_SIZE = 10485760 # Currently 10MB is the maximum upload size
-
-class InputFileError(Exception):
-    pass
-
+# Records parsed from an api/write upload before they are imported.
+WRITE_CHUNK_SIZE = importer.MAX_PUT_BATCH
 
 def get_requested_formats(path):
     """Returns a list of requested formats.
@@ -72,17 +69,6 @@ def get_requested_formats(path):
     return ['persons', 'notes']
 
 
-def complete_record_ids(record, domain):
-    """Ensures that a record's record_id fields are prefixed with a domain."""
-    def complete(record, field):
-        id = record.get(field)
-        if id and '/' not in id:
-            record[field] = '%s/%s' % (domain, id)
-    complete(record, 'person_record_id')
-    complete(record, 'note_record_id')
-    return record
-
-
 def get_tag_params(handler):
     """Return HTML tag parameters used in import.html."""
     return {
@@ -105,67 +91,6 @@ def get_tag_params(handler):
     }
 
 
-def generate_note_record_ids(records):
-    for record in records:
-        if not record.get('note_record_id', '').strip():
-            record['note_record_id'] = str(model.UniqueId.create_id())
-        yield record
-
-
-def convert_time(text, offset):
-    """Converts a textual date and time into an RFC 3339 UTC timestamp."""
-    if utils.DATETIME_RE.match(text.strip()):  # don't apply offset
-        return text
-    match = re.search(r'(\d\d\d\d)[/-](\d+)[/-](\d+) *(\d+):(\d+)', text)
-    if match:
-        y, l, d, h, m = map(int, match.groups())
-        timestamp = calendar.timegm((y, l, d, h, m, 0)) - offset*3600
-        return utils.format_utc_timestamp(timestamp)
-    return text  # keep the original text so it shows up in the error message
-
-
-def convert_time_fields(rows, default_offset=0):
-    """Filters CSV rows, converting time fields to RFC 3339 UTC times.
-
-    The first row that contains "person_record_id" is assumed to be the header
-    row containing field names.  Preceding rows are treated as a preamble.
-
-    If the text "time_zone_offset" is found in the preamble section, the cell
-    immediately below it is treated as a time zone offset from UTC in hours.
-    Otherwise default_offset is used as the time zone offset.
-
-    Rows below the header row are returned as dictionaries (as csv.DictReader
-    would), except that any "*_date" fields are parsed as local times,
-    converted to UTC according to the specified offset, and reformatted
-    as RFC 3339 UTC times.
-    """
-    field_names = []
-    time_fields = []
-    setting_names = []
-    settings = {}
-    offset = default_offset
-
-    for row in rows:
-        if field_names:
-            record = dict(zip(field_names, row))
-            for key in time_fields:
-                record[key] = convert_time(record[key], offset)
-            yield record
-
-        elif 'person_record_id' in row:
-            field_names = [name.lower().strip() for name in row]
-            time_fields = [name for name in row if name.endswith('_date')]
-            if 'time_zone_offset' in settings:
-                try:
-                    offset = float(settings['time_zone_offset'])
-                except ValueError:
-                    raise InputFileError('invalid time_zone_offset value')
-
-        else:
-            settings.update(dict(zip(setting_names, row)))
-            setting_names = [name.lower().strip() for name in row]
-
-
 def convert_xsl_to_csv(contents):
     """Converts data in xsl (or xslx) format to CSV."""
     try:
@@ -251,13 +176,17 @@ class Import(BaseApiHandler):
                 self.write(error)
                 return
 
+        if self.request.get('background'):
+            self.start_import_job(content)
+            return
+
         try:
             lines = content.splitlines()  # handles \r, \n, or \r\n
             if self.request.get('format') == 'notes':
                 self.import_notes(lines)
             else:
                 self.import_persons(lines)
-        except InputFileError, e:
+        except importer.InputFileError, e:
             self.error(400, message='Problem in the uploaded file: %s' % e)
         except runtime.DeadlineExceededError, e:
             self.error(400, message=
@@ -267,10 +196,12 @@ class Import(BaseApiHandler):
 
     def import_notes(self, lines):
         source_domain = self.auth.domain_write_permission
-        records = importer.utf8_decoder(generate_note_record_ids(
-            convert_time_fields(csv.reader(lines))))
+        context = importer.ImportContext(self.repo)
+        records = importer.utf8_decoder(importer.generate_note_record_ids(
+            importer.convert_time_fields(csv.reader(lines)), context))
         try:
-            records = [complete_record_ids(r, source_domain) for r in records]
+            records = [importer.complete_record_ids(r, source_domain)
+                       for r in records]
         except csv.Error, e:
             self.error(400, message=
                 'The CSV file is formatted incorrectly. (%s)' % e)
@@ -279,7 +210,7 @@ class Import(BaseApiHandler):
         notes_written, notes_skipped, notes_total = importer.import_records(
             self.repo, source_domain, importer.create_note, records,
             believed_dead_permission=self.auth.believed_dead_permission,
-            omit_duplicate_notes=True)
+            omit_duplicate_notes=True, context=context)
 
         utils.log_api_action(self, ApiActionLog.WRITE,
                              0, notes_written, 0, len(notes_skipped))
@@ -297,23 +228,26 @@ class Import(BaseApiHandler):
         # TODO(ryok): support non-UTF8 encodings.
 
         source_domain = self.auth.domain_write_permission
-        records = importer.utf8_decoder(convert_time_fields(csv.reader(lines)))
+        records = importer.utf8_decoder(
+            importer.convert_time_fields(csv.reader(lines)))
         try:
-            records = [complete_record_ids(r, source_domain) for r in records]
+            records = [importer.complete_record_ids(r, source_domain)
+                       for r in records]
         except csv.Error, e:
             self.error(400, message=
                 'The CSV file is formatted incorrectly. (%s)' % e)
             return
 
-        is_not_empty = lambda x: (x or '').strip()
-        persons = [r for r in records if is_not_empty(r.get('full_name'))]
-        notes = [r for r in records if is_not_empty(r.get('note_record_id'))]
+        persons, notes = importer.split_person_and_note_records(records)
 
+        context = importer.ImportContext(self.repo)
         people_written, people_skipped, people_total = importer.import_records(
-            self.repo, source_domain, importer.create_person, persons)
+            self.repo, source_domain, importer.create_person, persons,
+            context=context)
         notes_written, notes_skipped, notes_total = importer.import_records(
             self.repo, source_domain, importer.create_note, notes,
-            believed_dead_permission=self.auth.believed_dead_permission)
+            believed_dead_permission=self.auth.believed_dead_permission,
+            context=context)
 
         utils.log_api_action(self, ApiActionLog.WRITE,
                              people_written, notes_written,
@@ -332,6 +266,37 @@ class Import(BaseApiHandler):
                                total=notes_total)],
                     **get_tag_params(self))
 
+    def start_import_job(self, content):
+        """Stages the uploaded file and queues a task to import it in the
+        background.  Its progress is reported by api/import/status."""
+        # Normalize the line endings, as splitlines does for smaller files.
+        content = '\n'.join(content.splitlines()) + '\n'
+        try:
+            header_end = importer.find_header_end(content)
+        except csv.Error, e:
+            self.error(400, message=
+                'The CSV file is formatted incorrectly. (%s)' % e)
+            return
+        job = model.ImportJob.create(
+            self.repo, content,
+            format=('notes' if self.request.get('format') == 'notes'
+                    else 'persons'),
+            source_domain=self.auth.domain_write_permission,
+            believed_dead_permission=bool(self.auth.believed_dead_permission),
+            header_end=header_end)
+        self.add_task_for_repo(
+            self.repo, 'process-import-%s' % job.job_id,
+            importer.BACKGROUND_IMPORT_ACTION, id=job.job_id)
+
+        self.response.set_status(202)
+        self.response.headers['Content-Type'] = (
+                'application/json; charset=utf-8')
+        self.write(simplejson.dumps({
+            'id': job.job_id,
+            'status': job.status,
+            'status_url': self.get_url('api/import/status', id=job.job_id),
+        }))
+
     def export_records(self):
         if not (self.auth and self.auth.read_permission):
             # TODO(gimite): i18n
@@ -355,6 +320,40 @@ class Import(BaseApiHandler):
                 message=_('The data is not ready yet. Try again in 24 hours.'))
 
 
+class ImportStatus(BaseApiHandler):
+    """Reports the progress of an import started by api/import in JSON."""
+
+    https_required = True
+
+    def get(self):
+        if not (self.auth and self.auth.domain_write_permission):
+            self.info(
+                403,
+                message='Missing or invalid authorization key',
+                style='plain')
+            return
+
+        job = self.params.id and model.ImportJob.get(self.repo, self.params.id)
+        if not job or job.source_domain != self.auth.domain_write_permission:
+            self.info(404, message='No such import.', style='plain')
+            return
+
+        self.response.headers['Content-Type'] = (
+                'application/json; charset=utf-8')
+        self.write(simplejson.dumps({
+            'id': job.job_id,
+            'status': job.status,
+            'error': job.error,
+            'size': job.size,
+            'offset': job.offset,
+            'persons_written': job.persons_written,
+            'notes_written': job.notes_written,
+            'skipped': job.skipped,
+            'total': job.total,
+            'skipped_messages': job.skipped_messages,
+        }))
+
+
 class Read(BaseApiHandler):
     https_required = True
 
@@ -448,44 +447,86 @@ class Write(BaseApiHandler):
                 style='plain')
             return
 
+        # The upload is parsed and imported a chunk at a time, so that only
+        # about WRITE_CHUNK_SIZE records are held in memory at once.  The
+        # Notes in each chunk are imported after the Persons in the chunk,
+        # except for Notes on Persons that aren't stored yet, which may come
+        # later in the upload; those are imported after all the Persons.  If
+        # a Person is overwritten after Notes on it were imported, its
+        # latest_* fields are updated from those Notes again.
+        # A malformed upload gets a 400 response when the parser reaches the
+        # error, and the chunks before the error stay written.
+        start_time = utils.get_utcnow()
         source_domain = self.auth.domain_write_permission
-        try:
-            person_records, note_records = \
-                pfif.parse_file(self.request.body_file)
-        except Exception, e:
-            self.info(400, message='Invalid XML: %s' % e, style='plain')
-            return
+        context = importer.ImportContext(self.repo)
+        num_people_written, people_skipped, people_total = 0, [], 0
+        num_notes_written, notes_skipped, notes_total = 0, [], 0
+        later_note_records = []
+        noted_person_record_ids = set()  # Persons with Notes imported so far
+        chunks = pfif.parse_file_in_chunks(
+            StringIO.StringIO(self.request.body), WRITE_CHUNK_SIZE)
+        while True:
+            try:
+                person_records, note_records = next(chunks)
+            except StopIteration:
+                break
+            except Exception, e:
+                self.info(400, message='Invalid XML: %s' % e, style='plain')
+                return
 
-        mark_notes_reviewed = bool(self.auth.mark_notes_reviewed)
-        believed_dead_permission = bool(
-            self.auth.believed_dead_permission)
+            written, skipped, total = importer.import_records(
+                self.repo, source_domain, importer.create_person,
+                person_records, context=context)
+            num_people_written += written
+            people_skipped += skipped
+            people_total += total
+            overwritten_person_record_ids = noted_person_record_ids & set(
+                record.get('person_record_id') for record in person_records)
+            if overwritten_person_record_ids:
+                importer.update_persons_from_notes(
+                    self.repo, overwritten_person_record_ids, start_time)
+
+            note_records, later = importer.split_notes_by_known_person(
+                self.repo, person_records, note_records)
+            later_note_records += later
+            written, skipped, total = self.import_notes(
+                source_domain, note_records, context)
+            num_notes_written += written
+            notes_skipped += skipped
+            notes_total += total
+            noted_person_record_ids.update(
+                record.get('person_record_id') for record in note_records)
+
+        if later_note_records:
+            written, skipped, total = self.import_notes(
+                source_domain, later_note_records, context)
+            num_notes_written += written
+            notes_skipped += skipped
+            notes_total += total
 
         self.response.headers['Content-Type'] = 'application/xml; charset=utf-8'
         self.write('<?xml version="1.0"?>\n')
         self.write('<status:status ' +
                 'xmlns:status="http://zesty.ca/pfif/1.4/status" ' +
                 'xmlns:pfif="http://zesty.ca/pfif/1.4">\n')
-
-        create_person = importer.create_person
-        num_people_written, people_skipped, total = importer.import_records(
-            self.repo, source_domain, create_person, person_records)
         self.write_status(
-            'person', num_people_written, people_skipped, total,
+            'person', num_people_written, people_skipped, people_total,
             'person_record_id')
-
-        create_note = importer.create_note
-        num_notes_written, notes_skipped, total = importer.import_records(
-            self.repo, source_domain, create_note, note_records,
-            mark_notes_reviewed, believed_dead_permission, self)
-
         self.write_status(
-            'note', num_notes_written, notes_skipped, total, 'note_record_id')
-
+            'note', num_notes_written, notes_skipped, notes_total,
+            'note_record_id')
         self.write('</status:status>\n')
         utils.log_api_action(self, ApiActionLog.WRITE,
                              num_people_written, num_notes_written,
                              len(people_skipped), len(notes_skipped))
 
+    def import_notes(self, source_domain, note_records, context):
+        """Imports note records with the permissions of the authorization
+        key, returning the results of importer.import_records."""
+        return importer.import_records(
+            self.repo, source_domain, importer.create_note, note_records,
+            bool(self.auth.mark_notes_reviewed),
+            bool(self.auth.believed_dead_permission), self, context=context)
 
     def write_status(self, type, written, skipped, total, id_field):
         """Emit status information about the results of an attempted write."""
@@ -547,10 +588,13 @@ class Search(BaseApiHandler):
         records = [pfif_version.person_to_dict(result) for result in results]
         utils.optionally_filter_sensitive_fields(records, self.auth)
 
+        # Get the notes for all the results at once.
+        notes_by_person_record_id = model.Note.get_by_person_record_ids(
+            self.repo, [result.record_id for result in results])
+
         # Define the function to retrieve notes for a person.
         def get_notes_for_person(person):
-            notes = model.Note.get_by_person_record_id(
-                self.repo, person['person_record_id'])
+            notes = notes_by_person_record_id[person['person_record_id']]
             notes = [note for note in notes if not note.hidden]
             records = map(pfif_version.note_to_dict, notes)
             utils.optionally_filter_sensitive_fields(records, self.auth)
@@ -623,26 +667,32 @@ class Stats(BaseApiHandler):
         person_counts = model.Counter.get_all_counts(self.repo, 'person')
         note_counts = model.Counter.get_all_counts(self.repo, 'note')
 
-        # unreviewed
-        note_counts['hidden=FALSE,reviewed=FALSE'] = len(fetch_all(
-            model.Note.all(keys_only=True
-            ).filter('repo =', self.repo
-            ).filter('reviewed =', False
-            ).filter('hidden =', False
-            ).order('-entry_date')))
-        # accepted
-        note_counts['hidden=FALSE,reviewed=TRUE'] = len(fetch_all(
-            model.Note.all(keys_only=True
-            ).filter('repo =', self.repo
-            ).filter('reviewed =', True
-            ).filter('hidden =', False
-            ).order('-entry_date')))
-        # flagged
-        note_counts['hidden=TRUE'] = len(fetch_all(
-            model.Note.all(keys_only=True
-            ).filter('repo =', self.repo
-            ).filter('hidden =', True
-            ).order('-entry_date')))
+        # The numbers of unreviewed, accepted, and flagged notes are kept
+        # with the other note counts, unless the last finished scan predates
+        # them, in which case they are counted here.
+        note_counter = model.Counter.get_latest_finished(self.repo, 'note')
+        if not (note_counter and all(note_counter.has(name)
+                                     for name in model.REVIEW_COUNT_NAMES)):
+            # unreviewed
+            note_counts['hidden=FALSE,reviewed=FALSE'] = len(fetch_all(
+                model.Note.all(keys_only=True
+                ).filter('repo =', self.repo
+                ).filter('reviewed =', False
+                ).filter('hidden =', False
+                ).order('-entry_date')))
+            # accepted
+            note_counts['hidden=FALSE,reviewed=TRUE'] = len(fetch_all(
+                model.Note.all(keys_only=True
+                ).filter('repo =', self.repo
+                ).filter('reviewed =', True
+                ).filter('hidden =', False
+                ).order('-entry_date')))
+            # flagged
+            note_counts['hidden=TRUE'] = len(fetch_all(
+                model.Note.all(keys_only=True
+                ).filter('repo =', self.repo
+                ).filter('hidden =', True
+                ).order('-entry_date')))
 
         self.response.headers['Content-Type'] = (
                 'application/json; charset=utf-8')
@@ -58,10 +58,11 @@ class AtomPfifVersion:
         file.write(indent + '</entry>\n')
 
     def write_person_feed(self, file, persons, get_notes_for_person,
-                          url, title, subtitle, updated):
+                          url, title, subtitle, updated, next_url=None):
         """Takes a list of person records and a function that gets the list
         of note records for each person, and writes a PFIF Atom feed to the
-        given file."""
+        given file.  If next_url is given, the feed links to it as the next
+        page."""
         file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
         file.write('<feed xmlns="http://www.w3.org/2005/Atom"\n')
         file.write('      xmlns:pfif="%s">\n' % self.pfif_version.ns)
@@ -70,6 +71,8 @@ class AtomPfifVersion:
         write_element(file, 'subtitle', subtitle, '  ')
         write_element(file, 'updated', format_utc_datetime(updated), '  ')
         file.write('  <link rel="self">%s</link>\n' % xml_escape(url))
+        if next_url:
+            file.write('  <link rel="next">%s</link>\n' % xml_escape(next_url))
         for person in persons:
             self.write_person_entry(
                 file, person, get_notes_for_person(person), title, '  ')
@@ -91,8 +94,10 @@ class AtomPfifVersion:
         indent = indent[2:]
         file.write(indent + '</entry>\n')
 
-    def write_note_feed(self, file, notes, url, title, subtitle, updated):
-        """Takes a list of notes and writes a PFIF Atom feed to a file."""
+    def write_note_feed(self, file, notes, url, title, subtitle, updated,
+                        next_url=None):
+        """Takes a list of notes and writes a PFIF Atom feed to a file.  If
+        next_url is given, the feed links to it as the next page."""
         file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
         file.write('<feed xmlns="http://www.w3.org/2005/Atom"\n')
         file.write('      xmlns:pfif="%s">\n' % self.pfif_version.ns)
@@ -101,6 +106,8 @@ class AtomPfifVersion:
         write_element(file, 'subtitle', subtitle, '  ')
         write_element(file, 'updated', format_utc_datetime(updated), '  ')
         file.write('  <link rel="self">%s</link>\n' % xml_escape(url))
+        if next_url:
+            file.write('  <link rel="next">%s</link>\n' % xml_escape(next_url))
         for note in notes:
             self.write_note_entry(file, note, '  ')
         file.write('</feed>\n')
@@ -19,6 +19,7 @@ See here for usage examples:
 https://github.com/google/personfinder/wiki/DeveloperFaq
 """
 
+from google.appengine.api import memcache
 from google.appengine.ext import db
 import UserDict, model, random, simplejson
 import logging
@@ -28,28 +29,83 @@ from datetime import timedelta
 
 
 class ConfigurationCache:
-    """This class implements an in-memory cache used to store the config
-    entries. Cache entries have a default lifetime of 600 seconds. When
-    fetching a config entry, the cache is first searched. If the entry is
-    not available in cache it is retrieved from database, added to cache and
-    returned. Cache is enabled by setting a config entry *:config_cache_enable.
+    """This class implements a process-wide, versioned snapshot of the config
+    entries, which is shared by config.get and Configuration. When fetching
+    the config entries of a repository, the snapshot is first searched. If
+    the entries are not available in the snapshot they are retrieved from
+    database, added to the snapshot and returned.
     Config entries are stored with the key repo:entry_name in database.
     This cache uses the repo as the key and stores all configs for a
-    repository in one cache element. The global configs have repo='*'."""
+    repository in one cache element. The global configs have repo='*'.
+
+    The version of the snapshot is kept in memcache so that config.set and
+    flush_caches on any instance invalidate the snapshots of all instances.
+    The version is read from memcache at most once every
+    version_check_interval seconds, so changes made on other instances are
+    picked up after a few seconds.  Cache entries also have a default
+    lifetime of 600 seconds, so that ConfigEntry entities written directly
+    to the datastore (or while memcache is unavailable) are eventually
+    picked up."""
+    VERSION_MEMCACHE_KEY = 'config_cache_version'
     storage = {}
+    version = None
     expiry_time = 600
+    version_check_interval = 5
+    checked_version = None
+    version_check_expiry = None
     miss_count = 0
     hit_count = 0
     evict_count = 0
     items_count = 0
     max_items = 0
 
+    def new_version(self):
+        return '%x' % random.getrandbits(64)
+
+    def get_version(self):
+        """Gets the current version of the config entries from memcache,
+        initializing it if it is missing. The version is only read from
+        memcache if it hasn't been read in the last version_check_interval
+        seconds. Returns None if memcache is not available."""
+        now = utils.get_utcnow()
+        if self.version_check_expiry and now < self.version_check_expiry:
+            return self.checked_version
+        version = memcache.get(self.VERSION_MEMCACHE_KEY)
+        if version is None:
+            memcache.add(self.VERSION_MEMCACHE_KEY, self.new_version())
+            version = memcache.get(self.VERSION_MEMCACHE_KEY)
+        self.checked_version = version
+        self.version_check_expiry = now + timedelta(
+            seconds=self.version_check_interval)
+        return version
+
+    def check_version(self):
+        """Drops the snapshot if the config entries have been modified since
+        it was taken. If the version can't be determined, the snapshot is
+        kept, and its entries are only dropped when they expire."""
+        version = self.get_version()
+        if version is not None and version != self.version:
+            if self.storage:
+                logging.debug('Config version changed, dropping config_cache')
+                self.evict_count += self.items_count
+            self.storage.clear()
+            self.items_count = 0
+            self.version = version
+
     def flush(self):
+        """Drops the snapshot on every instance."""
+        memcache.set(self.VERSION_MEMCACHE_KEY, self.new_version())
+        self.version_check_expiry = None
         self.storage.clear()
-        self.items_count=0
+        self.items_count = 0
 
-    def delete(self,key):
-        """Deletes the entry with given key from config_cache."""
+    def delete(self, key):
+        """Deletes the entry with given key from config_cache on every
+        instance."""
+        # Other instances can't drop a single repository, so make them drop
+        # their whole snapshot.
+        memcache.set(self.VERSION_MEMCACHE_KEY, self.new_version())
+        self.version_check_expiry = None
         if key in self.storage:
             self.storage.pop(key)
             self.items_count -= 1
@@ -58,9 +114,10 @@ class ConfigurationCache:
         """Adds the key/value pair to cache and updates the expiry time.
            If key already exists, its value and expiry are updated."""
         expiry = utils.get_utcnow() + timedelta(seconds=time_to_live_in_seconds)
+        if key not in self.storage:
+            self.items_count += 1
+            self.max_items = max(self.max_items, self.items_count)
         self.storage[key] = (value, expiry)
-        self.items_count += 1
-        self.max_items += 1
 
     def read(self, key, default=None):
         """Gets the value corresponding to the key from cache. If cache entry
@@ -76,7 +133,8 @@ class ConfigurationCache:
             return value
         else:
             # Stale cache entry. Evicting from cache
-            self.delete(key)
+            self.storage.pop(key)
+            self.items_count -= 1
             self.evict_count += 1
             self.miss_count += 1
             return default
@@ -88,33 +146,23 @@ class ConfigurationCache:
         logging.info("Eviction Count - %r" % self.evict_count)
         logging.info("Max Items - %r" % self.max_items)
 
-    def get_config(self, repo, name, default=None):
-        """Looks for data in cache. If not present, retrieves from
-           database, stores it in cache and returns the required value."""
+    def get_entries(self, repo):
+        """Returns a dictionary of all the config entries for a repository.
+        Looks for it in cache. If not present, retrieves it from database and
+        stores it in cache. The returned dictionary must not be modified."""
+        self.check_version()
         config_dict = self.read(repo, None)
         if config_dict is None:
             # Cache miss
-            entries = model.filter_by_prefix(ConfigEntry.all(), repo + ':')
-            if entries is None:
-                return default
             logging.debug("Adding repository %r to config_cache" % repo)
-            config_dict = dict([(e.key().name().split(':', 1)[1],
-                         simplejson.loads(e.value)) for e in entries])
+            config_dict = load_entries(repo)
             self.add(repo, config_dict, self.expiry_time)
+        return config_dict
 
-        if name in config_dict:
-            return config_dict[name]
-        return default
-
-    def enable(self, value):
-        """Enable/disable caching of config."""
-        logging.info('Setting config_cache_enable to %s' % value)
-        db.put(ConfigEntry(key_name="*:config_cache_enable",
-                           value=simplejson.dumps(bool(value))))
-        self.delete('*')
-
-    def is_enabled(self):
-        return self.get_config('*', 'config_cache_enable', None)
+    def get_config(self, repo, name, default=None):
+        """Looks for data in cache. If not present, retrieves from
+           database, stores it in cache and returns the required value."""
+        return self.get_entries(repo).get(name, default)
 
 cache = ConfigurationCache()
 
@@ -124,19 +172,20 @@ class ConfigEntry(db.Model):
     value = db.TextProperty(default='')
 
 
+def load_entries(repo):
+    """Loads all the config entries for a repository from the database."""
+    entries = model.filter_by_prefix(ConfigEntry.all(), repo + ':')
+    return dict([(e.key().name().split(':', 1)[1],
+                  simplejson.loads(e.value)) for e in entries])
+
+
 # If calling from code where a Configuration object is available (e.g., from
 # within a handler), prefer Configuration.get. Configuration objects get all
 # config entries when they're initialized, so they don't need to make an
-# additional Datastore query.
+# additional config cache lookup.
 def get(name, default=None, repo='*'):
-    """Gets a configuration setting from cache if it is enabled,
-       otherwise from the database."""
-    if cache.is_enabled():
-        return cache.get_config(repo, name, default)
-    entry = ConfigEntry.get_by_key_name(repo + ':' + name)
-    if entry:
-        return simplejson.loads(entry.value)
-    return default
+    """Gets a configuration setting from the config cache."""
+    return cache.get_config(repo, name, default)
 
 def set(repo='*', **kwargs):
     """Sets configuration settings."""
@@ -151,7 +200,7 @@ def set(repo='*', **kwargs):
 # If calling from code where a Configuration object is available (e.g., from
 # within a handler), prefer Configuration.get. Configuration objects get all
 # config entries when they're initialized, so they don't need to make an
-# additional Datastore query.
+# additional config cache lookup.
 def get_for_repo(repo, name, default=None):
     """Gets a configuration setting for a particular repository.  Looks for a
     setting specific to the repository, then falls back to a global setting."""
@@ -170,14 +219,9 @@ def set_for_repo(repo, **kwargs):
 class Configuration(UserDict.DictMixin):
     def __init__(self, repo, include_global=True):
         self.repo = repo
-        # We fetch all the config entries at once here, so that we don't have to
-        # make many Datastore queries for each individual entry later.
-        db_entries = model.filter_by_prefix(
-            ConfigEntry.all(), self.repo + ':')
-        self.entries = {
-            entry.key().name().split(':', 1)[1]: simplejson.loads(entry.value)
-            for entry in db_entries
-        }
+        # We get all the config entries at once from the config cache here, so
+        # that we don't have to look up each individual entry later.
+        self.entries = cache.get_entries(self.repo)
         if include_global:
             self.global_config = None if repo == '*' else Configuration('*')
         else:
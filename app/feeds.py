@@ -16,9 +16,14 @@
 
 __author__ = 'kpy@google.com (Ka-Ping Yee)'
 
+import base64
+import calendar
+import datetime
+
+from google.appengine.api import datastore_errors
+
 import atom
 import config
-import datetime
 import model
 import pfif
 import utils
@@ -41,6 +46,67 @@ def make_hidden_notes_blank(notes):
         if note.hidden:
             note.text = ''
 
+def encode_continuation(entry_date, cursor):
+    """Makes an opaque token for continuing a feed after an entity with the
+    given entry_date, at the given query cursor.  An entity with no
+    entry_date gets a token with just the cursor."""
+    timestamp = ''
+    if entry_date:
+        timestamp = '%d.%06d' % (calendar.timegm(entry_date.utctimetuple()),
+                                 entry_date.microsecond)
+    return base64.urlsafe_b64encode('%s:%s' % (timestamp, cursor))
+
+def decode_continuation(token):
+    """Gets the entry_date (None if the token has none) and the query cursor
+    from a continuation token."""
+    try:
+        timestamp, cursor = base64.urlsafe_b64decode(str(token)).split(':', 1)
+        if not timestamp:
+            return None, cursor
+        seconds, microseconds = timestamp.split('.')
+        entry_date = (datetime.datetime.utcfromtimestamp(int(seconds)) +
+                      datetime.timedelta(microseconds=int(microseconds)))
+        return entry_date, cursor
+    except (TypeError, ValueError):
+        raise ValueError('Bad continuation token: %r' % token)
+
+def fetch_page(query, max_results, skip, continuation, scan_forward):
+    """Fetches up to max_results entities from a query ordered by entry_date.
+    If a continuation token from a previous page is given, the query picks up
+    where that page ended; otherwise the first 'skip' entities are skipped,
+    which the datastore does by reading and discarding them.  Returns the
+    entities and a continuation token for the next page (None if there are no
+    more entities)."""
+    if continuation:
+        entry_date, cursor = decode_continuation(continuation)
+        try:
+            query.with_cursor(cursor)
+            entities = query.fetch(max_results)
+        except (datastore_errors.BadRequestError,
+                datastore_errors.BadValueError):
+            # The cursor doesn't work with this query (e.g. the index has
+            # changed), so continue from the last entry_date instead.  This
+            # repeats any entities that have that same entry_date (or, if it
+            # was None, all the entities with no entry_date, which come last
+            # in a backward scan).
+            query.with_cursor(None)
+            query.filter(scan_forward and 'entry_date >=' or 'entry_date <=',
+                         entry_date)
+            entities = query.fetch(max_results)
+    else:
+        entities = query.fetch(max_results, offset=skip)
+    if len(entities) < max_results:
+        return entities, None
+    return entities, encode_continuation(
+        entities[-1].entry_date, query.cursor())
+
+def get_next_url(url, continuation):
+    """Gets the URL of the next page of a feed, given the URL of this page."""
+    if continuation:
+        return utils.set_url_param(
+            utils.set_url_param(url, 'skip', None),
+            'continuation', continuation)
+
 
 class BaseFeedsHandler(utils.BaseHandler):
 
@@ -65,23 +131,6 @@ class Person(BaseFeedsHandler):
         max_results = min(self.params.max_results or 10, HARD_MAX_RESULTS)
         skip = self.params.skip or 0
 
-        # We use a member because a var can't be modified inside the closure.
-        self.num_notes = 0
-        def get_notes_for_person(person):
-            notes = model.Note.get_by_person_record_id(
-                self.repo, person['person_record_id'])
-            # Show hidden notes as blank in the Person feed (melwitt)
-            # https://web.archive.org/web/20111228161607/http://code.google.com/p/googlepersonfinder/issues/detail?id=58
-            make_hidden_notes_blank(notes)
-
-            records = map(pfif_version.note_to_dict, notes)
-            utils.optionally_filter_sensitive_fields(records, self.auth)
-            self.num_notes += len(notes)
-            return records
-
-        if self.params.omit_notes:  # Return only the person records.
-            get_notes_for_person = lambda person: []
-
         query = model.Person.all_in_repo(self.repo, filter_expired=False)
         if self.params.min_entry_date:  # Scan forward.
             query = query.order('entry_date')
@@ -89,9 +138,35 @@ class Person(BaseFeedsHandler):
         else:  # Show recent entries, scanning backward.
             query = query.order('-entry_date')
 
-        persons = query.fetch(max_results, offset=skip)
+        try:
+            persons, continuation = fetch_page(
+                query, max_results, skip, self.params.continuation,
+                bool(self.params.min_entry_date))
+        except ValueError:
+            self.response.set_status(400)
+            self.write('Invalid continuation token\n')
+            return
         updated = get_latest_entry_date(persons)
 
+        # We use a member because a var can't be modified inside the closure.
+        self.num_notes = 0
+        if self.params.omit_notes:  # Return only the person records.
+            get_notes_for_person = lambda person: []
+        else:
+            # Get the notes for all the persons on the page at once.
+            notes_by_person_record_id = model.Note.get_by_person_record_ids(
+                self.repo, [person.record_id for person in persons])
+            def get_notes_for_person(person):
+                notes = notes_by_person_record_id[person['person_record_id']]
+                # Show hidden notes as blank in the Person feed (melwitt)
+                # https://web.archive.org/web/20111228161607/http://code.google.com/p/googlepersonfinder/issues/detail?id=58
+                make_hidden_notes_blank(notes)
+
+                records = map(pfif_version.note_to_dict, notes)
+                utils.optionally_filter_sensitive_fields(records, self.auth)
+                self.num_notes += len(notes)
+                return records
+
         self.response.headers['Content-Type'] = 'application/xml; charset=utf-8'
         records = [pfif_version.person_to_dict(person, person.is_expired)
                    for person in persons]
@@ -99,7 +174,8 @@ class Person(BaseFeedsHandler):
         atom_version.write_person_feed(
             self.response.out, records, get_notes_for_person,
             self.request.url, self.env.netloc, PERSON_SUBTITLE_BASE +
-            self.env.netloc, updated)
+            self.env.netloc, updated,
+            get_next_url(self.request.url, continuation))
         utils.log_api_action(self, model.ApiActionLog.READ, len(records),
                              self.num_notes)
 
@@ -140,7 +216,14 @@ class Note(BaseFeedsHandler):
             query = query.filter('person_record_id =',
                                  self.params.person_record_id)
 
-        notes = query.fetch(max_results, offset=skip)
+        try:
+            notes, continuation = fetch_page(
+                query, max_results, skip, self.params.continuation,
+                bool(self.params.min_entry_date))
+        except ValueError:
+            self.response.set_status(400)
+            self.write('Invalid continuation token\n')
+            return
         updated = get_latest_entry_date(notes)
 
         # Show hidden notes as blank in the Note feed (melwitt)
@@ -152,5 +235,6 @@ class Note(BaseFeedsHandler):
         utils.optionally_filter_sensitive_fields(records, self.auth)
         atom_version.write_note_feed(
             self.response.out, records, self.request.url,
-            self.env.netloc, NOTE_SUBTITLE_BASE + self.env.netloc, updated)
+            self.env.netloc, NOTE_SUBTITLE_BASE + self.env.netloc, updated,
+            get_next_url(self.request.url, continuation))
         utils.log_api_action(self, model.ApiActionLog.READ, 0, len(records))
@@ -50,6 +50,7 @@ class Handler(utils.BaseHandler):
 
         captcha_response = note.hidden and self.get_captcha_response()
         if not note.hidden or captcha_response.is_valid:
+            review_count_name = model.get_review_count_name(note)
             note.hidden = not note.hidden
             # When "hidden" changes, update source_date and entry_date (melwitt)
             # https://web.archive.org/web/20111228161607/http://code.google.com/p/googlepersonfinder/issues/detail?id=58
@@ -57,6 +58,8 @@ class Handler(utils.BaseHandler):
             note.source_date = now
             note.entry_date = now
             db.put(note)
+            model.add_review_count_deltas(
+                self.repo, [(note, review_count_name)])
 
             model.UserActionLog.put_new(
                 (note.hidden and 'hide') or 'unhide',
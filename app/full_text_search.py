@@ -15,6 +15,7 @@
 
 import logging
 import re
+import time
 
 from google.appengine.api import search as appengine_search
 
@@ -29,8 +30,25 @@ ROMANIZE_METHODS = [script_variant.romanize_word_by_unidecode,
                     script_variant.romanize_japanese_word,
                     script_variant.romanize_chinese_name]
 
-# This is for ranking (person name match higher than location)
-REPEAT_COUNT_FOR_RANK = 5
+# This is for ranking (person name match higher than location):
+# a query word found in a person name counts this many times as much as
+# a query word found only in a location.
+NAME_MATCH_WEIGHT = 5
+
+# The index is asked for this many candidates per result wanted, so that
+# Persons matching the query in their names are not crowded out by Persons
+# matching it only in their locations before they are filtered and ranked.
+INDEX_RESULTS_PER_RESULT = 5
+
+# The maximum number of results the search API returns for a query.
+MAX_INDEX_RESULTS = 1000
+
+# The maximum number of documents the search API accepts in a single put or
+# delete call.
+MAX_DOCUMENTS_PER_BATCH = appengine_search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+
+# The number of attempts made to write a batch of documents.
+DEFAULT_INDEX_RETRIES = 3
 
 
 def create_sort_expressions():
@@ -100,31 +118,53 @@ def create_romanized_query_txt(query_txt):
     return enclose_in_parenthesis(romanized_query)
 
 
+class QueryMatcher(object):
+    """
+    Checks if a query matches records.
+    The query is romanized and its patterns are compiled once,
+    so that checking each record is cheap.
+    It should be used in get_person_ids_from_results method.
+    """
+
+    def __init__(self, query_txt):
+        self.query_txt = query_txt
+        # [[pattern for each word in search_terms], ...]
+        self.patterns_list = []
+        if query_txt:
+            for search_terms in script_variant.romanize_search_query(
+                    query_txt):
+                self.patterns_list.append(
+                    [re.compile(word, re.I)
+                     for word in search_terms.split(' ')])
+
+    def matches(self, romanized_values):
+        """
+        Args:
+            romanized_values: field values
+        Returns:
+            Boolean
+        """
+        # empty matches everything
+        if not self.query_txt:
+            return True
+
+        # A query matches a record if all search_terms appear in the record
+        text = ' '.join(romanized_values)
+        return any(all(pattern.search(text) for pattern in patterns)
+                   for patterns in self.patterns_list)
+
+
 def is_query_match(query_txt, romanized_values):
     """
     Checks if a query matches a record
-    It should be called in get_person_ids_from_results method.
+    Use QueryMatcher to check multiple records against the same query.
     Args:
         query_txt: Search query
         romanized_values: field values
     Returns:
         Boolean
     """
-    # empty matches everything
-    if not query_txt:
-        return True
-
-    romanized_query_list = (script_variant.romanize_search_query(query_txt))
-
-    # A query matches a record if all search_terms appear in the record
-    for search_terms in romanized_query_list:
-        words = search_terms.split(" ")
-        for word_index, word in enumerate(words):
-            if not re.search(word, " ".join(romanized_values), re.I):
-                break
-            if word_index == len(words) - 1:
-                return True
-    return False
+    return QueryMatcher(query_txt).matches(romanized_values)
 
 
 def get_person_ids_from_results(
@@ -133,20 +173,27 @@ def get_person_ids_from_results(
     Returns person record_id of persons
     whose name contain in romanized_name_query and
     location contain in romanized_location_query.
-    We use is_query_match to check if romanized_querys match
+    We use QueryMatcher to check if romanized_querys match
     at least a part of person name and location.
     To protect users' privacy, we should not return records
     which match location only.
     It also removes dups.
     (i.e., If results_list contains multiple results with the same index_results,
     it returns just one of them)
+    Within each results, persons are ordered by get_match_rank
+    (person name match > location match), keeping the index order for ties.
     """
     name_query_txt = query_dict.get('name', '')
     location_query_txt = query_dict.get('location', '')
+    name_matcher = QueryMatcher(name_query_txt)
+    location_matcher = QueryMatcher(location_query_txt)
+    query_word_variants = get_query_word_variants(
+        name_query_txt + ' ' + location_query_txt)
 
     index_results = []
     added_results = set()
     for results in results_list:
+        ranked_record_ids = []
         for document in results:
             fields = {field.name: field.value for field in
                           document.fields}
@@ -163,13 +210,54 @@ def get_person_ids_from_results(
             romanized_locations = [value for name, value in fields.items()
                                         if name in romanized_location_fields]
 
-            if (is_query_match(name_query_txt, romanized_names) and
-                is_query_match(location_query_txt, romanized_locations)):
-                index_results.append(record_id)
-                added_results.add(record_id)
+            if (name_matcher.matches(romanized_names) and
+                location_matcher.matches(romanized_locations)):
+                rank = get_match_rank(
+                    query_word_variants, romanized_names, romanized_locations)
+                ranked_record_ids.append((rank, record_id))
+        # sort() is stable, so ties keep the order of the index results.
+        ranked_record_ids.sort(key=lambda rank_and_id: -rank_and_id[0])
+        for rank, record_id in ranked_record_ids:
+            index_results.append(record_id)
+            added_results.add(record_id)
     return index_results
 
 
+def get_query_word_variants(query_txt):
+    """
+    Romanizes each word in query_txt.
+    Returns:
+        [[lowercased romanized query_word1, ...], ...]
+    """
+    return [[variant.lower()
+             for variant in script_variant.romanize_search_query(word)]
+            for word in query_txt.split()]
+
+
+def get_match_rank(query_word_variants, romanized_names,
+                   romanized_locations):
+    """
+    Ranks a record for the query (person name match > location match).
+    The full text index scores all fields alike, so we weight the
+    query words found in names by NAME_MATCH_WEIGHT here.
+    Args:
+        query_word_variants: result of get_query_word_variants
+        romanized_names: romanized name field values of the record
+        romanized_locations: romanized location field values of the record
+    Returns:
+        rank of the record (the higher, the better)
+    """
+    names = ' '.join(romanized_names).lower()
+    locations = ' '.join(romanized_locations).lower()
+    rank = 0
+    for variants in query_word_variants:
+        if any(variant in names for variant in variants):
+            rank += NAME_MATCH_WEIGHT
+        elif any(variant in locations for variant in variants):
+            rank += 1
+    return rank
+
+
 def search(repo, query_dict, max_results):
     """
     Searches person with index.
@@ -191,6 +279,8 @@ def search(repo, query_dict, max_results):
     if not name:
         return []
 
+    start_time = time.time()
+
     # Order does not matter
     query_list= [name, location]
     query_list_cleaned = query_list if location else [name]
@@ -224,7 +314,7 @@ def search(repo, query_dict, max_results):
                        returned_location_fields + ['record_id'])
 
     options = appengine_search.QueryOptions(
-        limit=max_results,
+        limit=min(max_results * INDEX_RESULTS_PER_RESULT, MAX_INDEX_RESULTS),
         sort_options=sort_opt,
         returned_fields=returned_fields)
 
@@ -233,56 +323,63 @@ def search(repo, query_dict, max_results):
     # (e.g., "repo: repository_name", "test: test", "test AND test").
     and_query = ' AND '.join(
         romanized_query_list) + ' AND (repo: ' + repo + ')'
-    person_location_index_results = person_location_index.search(
-        appengine_search.Query(
-            query_string=and_query, options=options))
 
     # To rank exact matches higher than
     # non-exact matches with the same romanization.
     non_romanized_and_query = (' AND '.join(non_romanized_query_list)
                                 + ' AND (repo: ' + repo + ')')
-    non_romanized_person_location_index_results = (
-        person_location_index.search(appengine_search.Query(
+
+    # Issue both searches before waiting for either of them.
+    index_search_start_time = time.time()
+    person_location_index_future = person_location_index.search_async(
+        appengine_search.Query(
+            query_string=and_query, options=options))
+    non_romanized_person_location_index_future = (
+        person_location_index.search_async(appengine_search.Query(
             query_string=non_romanized_and_query, options=options)))
 
-    results_list = [non_romanized_person_location_index_results,
-                    person_location_index_results]
+    results_list = [non_romanized_person_location_index_future.get_result(),
+                    person_location_index_future.get_result()]
 
+    filter_start_time = time.time()
     index_results = get_person_ids_from_results(query_dict,
-        results_list, returned_name_fields, returned_location_fields)
-
-    results = []
-    for record_id in index_results:
-        result = model.Person.get(repo, record_id, filter_expired=True)
-        if result:
-            results.append(result)
+        results_list, returned_name_fields, returned_location_fields
+    )[:max_results]
+
+    # Fetch all the hits with batched gets instead of one get per hit.
+    # get_all preserves the ranking order of index_results.
+    fetch_start_time = time.time()
+    results = model.Person.get_all(repo, index_results, filter_expired=True)
+    end_time = time.time()
+    logging.info(
+        'full_text_search found %d persons (%d matched): '
+        'query %.3f s, index search %.3f s, filter %.3f s, fetch %.3f s' % (
+            len(results), len(index_results),
+            index_search_start_time - start_time,
+            filter_start_time - index_search_start_time,
+            fetch_start_time - filter_start_time,
+            end_time - fetch_start_time))
     return results
 
 
-def create_fields_for_rank(field_name, values):
+def take_new_values(values, indexed_values):
     """
-    Creates fields for ranking. (person name match > location match)
-    MatchScorer class(assigns score) doesn't support to assign
-    a score based on term frequency in a field.
-    So we add 5 fields for each name params.
+    Drops the values which are already in the document, so that
+    identical values produced by different romanize methods are
+    indexed only once. Comparison ignores case because the index does.
     Args:
-        field_name: field name
-        values: field values
+        values: values to add to the document
+        indexed_values: lowercased values already in the document
+                        (updated with the new values)
     Returns:
-        array of appengine_search.TextField(name=field_name, value=value)
-           (length: REPEAT_COUNT_FOR_RANK)
+        array of the non-empty values which are not in indexed_values yet
     """
-    if not values:
-        return []
-
-    fields = []
-    for index, value in enumerate(values):
-        for x in xrange(REPEAT_COUNT_FOR_RANK):
-            fields.append(
-                appengine_search.TextField(name='%s_%d_for_rank_%d' % (
-                    field_name, index, x),
-                                           value=value))
-    return fields
+    new_values = []
+    for value in values:
+        if value and value.lower() not in indexed_values:
+            indexed_values.add(value.lower())
+            new_values.append(value)
+    return new_values
 
 
 def create_full_name_list_without_space(given_names, family_names):
@@ -301,71 +398,71 @@ def create_full_name_list_without_space(given_names, family_names):
 
 
 def create_full_name_without_space_fields(romanize_method, given_name,
-                                          family_name):
+                                          family_name, indexed_values):
     """
     Creates fields with the full name without white spaces.
+    Full names already in indexed_values are skipped.
     Returns:
         fullname fields, romanized_name_list: (for check)
     """
     fields = []
-    romanized_name_list = []
     romanized_given_names = romanize_method(given_name)
     romanized_family_names = romanize_method(family_name)
     romanize_method_name = romanize_method.__name__
-    full_names = create_full_name_list_without_space(
-        romanized_given_names, romanized_family_names)
+    full_names = take_new_values(create_full_name_list_without_space(
+        romanized_given_names, romanized_family_names), indexed_values)
     for index, full_name in enumerate(full_names):
         fields.append(appengine_search.TextField(
             name='no_space_full_name_romanized_by_%s_%d' % (
                 romanize_method_name, index),
             value=full_name))
-        romanized_name_list.append(full_name)
-    return fields, romanized_name_list
+    return fields, full_names
 
 
-def create_romanized_name_fields(romanize_method, **kwargs):
+def create_romanized_name_fields(romanize_method, indexed_values, **kwargs):
     """
     Creates romanized name fields (romanized by romanize_method)
     for full text search.
+    Names already indexed by another romanize method are skipped.
+    The names are not repeated for ranking; get_match_rank ranks
+    person name matches higher than location matches instead.
     """
     fields = []
     romanized_names_list = []
     romanize_method_name = romanize_method.__name__
 
     for field_name, field_value in kwargs.iteritems():
-        romanized_names = romanize_method(field_value)
-        for index, romanized_name in enumerate(romanized_names):
-            fields.extend(create_fields_for_rank('%s_romanized_by_%s_%d' %
-                                                 (field_name,
-                                                  romanize_method_name,
-                                                  index),
-                                                 romanized_name))
-        romanized_names_list.extend(romanized_names)
+        romanized_names_list.extend(take_new_values(
+            romanize_method(field_value), indexed_values))
 
     full_name_fields, romanized_full_names = (
         create_full_name_without_space_fields(
-            romanize_method, kwargs['given_name'], kwargs['family_name']))
+            romanize_method, kwargs['given_name'], kwargs['family_name'],
+            indexed_values))
     fields.extend(full_name_fields)
     romanized_names_list.extend(romanized_full_names)
 
-    names = ':'.join([name for name in romanized_names_list if name])
-    fields.append(
-        appengine_search.TextField(
-            name='names_romanized_by_' + romanize_method_name,
-            value=names))
+    if romanized_names_list:
+        fields.append(
+            appengine_search.TextField(
+                name='names_romanized_by_' + romanize_method_name,
+                value=':'.join(romanized_names_list)))
 
     return fields
 
 
-def create_romanized_location_fields(romanize_method, **kwargs):
+def create_romanized_location_fields(romanize_method, indexed_values,
+                                     **kwargs):
     """
     Creates romanized location fields (romanized by romanize_method)
     for full text search.
+    Locations already indexed by another romanize method are skipped.
     """
     fields = []
     romanize_method_name = romanize_method.__name__
     for field in kwargs:
-        romanized_locations = romanize_method(kwargs[field])
+        romanized_locations = take_new_values(
+            romanize_method(kwargs[field]), indexed_values)
         for index, romanized_location in enumerate(romanized_locations):
             fields.append(
                 appengine_search.TextField(
@@ -373,11 +470,12 @@ def create_romanized_location_fields(romanize_method, **kwargs):
                         field, romanize_method_name, index),
                     value=romanized_location)
             )
-    full_romanized_location = ':'.join(
-        location.value for location in fields if location.value)
-    fields.append(appengine_search.TextField(
-        name='full_location_romanized_by_' + romanize_method_name,
-        value=full_romanized_location))
+    if fields:
+        full_romanized_location = ':'.join(
+            location.value for location in fields)
+        fields.append(appengine_search.TextField(
+            name='full_location_romanized_by_' + romanize_method_name,
+            value=full_romanized_location))
     return fields
 
 
@@ -388,11 +486,13 @@ def create_non_romanized_fields(**kwargs):
     e.g.,
     if there are records record1:[name=菊地真], record2:[name=菊地眞],
     get results(1st: 菊地真、2nd: 菊地眞) when search by "菊地 真"
+    Empty fields are omitted.
     """
     fields = []
     for field_name in kwargs:
-        fields.append(appengine_search.TextField(
-            name=field_name, value=kwargs[field_name]))
+        if kwargs[field_name]:
+            fields.append(appengine_search.TextField(
+                name=field_name, value=kwargs[field_name]))
     return fields
 
 
@@ -424,16 +524,21 @@ def create_document(person):
 
     # Applies two methods because kanji is used in Chinese and Japanese,
     # and romanizing in chinese and japanese is different.
-
+    # Many values (e.g., any Latin name) romanize the same way with every
+    # method, so each value is indexed only by the first method producing it.
+    indexed_names = set()
+    indexed_locations = set()
     for romanize_method in ROMANIZE_METHODS:
         fields.extend(create_romanized_name_fields(
             romanize_method,
+            indexed_names,
             given_name=person.given_name,
             family_name=person.family_name,
             full_name=person.full_name,
             alternate_names=person.alternate_names))
         fields.extend(create_romanized_location_fields(
             romanize_method,
+            indexed_locations,
             home_city=person.home_city,
             home_state=person.home_state,
             home_postal_code=person.home_postal_code,
@@ -443,6 +548,83 @@ def create_document(person):
     return appengine_search.Document(doc_id=doc_id, fields=fields)
 
 
+class BatchIndexWriter(object):
+    """Accumulates documents to add to and delete from the full-text index,
+    and writes them in batches of MAX_DOCUMENTS_PER_BATCH instead of making
+    one index call per person.  Pending documents are written when a batch
+    fills up and when flush() is called, so callers must call flush() when
+    they are done (or use the writer as a context manager).
+
+    If a batch partially fails, only the failed documents are retried, up to
+    'retries' attempts in total; after that the last search.Error is raised,
+    as add_record_to_index and delete_record_from_index do."""
+
+    def __init__(self, retries=DEFAULT_INDEX_RETRIES):
+        self.retries = retries
+        self._index = appengine_search.Index(
+            name=PERSON_LOCATION_FULL_TEXT_INDEX_NAME)
+        self._documents = []
+        self._doc_ids_to_delete = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not exc_type:
+            self.flush()
+
+    def add(self, person):
+        """Adds or replaces the document for a person."""
+        self._documents.append(create_document(person))
+        if len(self._documents) >= MAX_DOCUMENTS_PER_BATCH:
+            self._flush_documents()
+
+    def delete(self, person):
+        """Deletes the document for a person."""
+        self._doc_ids_to_delete.append(person.repo + ':' + person.record_id)
+        if len(self._doc_ids_to_delete) >= MAX_DOCUMENTS_PER_BATCH:
+            self._flush_deletions()
+
+    def flush(self):
+        """Writes all the pending additions and deletions."""
+        self._flush_documents()
+        self._flush_deletions()
+
+    def _flush_documents(self):
+        documents, self._documents = self._documents, []
+        self._write(self._index.put, documents, appengine_search.PutError)
+
+    def _flush_deletions(self):
+        doc_ids, self._doc_ids_to_delete = self._doc_ids_to_delete, []
+        self._write(self._index.delete, doc_ids, appengine_search.DeleteError)
+
+    def _write(self, write_function, items, error_class):
+        """Calls write_function on a batch of items (documents or doc IDs),
+        retrying only the items that failed with a retriable error."""
+        for attempt in xrange(self.retries):
+            if not items:
+                return
+            try:
+                write_function(items)
+                return
+            except error_class, e:
+                if attempt == self.retries - 1:
+                    raise
+                failed_items = [
+                    item for item, result in zip(items, e.results)
+                    if result.code != appengine_search.OperationResult.OK]
+                retriable_items = [
+                    item for item, result in zip(items, e.results)
+                    if result.code not in [
+                        appengine_search.OperationResult.OK,
+                        appengine_search.OperationResult.INVALID_REQUEST]]
+                if len(retriable_items) < len(failed_items):
+                    raise
+                logging.warn('Retrying %d of %d documents: %s' % (
+                    len(retriable_items), len(items), e))
+                items = retriable_items
+
+
 def add_record_to_index(person):
     """
     Adds person record to index.
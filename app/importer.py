@@ -19,20 +19,35 @@ The values of all dictionary fields are Unicode strings."""
 
 __author__ = 'kpy@google.com (Ka-Ping Yee) and many other Googlers'
 
+import calendar
+import collections
+import csv
 import datetime
+import functools
+import itertools
 import logging
 import re
 import sys
+import time
 
 from google.appengine.api import datastore_errors
 
+import full_text_search
 import subscribe
+import utils
 from model import *
 from utils import validate_sex, validate_status, validate_approximate_date, \
                   validate_age, get_utcnow, get_full_name
 
 DEFAULT_PUT_RETRIES = 3
 MAX_PUT_BATCH = 100
+# Number of db.put_async calls that BatchWriter keeps in flight at once.
+MAX_PUTS_IN_FLIGHT = 4
+# Delay before the first retry of a failed batch, doubled for each retry.
+PUT_RETRY_BACKOFF_SECONDS = 0.5
+# Records imported between two checkpoints of a background import.
+BACKGROUND_IMPORT_BATCH_SIZE = MAX_PUT_BATCH
+BACKGROUND_IMPORT_ACTION = 'tasks/process_import'
 
 def utf8_decoder(dict_reader):
     """Yields a dictionary where all string values are converted to Unicode.
@@ -50,16 +65,77 @@ def utf8_decoder(dict_reader):
                 record[key] = value.decode('utf-8')
         yield record
 
-def put_batch(batch, retries=DEFAULT_PUT_RETRIES):
-    for attempt in range(retries):
+class BatchWriter(object):
+    """Writes batches of entities with db.put_async, keeping up to
+    max_in_flight batches in flight, so that writing many batches isn't
+    bounded by the latency of each put.  A batch whose put fails is put again
+    after a backoff delay (only that batch; the others are unaffected), up to
+    'retries' attempts in total, after which it is given up on.  Callers must
+    call flush() to wait for all the batches to be written."""
+
+    def __init__(self, retries=DEFAULT_PUT_RETRIES,
+                 max_in_flight=MAX_PUTS_IN_FLIGHT,
+                 backoff_seconds=PUT_RETRY_BACKOFF_SECONDS):
+        self.retries = retries
+        self.max_in_flight = max_in_flight
+        self.backoff_seconds = backoff_seconds
+        # (batch, rpc, attempt, start_time, callback) for each batch in flight
+        self._in_flight = collections.deque()
+        self.written = 0  # number of entities written
+        self.batch_count = 0  # number of batches written
+        self.retry_count = 0  # number of retried puts
+        self.failed = 0  # number of entities given up on
+
+    def put(self, batch, callback=None):
+        """Starts writing a batch of entities.  callback is called with no
+        arguments once the whole batch has been written."""
+        self._start(batch, 0, callback)
+        while len(self._in_flight) >= self.max_in_flight:
+            self._wait()
+
+    def flush(self):
+        """Waits for all the batches to be written, and returns the number of
+        entities written so far."""
+        while self._in_flight:
+            self._wait()
+        if self.retry_count or self.failed:
+            logging.warn('Retried %d puts, failed to write %d records' % (
+                self.retry_count, self.failed))
+        return self.written
+
+    def _start(self, batch, attempt, callback):
+        self._in_flight.append(
+            (batch, db.put_async(batch), attempt, time.time(), callback))
+
+    def _wait(self):
+        """Waits for the oldest batch in flight, retrying it if it failed."""
+        batch, rpc, attempt, start_time, callback = self._in_flight.popleft()
         try:
-            db.put(batch)
-            logging.info('Imported records: %d' % len(batch))
-            return len(batch)
+            rpc.get_result()
         except:
             type, value, traceback = sys.exc_info()
-            logging.warn('Retrying batch: %s' % value)
-    return 0
+            if attempt + 1 >= self.retries:
+                logging.error('Giving up on batch of %d: %s' % (
+                    len(batch), value))
+                self.failed += len(batch)
+                return
+            logging.warn('Retrying batch of %d: %s' % (len(batch), value))
+            time.sleep(self.backoff_seconds * 2 ** attempt)
+            self.retry_count += 1
+            self._start(batch, attempt + 1, callback)
+            return
+        logging.info('Imported records: %d in %.3f s (attempt %d)' % (
+            len(batch), time.time() - start_time, attempt + 1))
+        self.written += len(batch)
+        self.batch_count += 1
+        if callback:
+            callback()
+
+
+def put_batch(batch, retries=DEFAULT_PUT_RETRIES):
+    writer = BatchWriter(retries=retries)
+    writer.put(batch)
+    return writer.flush()
 
 date_re = re.compile(r'^(\d\d\d\d)-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)Z$')
 
@@ -84,12 +160,48 @@ def validate_boolean(string):
     return (isinstance(string, basestring) and
             string.strip().lower() in ['true', 'yes', 'y', '1'])
 
-def create_person(repo, fields):
+class ImportContext(object):
+    """State shared by the conversion of all the records in one import, so
+    that converters don't have to look up the repository configuration for
+    each record."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self._config = None
+        self._ids = []  # IDs to hand out before getting new ones
+        # Whether records with the IDs in _ids may already have been written.
+        self.ids_may_be_used = False
+
+    @property
+    def config(self):
+        """The configuration of the repository, fetched on first use."""
+        if self._config is None:
+            self._config = config.Configuration(self.repo)
+        return self._config
+
+    def use_ids(self, ids, may_be_used=False):
+        """Makes create_id hand out the given IDs before any new ones.  Set
+        may_be_used if records with these IDs may already have been written,
+        by an earlier attempt at the same import that didn't finish."""
+        self._ids = list(ids)
+        self.ids_may_be_used = may_be_used
+
+    def create_id(self):
+        """Returns the next ID passed to use_ids, or else a new unique ID
+        from UniqueId.create_id, which reserves IDs in blocks rather than
+        making a datastore call for each."""
+        if self._ids:
+            return self._ids.pop(0)
+        return UniqueId.create_id()
+
+
+def create_person(repo, fields, context=None):
     """Creates a Person entity in the given repository with the given field
     values.  If 'fields' contains a 'person_record_id', calling put() on the
     resulting entity will overwrite any existing (original or clone) record
     with the same person_record_id.  Otherwise, a new original person record is
-    created in the given repository."""
+    created in the given repository.  Pass an ImportContext when creating many
+    Persons."""
     person_fields = dict(
         entry_date=get_utcnow(),
         expiry_date=validate_datetime(fields.get('expiry_date')),
@@ -123,7 +235,7 @@ def create_person(repo, fields):
         person_fields['full_name'] = get_full_name(
             person_fields['given_name'],
             person_fields['family_name'],
-            config.Configuration(repo))
+            context.config if context else config.Configuration(repo))
     # TODO(liuhsinwen): Separate existed and non-existed record id and
     # increment person counter for new records
     record_id = strip(fields.get('person_record_id'))
@@ -134,17 +246,16 @@ def create_person(repo, fields):
             return Person.create_original_with_record_id(
                 repo, record_id, **person_fields)
     else:  # create a new original record
-        # TODO(liuhsinwen): fix performance problem by incrementing the counter
-        # by the number of upload records
-        # UsageCounter.increment_person_counter(repo)
-        return Person.create_original(repo, **person_fields)
+        return Person.create_original(
+            repo, unique_id=context and context.create_id(), **person_fields)
 
-def create_note(repo, fields):
+def create_note(repo, fields, context=None):
     """Creates a Note entity in the given repository with the given field
     values.  If 'fields' contains a 'note_record_id', calling put() on the
     resulting entity will overwrite any existing (original or clone) record
     with the same note_record_id.  Otherwise, a new original note record is
-    created in the given repository."""
+    created in the given repository.  Pass an ImportContext when creating many
+    Notes."""
     assert strip(fields.get('person_record_id')), 'person_record_id is required'
     assert strip(fields.get('source_date')), 'source_date is required'
     note_fields = dict(
@@ -173,20 +284,39 @@ def create_note(repo, fields):
             return Note.create_original_with_record_id(
                 repo, record_id, **note_fields)
     else:  # create a new original record
-        # TODO(liuhsinwen): fix performance problem by incrementing the counter
-        # by the number of upload notes
-        # UsageCounter.increment_note_counter(repo)
-        return Note.create_original(repo, **note_fields)
+        return Note.create_original(
+            repo, unique_id=context and context.create_id(), **note_fields)
+
+def get_replaced_records(repo, entities, new_record_ids):
+    """Gets the unexpired records that writing the given entities will
+    overwrite, in a dictionary keyed by key.  Entities for new original
+    records (whose record IDs are in new_record_ids) can't overwrite
+    anything, so they aren't looked up."""
+    records = []
+    for kind in [Person, Note]:
+        records += kind.get_all(
+            repo, [entity.record_id for entity in entities
+                   if isinstance(entity, kind) and
+                   entity.record_id not in new_record_ids],
+            limit=MAX_PUT_BATCH, filter_expired=True)
+    return dict((record.key(), record) for record in records)
+
+def get_usage_counter_names(entity):
+    """Gets the names of the UsageCounters that a new original record counts
+    towards, matching Person.put_new and Note.put_new."""
+    if isinstance(entity, Note):
+        return ['note', entity.status or 'unspecified']
+    return ['person']
 
 def filter_new_notes(entities, repo):
     """Filter the notes which are new."""
-    notes = []
-    for entity in entities:
-        # Send an an email notification for new notes only
-        if isinstance(entity, Note):
-            if not Note.get(repo, entity.get_note_record_id()):
-                notes.append(entity)
-    return notes
+    # Send an an email notification for new notes only
+    notes = [entity for entity in entities if isinstance(entity, Note)]
+    existing_note_ids = set(note.get_note_record_id() for note in Note.get_all(
+        repo, [note.get_note_record_id() for note in notes],
+        filter_expired=True))
+    return [note for note in notes
+            if note.get_note_record_id() not in existing_note_ids]
 
 
 def send_notifications(handler, persons, notes):
@@ -203,19 +333,80 @@ def send_notifications(handler, persons, notes):
         subscribe.send_notifications(handler, person, [note])
 
 
+NOTE_MATCH_FIELDS = [
+    'person_record_id', 'author_name', 'author_email', 'author_phone',
+    'source_date', 'status', 'author_made_contact', 'email_of_found_person',
+    'phone_of_found_person', 'last_known_location', 'text', 'photo_url']
+
+def get_note_fingerprint(note):
+    """Returns a hashable tuple of the fields compared by notes_match."""
+    return tuple(getattr(note, f) for f in NOTE_MATCH_FIELDS)
+
+
 def notes_match(a, b):
-    fields = ['person_record_id', 'author_name', 'author_email', 'author_phone',
-              'source_date', 'status', 'author_made_contact',
-              'email_of_found_person', 'phone_of_found_person',
-              'last_known_location', 'text', 'photo_url']
-    return [getattr(a, f) for f in fields] == [getattr(b, f) for f in fields]
+    return get_note_fingerprint(a) == get_note_fingerprint(b)
+
+
+def prefetch_persons(repo, person_record_ids):
+    """Gets the unexpired Persons with the given person_record_ids in batches,
+    returning a dictionary keyed by person_record_id."""
+    return dict((person.record_id, person) for person in
+                Person.get_all(repo, person_record_ids, filter_expired=True))
+
+
+def split_notes_by_known_person(repo, person_records, note_records):
+    """Splits note records into those on the Persons in person_records or
+    on existing unexpired Persons, and the rest, whose Persons may not have
+    been imported yet.  Returns the two lists of note records."""
+    person_record_ids = set(
+        record.get('person_record_id') for record in person_records)
+    other_person_record_ids = set(
+        record.get('person_record_id') for record in note_records
+        if record.get('person_record_id')) - person_record_ids
+    person_record_ids.update(prefetch_persons(repo, other_person_record_ids))
+    known, unknown = [], []
+    for record in note_records:
+        if (not record.get('person_record_id') or
+            record['person_record_id'] in person_record_ids):
+            known.append(record)
+        else:
+            unknown.append(record)
+    return known, unknown
+
+def update_persons_from_notes(repo, person_record_ids, min_entry_date):
+    """Updates the latest_* fields on the given Persons from their Notes that
+    were entered at or after min_entry_date, as import_records does for the
+    Notes it imports, and stores the Persons.  This is for Persons that an
+    import overwrote after it had imported Notes on them."""
+    persons = Person.get_all(repo, person_record_ids)
+    notes_by_person_record_id = Note.get_by_person_record_ids(
+        repo, [person.record_id for person in persons])
+    for person in persons:
+        for note in notes_by_person_record_id[person.record_id]:
+            if note.entry_date >= min_entry_date:
+                person.update_from_note(note)
+    db.put(persons)
+
+def prefetch_note_fingerprints(repo, person_record_ids,
+                               ignored_record_ids=()):
+    """Gets the fingerprints of all the existing Notes (including expired
+    ones) on the given Persons, except those with the ignored_record_ids,
+    returning a dictionary of sets keyed by person_record_id."""
+    notes_by_person_record_id = Note.get_by_person_record_ids(
+        repo, person_record_ids, filter_expired=False)
+    return dict((person_record_id,
+                 set(get_note_fingerprint(note) for note in notes
+                     if note.record_id not in ignored_record_ids))
+                for person_record_id, notes in
+                notes_by_person_record_id.iteritems())
 
 
 def import_records(repo, domain, converter, records,
                    mark_notes_reviewed=False,
                    believed_dead_permission=False,
                    handler=None,
-                   omit_duplicate_notes=False):
+                   omit_duplicate_notes=False,
+                   context=None):
     """Convert and import a list of entries into a respository.
 
     Args:
@@ -223,7 +414,8 @@ def import_records(repo, domain, converter, records,
         domain: Accept only records that have this original domain.  Only one
             original domain may be imported at a time.
         converter: A function to transform a dictionary of fields to a
-            datastore entity.  This function may throw an exception if there
+            datastore entity, called as converter(repo, fields, context).
+            This function may throw an exception if there
             is anything wrong with the input fields and import_records will
             skip the bad record.  The key_name of the resulting datastore
             entity must begin with domain + '/', or the record will be skipped.
@@ -235,6 +427,8 @@ def import_records(repo, domain, converter, records,
             is None, then we do not send e-mail.
         omit_duplicate_notes: If true, skip any Notes that are identical to
             existing Notes on the same Person.
+        context: The ImportContext to pass to the converter.  If this is
+            None, a new one is used for this import.
 
     Returns:
         The number of passed-in records that were written (not counting other
@@ -242,17 +436,25 @@ def import_records(repo, domain, converter, records,
         of (error_message, record) pairs for the skipped records, and the
         number of records processed in total.
     """
+    # Shared by all the conversions, so that the configuration is looked up
+    # once and unique IDs are allocated in batches.
+    context = context or ImportContext(repo)
     persons = {}  # Person entities to write
+    # Full-text index documents for the Persons are written in batches.
+    index_writer = full_text_search.BatchIndexWriter()
     # Note entries in the records (incliding ones skipped later) with their
     # original fields.
     input_notes_with_fields = []
     skipped = []  # entities skipped due to an error
     total = 0  # total number of entities for which conversion was attempted
+    # Record IDs of the new original records (those that came in without a
+    # record ID), which are added to the UsageCounters once written.
+    new_record_ids = set()
 
     for fields in records:
         total += 1
         try:
-            entity = converter(repo, fields)
+            entity = converter(repo, fields, context)
         except (KeyError, ValueError, AssertionError,
                 datastore_errors.BadValueError), e:
             skipped.append((e.__class__.__name__ + ': ' + str(e), fields))
@@ -261,11 +463,16 @@ def import_records(repo, domain, converter, records,
             skipped.append(
                 ('Not in authorized domain: %r' % entity.record_id, fields))
             continue
+        record_id_field = (isinstance(entity, Note) and 'note_record_id' or
+                           'person_record_id')
+        if not strip(fields.get(record_id_field)):
+            new_record_ids.add(entity.record_id)
         if isinstance(entity, Person):
-            entity.update_index(['old', 'new'])
+            entity.update_index(['old', 'new'], index_writer=index_writer)
             persons[entity.record_id] = entity
         if isinstance(entity, Note):
             input_notes_with_fields.append((entity, fields))
+    index_writer.flush()
 
     # Note entities to write
     notes = {}
@@ -278,6 +485,25 @@ def import_records(repo, domain, converter, records,
     # produce a count of records written that only counts 'persons'.
     extra_persons = {}
 
+    # Fetch everything the Notes are checked against up front, in batches,
+    # rather than once per Note.
+    referenced_person_ids = set(
+        note.person_record_id for note, fields in input_notes_with_fields)
+    # Other Persons that are not part of this import.
+    other_persons = prefetch_persons(
+        repo, [person_record_id for person_record_id in referenced_person_ids
+               if person_record_id not in persons])
+    if omit_duplicate_notes:
+        ignored_record_ids = set()
+        if context.ids_may_be_used:
+            # Notes written by an earlier attempt at this import have the
+            # same record IDs as the ones being imported, and aren't
+            # duplicates of them.
+            ignored_record_ids = set(
+                note.record_id for note, fields in input_notes_with_fields)
+        existing_note_fingerprints = prefetch_note_fingerprints(
+            repo, referenced_person_ids, ignored_record_ids)
+
     for (note, fields) in input_notes_with_fields:
         if note.person_record_id in persons:
             # This Note belongs to a Person that is being imported.
@@ -289,7 +515,7 @@ def import_records(repo, domain, converter, records,
         else:
             # This Note belongs to some other Person that is not part of this
             # import and this is the first such Note in this import.
-            person = Person.get(repo, note.person_record_id)
+            person = other_persons.get(note.person_record_id)
 
         if not person:
             skipped.append(
@@ -312,9 +538,8 @@ def import_records(repo, domain, converter, records,
             continue
         # Check whether the note is a duplicate.
         if omit_duplicate_notes:
-            other_notes = Note.get_by_person_record_id(
-                repo, note.person_record_id, filter_expired=False)
-            if any(notes_match(note, other_note) for other_note in other_notes):
+            if (get_note_fingerprint(note) in
+                existing_note_fingerprints[note.person_record_id]):
                 skipped.append(
                     ('This is a duplicate of an existing note', fields))
                 continue
@@ -334,25 +559,291 @@ def import_records(repo, domain, converter, records,
     # Now store the imported Persons and Notes, and count them.
     entities = persons.values() + notes.values()
     all_persons = dict(persons, **extra_persons)
-    written = 0
-    while entities:
+    # The unexpired records that the imported ones replace, which are no
+    # longer counted once overwritten.
+    if context.ids_may_be_used:
+        # An earlier attempt at this import may have written the records
+        # that came in without record IDs, with the same IDs, so they are
+        # looked up too, and the ones found are not new.
+        replaced_records = get_replaced_records(repo, entities, set())
+        new_record_ids -= set(
+            record.record_id for record in replaced_records.values())
+    else:
+        replaced_records = get_replaced_records(
+            repo, entities, new_record_ids)
+    writer = BatchWriter()
+    written_counts = []  # sizes of the batches of entities written
+    usage_counts = collections.defaultdict(int)  # UsageCounter increments
+    added_records = []  # records written, for the count deltas
+    removed_records = []  # records overwritten, for the count deltas
+
+    def batch_written(batch, new_notes):
+        written_counts.append(len(batch))
+        added_records.extend(batch)
+        removed_records.extend(
+            replaced_records[entity.key()] for entity in batch
+            if entity.key() in replaced_records)
+        for entity in batch:
+            if entity.record_id in new_record_ids:
+                for counter_name in get_usage_counter_names(entity):
+                    usage_counts[counter_name] += 1
+        # If we have new_notes and results did not fail then send notifications.
+        if new_notes:
+            send_notifications(handler, all_persons, new_notes)
+
+    for start in xrange(0, len(entities), MAX_PUT_BATCH):
+        batch = entities[start:start + MAX_PUT_BATCH]
         # The presence of a handler indicates we should notify subscribers 
         # for any new notes being written. We do not notify on 
         # "re-imported" existing notes to avoid spamming subscribers.
         new_notes = []
         if handler:
-            new_notes = filter_new_notes(entities[:MAX_PUT_BATCH], repo)
-        written_batch = put_batch(entities[:MAX_PUT_BATCH])
-        written += written_batch
-        # If we have new_notes and results did not fail then send notifications.
-        if new_notes and written_batch:
-            send_notifications(handler, all_persons, new_notes)
-        entities[:MAX_PUT_BATCH] = []
+            new_notes = filter_new_notes(batch, repo)
+        writer.put(batch, functools.partial(batch_written, batch, new_notes))
 
     # Also store the other updated Persons, but don't count them.
     entities = extra_persons.values()
-    while entities:
-        put_batch(entities[:MAX_PUT_BATCH])
-        entities[:MAX_PUT_BATCH] = []
+    for start in xrange(0, len(entities), MAX_PUT_BATCH):
+        writer.put(entities[start:start + MAX_PUT_BATCH])
+
+    writer.flush()
+    logging.info('import_records wrote %d records in %d batches' % (
+        writer.written, writer.batch_count))
+    # One increment for the whole import rather than one per record.
+    UsageCounter.increment_counters(repo, usage_counts)
+    add_count_deltas(repo, added=added_records, removed=removed_records)
+    return sum(written_counts), skipped, total
+
+
+class InputFileError(Exception):
+    pass
+
+
+def complete_record_ids(record, domain):
+    """Ensures that a record's record_id fields are prefixed with a domain."""
+    def complete(record, field):
+        id = record.get(field)
+        if id and '/' not in id:
+            record[field] = '%s/%s' % (domain, id)
+    complete(record, 'person_record_id')
+    complete(record, 'note_record_id')
+    return record
+
+
+def generate_note_record_ids(records, context):
+    """Fills in missing note_record_ids with IDs from an
+    ImportContext."""
+    for record in records:
+        if not record.get('note_record_id', '').strip():
+            record['note_record_id'] = str(context.create_id())
+        yield record
+
+
+def convert_time(text, offset):
+    """Converts a textual date and time into an RFC 3339 UTC timestamp."""
+    if utils.DATETIME_RE.match(text.strip()):  # don't apply offset
+        return text
+    match = re.search(r'(\d\d\d\d)[/-](\d+)[/-](\d+) *(\d+):(\d+)', text)
+    if match:
+        y, l, d, h, m = map(int, match.groups())
+        timestamp = calendar.timegm((y, l, d, h, m, 0)) - offset*3600
+        return utils.format_utc_timestamp(timestamp)
+    return text  # keep the original text so it shows up in the error message
+
+
+def convert_time_fields(rows, default_offset=0):
+    """Filters CSV rows, converting time fields to RFC 3339 UTC times.
+
+    The first row that contains "person_record_id" is assumed to be the header
+    row containing field names.  Preceding rows are treated as a preamble.
+
+    If the text "time_zone_offset" is found in the preamble section, the cell
+    immediately below it is treated as a time zone offset from UTC in hours.
+    Otherwise default_offset is used as the time zone offset.
 
-    return written, skipped, total
+    Rows below the header row are returned as dictionaries (as csv.DictReader
+    would), except that any "*_date" fields are parsed as local times,
+    converted to UTC according to the specified offset, and reformatted
+    as RFC 3339 UTC times.
+    """
+    field_names = []
+    time_fields = []
+    setting_names = []
+    settings = {}
+    offset = default_offset
+
+    for row in rows:
+        if field_names:
+            record = dict(zip(field_names, row))
+            for key in time_fields:
+                record[key] = convert_time(record[key], offset)
+            yield record
+
+        elif 'person_record_id' in row:
+            field_names = [name.lower().strip() for name in row]
+            time_fields = [name for name in row if name.endswith('_date')]
+            if 'time_zone_offset' in settings:
+                try:
+                    offset = float(settings['time_zone_offset'])
+                except ValueError:
+                    raise InputFileError('invalid time_zone_offset value')
+
+        else:
+            settings.update(dict(zip(setting_names, row)))
+            setting_names = [name.lower().strip() for name in row]
+
+
+class LineReader(object):
+    """Iterates over the lines in a sequence of strings, keeping track of the
+    offset just past the last line returned.  Because csv.reader doesn't read
+    ahead, this is the offset at which the next CSV row starts."""
+
+    def __init__(self, strings, offset=0):
+        self.strings = iter(strings)
+        self.offset = offset
+        self.buffer = ''
+        self.position = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        end = self.buffer.find('\n', self.position)
+        while end < 0:
+            try:
+                self.buffer = self.buffer[self.position:] + next(self.strings)
+                self.position = 0
+            except StopIteration:
+                if self.position == len(self.buffer):
+                    raise
+                end = len(self.buffer) - 1
+                break
+            end = self.buffer.find('\n')
+        line = self.buffer[self.position:end + 1]
+        self.position = end + 1
+        self.offset += len(line)
+        return line
+
+
+def find_header_end(content):
+    """Returns the offset just past the header row of a CSV file, i.e. the row
+    that convert_time_fields takes for the field names."""
+    lines = LineReader([content])
+    for row in csv.reader(lines):
+        if 'person_record_id' in row:
+            return lines.offset
+    return len(content)
+
+
+def split_person_and_note_records(records):
+    """Splits the records of a persons file into the Person records and the
+    Note records (a row can be both)."""
+    is_not_empty = lambda x: (x or '').strip()
+    persons = [r for r in records if is_not_empty(r.get('full_name'))]
+    notes = [r for r in records if is_not_empty(r.get('note_record_id'))]
+    return persons, notes
+
+
+def read_import_job(job):
+    """Starts reading the records of an ImportJob from its offset.  The file
+    is streamed through csv.reader, convert_time_fields and utf8_decoder.
+    Returns the LineReader for the records, which keeps track of the offset,
+    and an iterator over the records."""
+    # The preamble and header rows are read again on every resume.
+    header = LineReader(job.generate_content(0, job.header_end))
+    start = max(job.offset, job.header_end)
+    lines = LineReader(job.generate_content(start), start)
+    records = utf8_decoder(
+        convert_time_fields(csv.reader(itertools.chain(header, lines))))
+    return lines, records
+
+
+def run_import_job(job, time_limit):
+    """Imports the records of a ImportJob, starting where it left off.
+    The records are imported BACKGROUND_IMPORT_BATCH_SIZE at a time,
+    checkpointing the offset of the next record after each batch.  A file in
+    the persons format is read twice, first for its Persons and then for its
+    Notes, so that each Note is imported after its Person even if the Person
+    comes later in the file.
+
+    The IDs for the records in a batch that have no record IDs are reserved
+    and stored in the job before the batch is imported, so that a batch that
+    is imported again after an interrupted attempt gives its records the same
+    IDs, overwriting them rather than writing duplicates.
+
+    Stops after the batch during which time_limit (a datetime) passes.
+
+    Returns:
+        True if the job is finished (done or failed), or False if it has to
+        be resumed.
+    """
+    context = ImportContext(job.repo)
+    lines, records = read_import_job(job)
+    try:
+        while True:
+            batch = list(
+                itertools.islice(records, BACKGROUND_IMPORT_BATCH_SIZE))
+            if not batch:
+                if job.format == 'notes' or job.notes_pass:
+                    job.status = ImportJob.Status.DONE
+                    break
+                # All the Persons are in; read the file again for the Notes.
+                job.notes_pass = True
+                job.offset = job.header_end
+                job.put()
+                lines, records = read_import_job(job)
+                continue
+            if job.format == 'notes':
+                persons, notes = [], batch
+            else:
+                persons, notes = split_person_and_note_records(batch)
+                if job.notes_pass:
+                    persons = []
+                else:
+                    notes = []
+
+            num_missing_ids = len(
+                [r for r in persons if not strip(r.get('person_record_id'))] +
+                [r for r in notes if not strip(r.get('note_record_id'))])
+            ids_may_be_used = bool(job.batch_ids)
+            if num_missing_ids and not job.batch_ids:
+                job.batch_ids = UniqueId.create_ids(num_missing_ids)
+                job.put()
+            context.use_ids(job.batch_ids, ids_may_be_used)
+            if job.format == 'notes':
+                notes = list(generate_note_record_ids(notes, context))
+            persons = [complete_record_ids(r, job.source_domain)
+                       for r in persons]
+            notes = [complete_record_ids(r, job.source_domain)
+                     for r in notes]
+
+            persons_written, persons_skipped, persons_total = (
+                import_records(
+                    job.repo, job.source_domain, create_person,
+                    persons, context=context))
+            notes_written, notes_skipped, notes_total = import_records(
+                job.repo, job.source_domain, create_note, notes,
+                believed_dead_permission=job.believed_dead_permission,
+                omit_duplicate_notes=(job.format == 'notes'),
+                context=context)
+
+            job.persons_written += persons_written
+            job.notes_written += notes_written
+            job.total += persons_total + notes_total
+            for message, fields in persons_skipped + notes_skipped:
+                job.skipped += 1
+                if len(job.skipped_messages) < job.MAX_SKIPPED_MESSAGES:
+                    job.skipped_messages.append(message)
+            job.offset = lines.offset
+            job.batch_ids = []
+            job.put()
+            if get_utcnow() >= time_limit:
+                return False
+    except (InputFileError, csv.Error), e:
+        job.status = ImportJob.Status.FAILED
+        job.error = 'Problem in the uploaded file: %s' % e
+    job.put()
+    job.delete_content()
+    logging.info('Import job %s %s: %d persons and %d notes written' % (
+        job.key().name(), job.status, job.persons_written, job.notes_written))
+    return True
@@ -34,8 +34,11 @@ but will not be retrieved by:
 from text_query import TextQuery
 
 from google.appengine.ext import db
+import array
+import bisect
 import unicodedata
 import logging
+import config
 import model
 import re
 import jautils
@@ -78,117 +81,311 @@ def get_alternate_name_tokens(person):
     return tokens
 
 
-class CmpResults():
+class NameIndex(object):
+    """An in-memory inverted index from names_prefixes tokens to the Persons
+    in one repository.
+
+    Each Person gets a small local ID when it is first seen, and each token
+    maps to a sorted array of local IDs (its posting list), so a query can be
+    answered by intersecting posting lists instead of running datastore
+    queries with one filter per query word.  The index is kept up to date
+    incrementally: Person.update_index() updates it for writes made by this
+    instance, and refresh() picks up writes made by other instances by
+    querying for Persons modified since the previous refresh.  The first
+    refresh reads the whole repository, so it is done a few batches per
+    search, and searches use the datastore until it has caught up."""
+
+    # The number of Persons to fetch per batch in refresh().
+    REFRESH_BATCH_SIZE = 500
+
+    # The most batches that refresh() reads for one search request, so that
+    # building the index of a large repository is spread over many requests.
+    MAX_REFRESH_BATCHES_PER_SEARCH = 2
+
+    # The index is abandoned for repositories with more Persons than this,
+    # so that it can't use up the memory of the instance.
+    MAX_PERSONS = 200000
+
+    def __init__(self, repo):
+        self.repo = repo
+        self._record_ids = []  # local ID -> record_id
+        self._local_ids = {}  # record_id -> local ID
+        self._tokens = {}  # local ID -> frozenset of indexed tokens
+        self._postings = {}  # token -> sorted array of local IDs
+        self._last_modified = None  # the latest last_modified seen
+        # The query cursor and last_modified filter of a refresh that
+        # stopped before it caught up.
+        self._cursor = None
+        self._refresh_start = None
+        self.too_large = False  # set when the repository exceeds MAX_PERSONS
+
+    def _get_local_id(self, record_id):
+        local_id = self._local_ids.get(record_id)
+        if local_id is None:
+            local_id = len(self._record_ids)
+            self._record_ids.append(record_id)
+            self._local_ids[record_id] = local_id
+        return local_id
+
+    def update(self, record_id, tokens):
+        """Sets the tokens indexed for the given record_id.  An empty list of
+        tokens removes the record from the index."""
+        local_id = self._get_local_id(record_id)
+        old_tokens = self._tokens.get(local_id, frozenset())
+        new_tokens = frozenset(tokens)
+        for token in old_tokens - new_tokens:
+            posting = self._postings[token]
+            del posting[bisect.bisect_left(posting, local_id)]
+            if not posting:
+                del self._postings[token]
+        for token in new_tokens - old_tokens:
+            posting = self._postings.setdefault(token, array.array('l'))
+            if not posting or posting[-1] < local_id:
+                posting.append(local_id)
+            else:
+                posting.insert(bisect.bisect_left(posting, local_id), local_id)
+        if new_tokens:
+            self._tokens[local_id] = new_tokens
+        else:
+            self._tokens.pop(local_id, None)
+
+    def update_person(self, person):
+        """Indexes the names_prefixes of a Person, or removes the Person from
+        the index if it has expired."""
+        self.update(person.record_id,
+                    [] if person.is_expired else person.names_prefixes)
+
+    def remove(self, record_id):
+        """Removes a record from the index."""
+        if record_id in self._local_ids:
+            self.update(record_id, [])
+
+    def lookup(self, tokens):
+        """Returns the record_ids of the Persons indexed under all the given
+        tokens."""
+        postings = []
+        for token in set(tokens):
+            posting = self._postings.get(token)
+            if not posting:
+                return []
+            postings.append(posting)
+        if not postings:
+            return []
+        # Walk the shortest posting list and binary-search the others.
+        postings.sort(key=len)
+        record_ids = []
+        for local_id in postings[0]:
+            for posting in postings[1:]:
+                i = bisect.bisect_left(posting, local_id)
+                if i == len(posting) or posting[i] != local_id:
+                    break
+            else:
+                record_ids.append(self._record_ids[local_id])
+        return record_ids
+
+    def refresh(self, max_batches=None):
+        """Indexes the Persons in the repository that were modified since
+        the previous refresh (all of them, the first time), reading at most
+        max_batches batches.  Returns True if the index has caught up with
+        the datastore, or False if there are more Persons left to read, in
+        which case the next refresh continues where this one stopped."""
+        if self.too_large:
+            return False
+        if not self._cursor:
+            self._refresh_start = self._last_modified
+        query = model.Person.all(filter_expired=False).filter(
+            'repo =', self.repo)
+        if self._refresh_start:
+            # Use >= so that we don't miss Persons written in the same
+            # microsecond; indexing a Person twice is harmless.
+            query.filter('last_modified >=', self._refresh_start)
+        query.order('last_modified')
+        query.with_cursor(self._cursor)
+        num_batches = 0
+        while max_batches is None or num_batches < max_batches:
+            persons = query.fetch(NameIndex.REFRESH_BATCH_SIZE)
+            num_batches += 1
+            for person in persons:
+                self.update_person(person)
+                self._last_modified = person.last_modified
+            if len(self._record_ids) > NameIndex.MAX_PERSONS:
+                logging.warning('Too many Persons in %s for a NameIndex; '
+                                'searching the datastore instead' % self.repo)
+                self._record_ids, self._local_ids = [], {}
+                self._tokens, self._postings = {}, {}
+                self.too_large = True
+                return False
+            if len(persons) < NameIndex.REFRESH_BATCH_SIZE:
+                self._cursor = None
+                return True
+            query.with_cursor(query.cursor())  # Continue where fetch left off.
+        self._cursor = query.cursor()
+        return False
+
+
+# NameIndex objects for each repository, built on first use.
+_name_indexes = {}
+
+
+def get_name_index(repo):
+    """Gets the NameIndex for a repository, if it is brought up to date with
+    the datastore by a refresh of at most MAX_REFRESH_BATCHES_PER_SEARCH
+    batches.  Returns None while the index is still being built."""
+    index = _name_indexes.get(repo)
+    if index is None:
+        index = _name_indexes[repo] = NameIndex(repo)
+    if index.refresh(NameIndex.MAX_REFRESH_BATCHES_PER_SEARCH):
+        return index
+    return None
+
+
+def update_name_index(person):
+    """Updates the in-memory NameIndex for a Person's repository, if one has
+    been started on this instance."""
+    index = _name_indexes.get(person.repo)
+    if index is not None and not index.too_large:
+        index.update_person(person)
+
+
+def fetch_from_name_index(repo, query_words, fetch_limit):
+    """Fetches up to fetch_limit unexpired Persons whose names_prefixes
+    contain all of the query_words, using the in-memory NameIndex.  Returns
+    None if the index isn't ready, in which case the caller should query the
+    datastore instead."""
+    if not query_words:
+        return []
+    index = get_name_index(repo)
+    if index is None:
+        return None
+    record_ids = index.lookup(query_words)[:fetch_limit]
+    persons = model.Person.get_all(repo, record_ids, filter_expired=True)
+    # Drop records that have been deleted (or expired) since they were indexed.
+    found_ids = set(person.record_id for person in persons)
+    for record_id in record_ids:
+        if record_id not in found_ids:
+            index.remove(record_id)
+    return persons
+
+
+# A single CJK ideograph, and a run of one or more CJK ideographs.
+CJK_CHARACTER_RE = re.compile(ur'^[\u3400-\u9fff]$')
+CJK_WORD_RE = re.compile(ur'^[\u3400-\u9fff]+$')
+
+
+class Ranker(object):
+    """Computes sort keys for ranking Persons against a query.  The key for
+    each Person is computed once, in a single pass, so sorting n results
+    costs n key computations instead of O(n log n) comparisons that each
+    re-normalize both names."""
+
     def __init__(self, query):
         self.query = query
         self.query_words_set = set(query.words)
+        # The normalized query words, in the order as entered.
+        self.ordered_words = query.normalized.split()
 
-    def __call__(self, p1, p2):
-        if ((p1.primary_full_name and
-             p1.primary_full_name == p2.primary_full_name) or
-            ((p1.given_name or p1.family_name) and
-             p1.given_name == p2.given_name and
-             p1.family_name == p2.family_name)):
-            return 0
-        self.set_ranking_attr(p1)
-        self.set_ranking_attr(p2)
-        r1 = self.rank(p1)
-        r2 = self.rank(p2)
-
-        if r1 == r2:
-            # if rank is the same sort by name so same names will be together
-            return cmp(p1._normalized_full_name.normalized,
-                       p2._normalized_full_name.normalized)
-        else:
-            return cmp(r2, r1)
-
-
-    def set_ranking_attr(self, person):
-        """Consider save these into to db"""
-        if not hasattr(person, '_normalized_given_name'):
-            person._normalized_given_name = TextQuery(person.given_name)
-            person._normalized_family_name = TextQuery(person.family_name)
-            person._normalized_full_name = TextQuery(person.full_name)
-            person._name_words = set(person._normalized_full_name.words)
-            person._alt_name_words = set(
-                    TextQuery(person.alternate_names).words)
+    def get_sort_key(self, person):
+        """Returns a key that sorts Persons by descending rank, and then by
+        name so that the same names will be together."""
+        normalized_full_name = TextQuery(person.full_name)
+        return (-self.rank(person, normalized_full_name),
+                normalized_full_name.normalized)
 
     # TODO(ryok): re-consider the ranking putting more weight on full_name (a
     # required field) instead of given name and family name pair (optional).
-    def rank(self, person):
-        # The normalized query words, in the order as entered.
-        ordered_words = self.query.normalized.split()
+    def rank(self, person, normalized_full_name):
+        ordered_words = self.ordered_words
+        given_name = person.given_name or ''
+        family_name = person.family_name or ''
+        normalized_given_name = TextQuery(given_name)
+        normalized_family_name = TextQuery(family_name)
 
         if (ordered_words ==
-            person._normalized_given_name.words +
-            person._normalized_family_name.words):
+            normalized_given_name.words + normalized_family_name.words):
             # Matches a Latin name exactly (given name followed by surname).
             return 10
 
-        if (re.match(ur'^[\u3400-\u9fff]$', person.family_name) and
-            ordered_words in [
-                [person.family_name + person.given_name],
-                [person.family_name, person.given_name]
-            ]):
-            # Matches a CJK name exactly (surname followed by given name).
-            return 10
-
-        if (re.match(ur'^[\u3400-\u9fff]+$', person.family_name) and
-            ordered_words in [
-                [person.family_name + person.given_name],
-                [person.family_name, person.given_name]
-            ]):
+        if CJK_WORD_RE.match(family_name) and ordered_words in [
+            [family_name + given_name], [family_name, given_name]
+        ]:
+            if CJK_CHARACTER_RE.match(family_name):
+                # Matches a CJK name exactly (surname followed by given name).
+                return 10
             # Matches a CJK name exactly (surname followed by given name).
             # A multi-character surname is uncommon, so it is ranked a bit lower.
             return 9.5
 
         if (ordered_words ==
-            person._normalized_family_name.words +
-            person._normalized_given_name.words):
+            normalized_family_name.words + normalized_given_name.words):
             # Matches a Latin name with given and family name switched.
             return 9
 
-        if (re.match(ur'^[\u3400-\u9fff]$', person.given_name) and
-            ordered_words in [
-                    [person.given_name + person.family_name],
-                    [person.given_name, person.family_name]
-            ]):
-            # Matches a CJK name with surname and given name switched.
-            return 9
-
-        if (re.match(ur'^[\u3400-\u9fff]+$', person.given_name) and
-            ordered_words in [
-                    [person.given_name + person.family_name],
-                    [person.given_name, person.family_name]
-            ]):
+        if CJK_WORD_RE.match(given_name) and ordered_words in [
+            [given_name + family_name], [given_name, family_name]
+        ]:
+            if CJK_CHARACTER_RE.match(given_name):
+                # Matches a CJK name with surname and given name switched.
+                return 9
             # Matches a CJK name with surname and given name switched.
             # A multi-character surname is uncommon, so it's ranked a bit lower.
             return 8.5
 
-        if person._name_words == self.query_words_set:
+        name_words = set(normalized_full_name.words)
+        if name_words == self.query_words_set:
             # Matches all the words in the given and family name, out of order.
             return 8
 
         if self.query.normalized in [
-            person._normalized_given_name.normalized,
-            person._normalized_family_name.normalized,
+            normalized_given_name.normalized,
+            normalized_family_name.normalized,
         ]:
             # Matches the given name exactly or the family name exactly.
             return 7
 
-        if person._name_words.issuperset(self.query_words_set):
+        if name_words.issuperset(self.query_words_set):
             # All words in the query appear somewhere in the name.
             return 6
 
         # Count the number of words in the query that appear in the name and
         # also in the alternate names.
-        matched_words = person._name_words.union(
-            person._alt_name_words).intersection(self.query_words_set)
+        alt_name_words = set(TextQuery(person.alternate_names).words)
+        matched_words = name_words.union(
+            alt_name_words).intersection(self.query_words_set)
         return min(5, 1 + len(matched_words))
 
 
+def get_same_name_keys(person):
+    """Returns the keys under which Persons are considered to have the same
+    name: the same primary full name, or the same given and family names."""
+    keys = []
+    if person.primary_full_name:
+        keys.append(('full_name', person.primary_full_name))
+    if person.given_name or person.family_name:
+        keys.append(('given_family', person.given_name, person.family_name))
+    return keys
+
+
 def rank_and_order(results, query, max_results):
-    results.sort(CmpResults(query))
+    # The old comparator ranked Persons with the same name as equal, leaving
+    # them in their original order.  To keep that, each Person gets the sort
+    # key of the first Person with the same name, followed by its original
+    # position, so they stay together in the order they came in.
+    ranker = Ranker(query)
+    sort_keys_by_name = {}
+    keyed_results = []
+    for index, person in enumerate(results):
+        names = get_same_name_keys(person)
+        for name in names:
+            if name in sort_keys_by_name:
+                sort_key = sort_keys_by_name[name]
+                break
+        else:
+            sort_key = ranker.get_sort_key(person)
+        for name in names:
+            sort_keys_by_name.setdefault(name, sort_key)
+        keyed_results.append((sort_key, index, person))
+    keyed_results.sort()
+    results[:] = [person for sort_key, index, person in keyed_results]
     return results[:max_results]
 
 
@@ -217,11 +414,20 @@ def search(repo, query_obj, max_results):
     query_words = sort_query_words(query_obj.query_words)
     logging.debug('query_words: %r' % query_words)
 
+    fetch_limit = 400
+    fetched = None
+    if config.get('enable_name_index'):
+        # The in-memory index matches all the query words at once, so there
+        # is no need to back off or over-fetch.  Until the index has been
+        # built, the datastore is queried instead.
+        fetched = fetch_from_name_index(repo, query_words, fetch_limit)
+    if fetched is None:
+        fetched = []
+        filters_to_try = len(query_words)
+    else:
+        filters_to_try = 0
     # First try the query with all the filters, and then keep backing off
     # if we get NeedIndexError.
-    fetch_limit = 400
-    fetched = []
-    filters_to_try = len(query_words)
     while filters_to_try:
         query = model.Person.all_in_repo(repo)
         for word in query_words[:filters_to_try]:
@@ -81,6 +81,7 @@ HANDLER_CLASSES['admin/api_keys/list'] = 'admin_api_keys.ListApiKeys'
 HANDLER_CLASSES['api/import'] = 'api.Import'
 HANDLER_CLASSES['api/import/notes'] = 'api.Import'
 HANDLER_CLASSES['api/import/persons'] = 'api.Import'
+HANDLER_CLASSES['api/import/status'] = 'api.ImportStatus'
 HANDLER_CLASSES['api/read'] = 'api.Read'
 HANDLER_CLASSES['api/write'] = 'api.Write'
 HANDLER_CLASSES['api/search'] = 'api.Search'
@@ -91,7 +92,6 @@ HANDLER_CLASSES['api/handle_sms'] = 'api.HandleSMS'
 HANDLER_CLASSES['api/photo_upload'] = 'api.PhotoUpload'
 HANDLER_CLASSES['feeds/note'] = 'feeds.Note'
 HANDLER_CLASSES['feeds/person'] = 'feeds.Person'
-HANDLER_CLASSES['tasks/count/note'] = 'tasks.CountNote'
 HANDLER_CLASSES['tasks/count/person'] = 'tasks.CountPerson'
 HANDLER_CLASSES['tasks/count/reindex'] = 'tasks.Reindex'
 HANDLER_CLASSES['tasks/count/update_dead_status'] = 'tasks.UpdateDeadStatus'
@@ -99,6 +99,7 @@ HANDLER_CLASSES['tasks/count/update_status'] = 'tasks.UpdateStatus'
 HANDLER_CLASSES['tasks/delete_expired'] = 'tasks.DeleteExpired'
 HANDLER_CLASSES['tasks/delete_old'] = 'tasks.DeleteOld'
 HANDLER_CLASSES['tasks/dump_csv'] = 'tasks.DumpCSV'
+HANDLER_CLASSES['tasks/process_import'] = 'tasks.ProcessImport'
 HANDLER_CLASSES['tasks/clean_up_in_test_mode'] = 'tasks.CleanUpInTestMode'
 HANDLER_CLASSES['tasks/notify_many_unreviewed_notes'] = 'tasks.NotifyManyUnreviewedNotes'
 HANDLER_CLASSES['tasks/thumbnail_preparer'] = 'tasks.ThumbnailPreparer'
@@ -183,14 +184,11 @@ def select_lang_from_header(request, default_lang):
 def get_repo_options(request, lang):
     """Returns a list of the names and titles of the launched repositories."""
     options = []
-    for repo in model.Repo.list_launched():
-        titles = config.get_for_repo(repo, 'repo_titles', {})
-        default_title = (titles.values() or ['?'])[0]
-        title = titles.get(lang, titles.get('en', default_title))
-        url = utils.get_repo_url(request, repo)
-        test_mode = config.get_for_repo(repo, 'test_mode')
-        options.append(utils.Struct(repo=repo, title=title, url=url,
-                                    test_mode=test_mode))
+    for info in model.repo_directory.list_launched():
+        url = utils.get_repo_url(request, info.repo)
+        options.append(utils.Struct(repo=info.repo,
+                                    title=info.get_title(lang), url=url,
+                                    test_mode=info.test_mode))
     return options
 
 def get_language_options(request, config, current_lang):
@@ -17,6 +17,8 @@
 __author__ = 'kpy@google.com (Ka-Ping Yee) and many other Googlers'
 
 from datetime import timedelta
+import random
+import threading
 
 from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
@@ -79,6 +81,71 @@ def clone_to_new_type(origin, dest_class, **kwargs):
         vals.update(record_id=origin.record_id)
     return dest_class(key_name=origin.key().name(), **vals)
 
+class WriteBatch(object):
+    """Collects the puts, deletes, full-text index deletions, and count
+    changes made while processing many records, so that they can be stored
+    with a few batch calls.  The Person methods that take a 'batch' argument
+    add their changes to it instead of storing them; call commit() to store
+    everything.  A later put or delete of the same key replaces an earlier
+    one."""
+
+    # Maximum number of entities to put or delete in one datastore call.
+    MAX_ENTITIES_PER_CALL = 500
+
+    def __init__(self):
+        self._index_writer = None
+        self._puts = {}  # entities to put, keyed by key
+        self._deletes = set()  # keys to delete
+        self._count_changes = {}  # repo -> (added records, removed records)
+
+    @property
+    def index_writer(self):
+        """A full_text_search.BatchIndexWriter flushed by commit()."""
+        if not self._index_writer:
+            self._index_writer = full_text_search.BatchIndexWriter()
+        return self._index_writer
+
+    def put(self, entities):
+        for entity in entities:
+            self._puts[entity.key()] = entity
+            self._deletes.discard(entity.key())
+
+    def delete(self, entities_or_keys):
+        for entity_or_key in entities_or_keys:
+            if isinstance(entity_or_key, db.Key):
+                key = entity_or_key
+            else:
+                key = entity_or_key.key()
+            self._deletes.add(key)
+            self._puts.pop(key, None)
+
+    def add_count_deltas(self, repo, added=(), removed=()):
+        """Collects the arguments for add_count_deltas."""
+        added_records, removed_records = self._count_changes.setdefault(
+            repo, ([], []))
+        added_records.extend(added)
+        removed_records.extend(removed)
+
+    def commit(self):
+        """Stores all the collected changes and empties the batch."""
+        entities = self._puts.values()
+        keys = list(self._deletes)
+        limit = self.MAX_ENTITIES_PER_CALL
+        rpcs = [db.put_async(entities[i:i + limit])
+                for i in xrange(0, len(entities), limit)]
+        rpcs += [db.delete_async(keys[i:i + limit])
+                 for i in xrange(0, len(keys), limit)]
+        for rpc in rpcs:
+            rpc.get_result()
+        if self._index_writer:
+            self._index_writer.flush()
+        for repo, (added, removed) in self._count_changes.items():
+            add_count_deltas(repo, added=added, removed=removed)
+        self._puts = {}
+        self._deletes = set()
+        self._count_changes = {}
+
+
 # ==== Model classes =======================================================
 
 # Every Person or Note entity belongs to a specific repository.  To partition
@@ -136,30 +203,111 @@ class Repo(db.Model):
     def get(repo_id):
         return Repo.get_by_key_name(repo_id)
 
+    def put(self, *args, **kwargs):
+        result = super(Repo, self).put(*args, **kwargs)
+        repo_directory.invalidate()
+        return result
+
+    def delete(self, *args, **kwargs):
+        result = super(Repo, self).delete(*args, **kwargs)
+        repo_directory.invalidate()
+        return result
+
     @classmethod
     def list(cls):
         """Returns a list of all repository names."""
-        return [repo.key().name() for repo in cls.all()]
+        return [info.repo for info in repo_directory.get_repos()]
 
     @classmethod
     def list_active(cls):
         """Returns a list of the active (non-deactivated) repository names."""
-        staging = [repo.key().name() for repo in Repo.all().filter(
-            'activation_status =', Repo.ActivationStatus.STAGING)]
-        active = [repo.key().name() for repo in Repo.all().filter(
-            'activation_status =', Repo.ActivationStatus.ACTIVE)]
+        repos = repo_directory.get_repos()
+        staging = [info.repo for info in repos if info.activation_status ==
+                   Repo.ActivationStatus.STAGING]
+        active = [info.repo for info in repos if info.activation_status ==
+                  Repo.ActivationStatus.ACTIVE]
         return staging + active
 
     @classmethod
     def list_launched(cls):
         """Returns a list of the launched (listed in menu) repository names."""
-        return [repo.key().name() for repo in Repo.all().filter(
-            'activation_status =', Repo.ActivationStatus.ACTIVE)]
+        return [info.repo for info in repo_directory.list_launched()]
 
     def is_deactivated(self):
         return self.activation_status == Repo.ActivationStatus.DEACTIVATED
 
 
+class RepoInfo(object):
+    """A summary of a repository, as kept in the repository directory."""
+
+    def __init__(self, repo, activation_status, titles, test_mode):
+        self.repo = repo
+        self.activation_status = activation_status
+        # The repo_titles config, a dictionary keyed by language code.
+        self.titles = titles
+        # The test_mode config (not the Repo.test_mode property).
+        self.test_mode = test_mode
+
+    def get_title(self, lang):
+        """Returns the title of the repository in the given language, falling
+        back to English and then to any title."""
+        default_title = (self.titles.values() or ['?'])[0]
+        return self.titles.get(lang, self.titles.get('en', default_title))
+
+
+class RepoDirectory(object):
+    """A process-wide cache of the RepoInfo of all the repositories, used to
+    list repositories without querying Repo and ConfigEntry entities on every
+    request. It shares its version with the config cache (see
+    config.ConfigurationCache), so it is refreshed on every instance whenever
+    a Repo entity is written or the config changes, and it also expires after
+    expiry_time seconds."""
+    expiry_time = 600
+
+    def __init__(self):
+        self.repos = None
+        self.version = None
+        self.expiry = None
+
+    def invalidate(self):
+        """Drops the directory on every instance."""
+        self.repos = None
+        config.cache.flush()
+
+    def get_repos(self):
+        """Returns a list of RepoInfo for all repositories, ordered by
+        repository name."""
+        import utils
+        version = config.cache.get_version()
+        now = utils.get_utcnow()
+        # If memcache is unavailable (version is None), the directory is
+        # only reloaded when it expires.
+        if (self.repos is None or version != self.version or
+            now >= self.expiry):
+            self.repos = self.load()
+            self.version = version
+            self.expiry = now + timedelta(seconds=self.expiry_time)
+        return self.repos
+
+    def list_launched(self):
+        """Returns a list of RepoInfo for the launched (listed in menu)
+        repositories."""
+        return [info for info in self.get_repos()
+                if info.activation_status == Repo.ActivationStatus.ACTIVE]
+
+    def load(self):
+        repos = []
+        for repo in Repo.all():
+            repo_id = repo.key().name()
+            repos.append(RepoInfo(
+                repo_id, repo.activation_status,
+                config.get_for_repo(repo_id, 'repo_titles', {}),
+                config.get_for_repo(repo_id, 'test_mode')))
+        return repos
+
+repo_directory = RepoDirectory()
+
+
 class Base(db.Model):
     """Base class providing methods common to both Person and Note entities,
     whose key names are partitioned using the repo name as a prefix."""
@@ -167,6 +315,9 @@ class Base(db.Model):
     # max records to fetch in one go.
     FETCH_LIMIT = 200
 
+    # max queries to run in parallel.
+    MAX_PARALLEL_QUERIES = 20
+
     # Even though the repo is part of the key_name, it is also stored
     # redundantly as a separate property so it can be indexed and queried upon.
     repo = db.StringProperty(required=True)
@@ -231,10 +382,20 @@ class Base(db.Model):
         return db.Key.from_path(cls.kind(), repo + ':' + record_id)
 
     @classmethod
-    def get_all(cls, repo, record_ids, limit=200):
-        """Gets the entities with the given record_ids in a given repository."""
+    def get_all(cls, repo, record_ids, limit=200, filter_expired=False):
+        """Gets the entities with the given record_ids in a given repository,
+        in the same order as record_ids.  Missing entities are omitted, and so
+        are expired ones if filter_expired is True.  The keys are fetched in
+        batches of at most 'limit' keys, and all the batches are issued in
+        parallel."""
         keys = [cls.get_key(repo, id) for id in record_ids]
-        return [record for record in db.get(keys) if record is not None]
+        rpcs = [db.get_async(keys[i:i + limit])
+                for i in xrange(0, len(keys), limit)]
+        records = []
+        for rpc in rpcs:
+            records.extend(rpc.get_result())
+        return [record for record in records if record is not None and
+                not (filter_expired and record.is_expired)]
 
     @classmethod
     def get(cls, repo, record_id, filter_expired=True):
@@ -245,12 +406,19 @@ class Base(db.Model):
                 return record
 
     @classmethod
-    def create_original(cls, repo, **kwargs):
-        """Creates a new original entity with the given field values."""
+    def create_original(cls, repo, unique_id=None, **kwargs):
+        """Creates a new original entity with the given field values.  The
+        record ID is made from unique_id, or from UniqueId.create_id if it's
+        not given.  Imports pass in IDs from importer.ImportContext.create_id,
+        which hands out any IDs that an import job reserved for a batch with
+        UniqueId.create_ids (so that a retried batch reuses the same IDs)
+        before new ones from UniqueId.create_id."""
+        if unique_id is None:
+            unique_id = UniqueId.create_id()
         # TODO(ryok): Consider switching to URL-like record id format,
         # which is more consitent with repo id format.
         record_id = '%s.%s/%s.%d' % (
-            repo, HOME_DOMAIN, cls.__name__.lower(), UniqueId.create_id())
+            repo, HOME_DOMAIN, cls.__name__.lower(), unique_id)
         return cls(key_name=repo + ':' + record_id, repo=repo, **kwargs)
 
     @classmethod
@@ -508,10 +676,12 @@ class Person(Base):
             start_date = self.original_creation_date or utils.get_utcnow()
             return start_date + timedelta(expiration_days)
 
-    def put_expiry_flags(self):
+    def put_expiry_flags(self, notes=None, batch=None):
         """Updates the is_expired flags on this Person and related Notes to
         make them consistent with the effective_expiry_date() on this Person,
-        and commits the changes to the datastore."""
+        and commits the changes to the datastore.  To process many Persons,
+        pass in all the Notes on this Person (including expired ones) and a
+        WriteBatch, which then holds the changes instead of the datastore."""
         import utils
         now = utils.get_utcnow()
         expired = self.get_effective_expiry_date() <= now
@@ -533,25 +703,39 @@ class Person(Base):
             self.entry_date = now
 
             # All the Notes on the Person also expire or unexpire, to match.
-            notes = self.get_notes(filter_expired=False)
+            if notes is None:
+                notes = self.get_notes(filter_expired=False)
+            changed_records = [self] + [
+                note for note in notes if note.is_expired != expired]
             for note in notes:
                 note.is_expired = expired
 
             # Store these changes in the datastore.
-            db.put(notes + [self])
+            write_batch = batch or WriteBatch()
+            write_batch.put(notes + [self])
+            # Expired records aren't counted.
+            if expired:
+                write_batch.add_count_deltas(
+                    self.repo, removed=changed_records)
+            else:
+                write_batch.add_count_deltas(self.repo, added=changed_records)
+            if not batch:
+                write_batch.commit()
             # TODO(lschumacher): photos don't have expiration currently.
 
-    def wipe_contents(self):
+    def wipe_contents(self, notes=None, batch=None):
         """Sets all the content fields to None (leaving timestamps and the
         expiry flag untouched), stores the empty record, and permanently
         deletes any related Notes and Photos.  Call this method ONLY on records
-        that have already expired."""
+        that have already expired.  The notes and batch arguments are as for
+        put_expiry_flags."""
         # We rely on put_expiry_flags to have properly set the source_date,
         # entry_date, and is_expired flags on Notes, as necessary.
         assert self.is_expired
 
+        write_batch = batch or WriteBatch()
         # Permanently delete all related Photos and Notes, but not self.
-        self.delete_related_entities()
+        self.delete_related_entities(notes=notes, batch=write_batch)
 
         was_changed = False
         # TODO(nworden): consider adding a is_tombstone property or something
@@ -573,24 +757,46 @@ class Person(Base):
                     setattr(self, name, property.default)
                     was_changed = True
         if was_changed:
-            self.put()  # Store the empty placeholder record.
+            write_batch.put([self])  # Store the empty placeholder record.
+        if not batch:
+            write_batch.commit()
 
-    def delete_related_entities(self, delete_self=False):
+    def delete_related_entities(self, delete_self=False, index_writer=None,
+                                notes=None, batch=None):
         """Permanently delete all related Photos and Notes, and also self if
-        delete_self is True."""
+        delete_self is True.  If an index_writer (a
+        full_text_search.BatchIndexWriter) is given, self is removed from the
+        full-text index through it instead of with a separate index call.
+        The notes and batch arguments are as for put_expiry_flags."""
         # Delete all related Notes.
-        notes = self.get_notes(filter_expired=False)
+        if notes is None:
+            notes = self.get_notes(filter_expired=False)
         # Delete the locally stored Photos.  We use get_value_for_datastore to
         # get just the keys and prevent auto-fetching the Photo data.
         photo = Person.photo.get_value_for_datastore(self)
         note_photos = [Note.photo.get_value_for_datastore(n) for n in notes]
 
         entities_to_delete = filter(None, notes + [photo] + note_photos)
+        # The unexpired records being deleted were counted; expired ones
+        # weren't.
+        counted_records = [note for note in notes if not note.is_expired]
         if delete_self:
             entities_to_delete.append(self)
+            if not self.is_expired:
+                counted_records.append(self)
             if config.get('enable_fulltext_search'):
-                full_text_search.delete_record_from_index(self)
-        db.delete(entities_to_delete)
+                if index_writer:
+                    index_writer.delete(self)
+                elif batch:
+                    batch.index_writer.delete(self)
+                else:
+                    full_text_search.delete_record_from_index(self)
+        if batch:
+            batch.delete(entities_to_delete)
+            batch.add_count_deltas(self.repo, removed=counted_records)
+        else:
+            db.delete(entities_to_delete)
+            add_count_deltas(self.repo, removed=counted_records)
 
     def update_from_note(self, note):
         """Updates any necessary fields on the Person to reflect a new Note."""
@@ -608,12 +814,20 @@ class Person(Base):
                 self.latest_status = note.status
                 self.latest_status_source_date = note.source_date
 
-    def update_index(self, which_indexing):
+    def update_index(self, which_indexing, index_writer=None):
+        """Updates the search index properties of this Person.  If an
+        index_writer (a full_text_search.BatchIndexWriter) is given, the
+        full-text index document is written through it, so the caller must
+        flush it."""
         #setup new indexing
         if 'new' in which_indexing:
             indexing.update_index_properties(self)
+            indexing.update_name_index(self)
             if config.get('enable_fulltext_search'):
-                full_text_search.add_record_to_index(self)
+                if index_writer:
+                    index_writer.add(self)
+                else:
+                    full_text_search.add_record_to_index(self)
         # setup old indexing
         if 'old' in which_indexing:
             prefix.update_prefix_properties(self)
@@ -639,6 +853,7 @@ class Person(Base):
         We should never call this method against an existing record."""
         db.put(self)
         UsageCounter.increment_counter(self.repo, ['person'])
+        add_count_deltas(self.repo, added=[self])
         UserActionLog.put_new('add', self, copy_properties=False)
 
 # Old indexing
@@ -721,6 +936,28 @@ class Note(Base):
             query.with_cursor(query.cursor())  # Continue where fetch left off.
             notes = query.fetch(Note.FETCH_LIMIT)
 
+    @staticmethod
+    def get_by_person_record_ids(
+        repo, person_record_ids, filter_expired=True):
+        """Gets all the Notes on several Person records, returning a
+        dictionary of lists of Notes ordered by source_date, keyed by
+        person_record_id.  The queries for the Persons run in parallel,
+        MAX_PARALLEL_QUERIES at a time."""
+        person_record_ids = list(person_record_ids)
+        notes_by_person_record_id = {}
+        for start in xrange(
+            0, len(person_record_ids), Note.MAX_PARALLEL_QUERIES):
+            runs = [(person_record_id,
+                     Note.all_in_repo(repo, filter_expired=filter_expired
+                         ).filter('person_record_id =', person_record_id
+                         ).order('source_date'
+                         ).run(batch_size=Note.FETCH_LIMIT))
+                    for person_record_id in person_record_ids[
+                        start:start + Note.MAX_PARALLEL_QUERIES]]
+            for person_record_id, notes in runs:
+                notes_by_person_record_id[person_record_id] = list(notes)
+        return notes_by_person_record_id
+
     @staticmethod
     def get_unreviewed_notes_count(repo, filter_expired=True):
         """Gets the number of unreviewed notes."""
@@ -736,6 +973,7 @@ class Note(Base):
         UserActionLog.put_new('add', self, copy_properties=False)
         note_status = self.status if self.status else 'unspecified'
         UsageCounter.increment_counter(self.repo, ['note', note_status])
+        add_count_deltas(self.repo, added=[self])
 
 class NoteWithBadWords(Note):
     # Spam score given by SpamDetector
@@ -769,6 +1007,104 @@ class Photo(db.Model):
         return Photo.get_by_key_name('%s:%s' % (repo, id))
 
 
+class ImportJob(db.Model):
+    """A CSV file uploaded to api/import, to be imported in the background by
+    tasks.ProcessImport.  The file is stored in ImportJobChunk children, and
+    the job keeps track of how far into the file the import has got, so that
+    a task that runs out of time can be resumed from there.
+    Key name: repo + ':' + job_id."""
+
+    class Status(object):
+        """An enum for the state of the import."""
+        PENDING = 'pending'
+        DONE = 'done'
+        FAILED = 'failed'
+
+    # Size of each ImportJobChunk, below the 1 MB limit on entity size.
+    CHUNK_SIZE = 512 * 1024
+    # Number of ImportJobChunks written per db.put, to stay well below the
+    # limit on the size of a datastore request.
+    CHUNKS_PER_PUT = 8
+    # Number of skipped records for which the reason is kept.
+    MAX_SKIPPED_MESSAGES = 100
+
+    repo = db.StringProperty(required=True)
+    # 'persons' or 'notes', as in the format parameter of api/import.
+    format = db.StringProperty(required=True)
+    # Permissions of the authorization key used to upload the file.
+    source_domain = db.StringProperty(required=True)
+    believed_dead_permission = db.BooleanProperty(default=False)
+
+    status = db.StringProperty(default=Status.PENDING)
+    error = db.TextProperty(default='')
+    # Total size of the file in bytes.
+    size = db.IntegerProperty(default=0)
+    # End of the preamble and header rows, which are read again on resume.
+    header_end = db.IntegerProperty(default=0)
+    # Offset in bytes up to which the records have been imported.
+    offset = db.IntegerProperty(default=0)
+    # Whether the job is reading a persons file again for its Notes, after
+    # importing all of its Persons.
+    notes_pass = db.BooleanProperty(default=False)
+    # IDs reserved for the records without record IDs in the batch that
+    # starts at offset, so that importing the batch again reuses them.
+    batch_ids = db.ListProperty(int, indexed=False)
+    persons_written = db.IntegerProperty(default=0)
+    notes_written = db.IntegerProperty(default=0)
+    skipped = db.IntegerProperty(default=0)
+    total = db.IntegerProperty(default=0)
+    skipped_messages = db.StringListProperty(indexed=False)
+    created = db.DateTimeProperty(auto_now_add=True)
+    updated = db.DateTimeProperty(auto_now=True)
+
+    @staticmethod
+    def create(repo, content, **kwargs):
+        """Stores the content of an uploaded file in chunks, and returns a new
+        ImportJob entity for it.  The chunks are written CHUNKS_PER_PUT at a
+        time, and the job itself last, so that a job is never found without
+        all of its content."""
+        id = UniqueId.create_id()
+        job = ImportJob(key_name='%s:%s' % (repo, id), repo=repo,
+                        size=len(content), **kwargs)
+        chunks = [ImportJobChunk(parent=job, id=index + 1,
+                                 content=content[start:start + job.CHUNK_SIZE])
+                  for index, start in enumerate(
+                      xrange(0, len(content), job.CHUNK_SIZE))]
+        for start in xrange(0, len(chunks), job.CHUNKS_PER_PUT):
+            db.put(chunks[start:start + job.CHUNKS_PER_PUT])
+        job.put()
+        return job
+
+    @staticmethod
+    def get(repo, id):
+        return ImportJob.get_by_key_name('%s:%s' % (repo, id))
+
+    @property
+    def job_id(self):
+        return self.key().name().split(':', 1)[1]
+
+    def generate_content(self, start, end=None):
+        """Generates the content of the file from offset start up to offset
+        end (or the end of the file), one chunk at a time."""
+        end = self.size if end is None else min(end, self.size)
+        while start < end:
+            index = start // self.CHUNK_SIZE
+            chunk = ImportJobChunk.get_by_id(index + 1, parent=self)
+            chunk_start = index * self.CHUNK_SIZE
+            content = chunk.content[start - chunk_start:end - chunk_start]
+            yield content
+            start += len(content)
+
+    def delete_content(self):
+        db.delete(ImportJobChunk.all(keys_only=True).ancestor(self))
+
+
+class ImportJobChunk(db.Model):
+    """A part of the file of an ImportJob, which is its parent.
+    Key id: 1-based index of the chunk."""
+    content = db.BlobProperty()
+
+
 class Authorization(db.Model):
     """Authorization keys.  Key name: repo + ':' + auth_key."""
 
@@ -982,6 +1318,17 @@ class Counter(db.Expando):
         prop_name = 'count_' + encode_count_name(count_name)
         setattr(self, prop_name, getattr(self, prop_name, 0) + 1)
 
+    def has(self, count_name):
+        """Returns True if this Counter has the given accumulator."""
+        return hasattr(self, 'count_' + encode_count_name(count_name))
+
+    def initialize(self, count_names):
+        """Sets the given accumulators to 0 if they don't exist yet, so that
+        a scan takes these counts even if no entity counts towards them."""
+        for count_name in count_names:
+            prop_name = 'count_' + encode_count_name(count_name)
+            setattr(self, prop_name, getattr(self, prop_name, 0))
+
     @classmethod
     def get_count(cls, repo, name):
         """Gets the latest finished count for the given repository and name.
@@ -993,35 +1340,52 @@ class Counter(db.Expando):
     @classmethod
     def get_all_counts(cls, repo, scan_name):
         """Gets a dictionary of all the counts for the last completed scan
-        for the given repository and scan name."""
+        for the given repository and scan name, adjusted by the CountDeltas
+        recorded since that scan finished."""
         counter_key = repo + ':' + scan_name
 
         # Get the counts from memcache, loading from datastore if necessary.
         counter_dict = memcache.get(counter_key)
         if not counter_dict:
-            try:
-                # Get the latest completed counter with this scan_name.
-                counter = cls.all().filter('repo =', repo
-                                  ).filter('scan_name =', scan_name
-                                  ).filter('last_key =', ''
-                                  ).order('-timestamp').get()
-            except datastore_errors.NeedIndexError:
-                # Absurdly, it can take App Engine up to an hour to build an
-                # index for a kind that has zero entities, and during that time
-                # all queries fail.  Catch this error so we don't get screwed.
-                counter = None
-
+            counter = cls.get_latest_finished(repo, scan_name)
             counter_dict = {}
+            delta_base = {}
             if counter:
-                # Cache the counter's contents in memcache for one minute.
                 counter_dict = dict((name[6:], getattr(counter, name))
                                     for name in counter.dynamic_properties()
                                     if name.startswith('count_'))
-                memcache.set(counter_key, counter_dict, 60)
+                delta_base = counter.get_delta_base()
+            for name, delta in CountDelta.get_totals(repo, scan_name).items():
+                counter_dict[name] = (counter_dict.get(name, 0) + delta -
+                                      delta_base.get(name, 0))
+            # Cache the counter's contents in memcache for one minute.
+            memcache.set(counter_key, counter_dict, 60)
 
         # Return the dictionary of counts for this scan.
         return counter_dict
 
+    @classmethod
+    def get_latest_finished(cls, repo, scan_name):
+        """Gets the latest finished Counter for the given repository and scan
+        name, or None if there is none."""
+        try:
+            return cls.all().filter('repo =', repo
+                           ).filter('scan_name =', scan_name
+                           ).filter('last_key =', ''
+                           ).order('-timestamp').get()
+        except datastore_errors.NeedIndexError:
+            # Absurdly, it can take App Engine up to an hour to build an
+            # index for a kind that has zero entities, and during that time
+            # all queries fail.  Catch this error so we don't get screwed.
+            return None
+
+    def get_delta_base(self):
+        """Gets a dictionary of the CountDelta totals at the time this scan
+        finished, keyed by encoded count_name."""
+        return dict((name[6:], getattr(self, name))
+                    for name in self.dynamic_properties()
+                    if name.startswith('delta_'))
+
     @classmethod
     def all_finished_counters(cls, repo, scan_name):
         """Gets a query for all finished counters for the specified scan."""
@@ -1029,6 +1393,24 @@ class Counter(db.Expando):
                        ).filter('scan_name =', scan_name
                        ).filter('last_key =', '')
 
+    @classmethod
+    def create(cls, repo, scan_name):
+        """Creates a Counter for a new scan."""
+        return Counter(repo=repo, scan_name=scan_name)
+
+    def finish(self):
+        """Marks the scan as finished, saving the current CountDelta totals
+        on the Counter.  Only the deltas recorded from then on are added to
+        the scan's counts.  Records written while the scan was running are
+        counted by the scan if their keys were still ahead of it, but not if
+        the scan had already passed them, so the counts can fall short by
+        those records until the next scan; this is preferred to counting the
+        records ahead of the scan twice."""
+        self.last_key = ''
+        for name, delta in CountDelta.get_totals(
+            self.repo, self.scan_name).items():
+            setattr(self, 'delta_' + name, delta)
+
     @classmethod
     def get_unfinished_or_create(cls, repo, scan_name):
         """Gets the latest unfinished Counter entity for the given repository
@@ -1037,10 +1419,161 @@ class Counter(db.Expando):
                           ).filter('scan_name =', scan_name
                           ).order('-timestamp').get()
         if not counter or not counter.last_key:
-            counter = Counter(repo=repo, scan_name=scan_name)
+            counter = cls.create(repo, scan_name)
         return counter
 
 
+def get_person_count_names(person):
+    """Gets the names of the 'person' scan accumulators that a Person counts
+    towards and that don't change after the Person is created."""
+    count_names = [
+        'all',
+        'original_domain=' + (person.original_domain or ''),
+        'sex=' + (person.sex or ''),
+        'home_country=' + (person.home_country or ''),
+        'photo=' + (person.photo_url and 'present' or ''),
+    ]
+    if person.author_email:  # author e-mail address present?
+        count_names.append('author_email')
+    if person.author_phone:  # author phone number present?
+        count_names.append('author_phone')
+    return count_names
+
+
+def get_note_count_names(note):
+    """Gets the names of the 'note' scan accumulators that a Note counts
+    towards."""
+    author_made_contact = ''
+    if note.author_made_contact is not None:
+        author_made_contact = note.author_made_contact and 'TRUE' or 'FALSE'
+
+    count_names = [
+        'all',
+        'status=' + (note.status or ''),
+        'original_domain=' + (note.original_domain or ''),
+        'author_made_contact=' + author_made_contact,
+    ]
+    if note.last_known_location:  # last known location specified?
+        count_names.append('last_known_location')
+    if note.author_email:  # author e-mail address present?
+        count_names.append('author_email')
+    if note.author_phone:  # author phone number present?
+        count_names.append('author_phone')
+    if note.linked_person_record_id:  # linked to another person?
+        count_names.append('linked_person')
+    count_names.append(get_review_count_name(note))
+    return count_names
+
+
+# The 'note' scan accumulators for the review states of Notes.
+REVIEW_COUNT_NAMES = [
+    'hidden=FALSE,reviewed=FALSE', 'hidden=FALSE,reviewed=TRUE', 'hidden=TRUE']
+
+def get_review_count_name(note):
+    """Gets the name of the 'note' scan accumulator for the review state of
+    a Note: unreviewed, accepted, or flagged."""
+    if note.hidden:
+        return 'hidden=TRUE'
+    return 'hidden=FALSE,reviewed=' + (note.reviewed and 'TRUE' or 'FALSE')
+
+
+class CountDelta(db.Expando):
+    """Changes to the counts of a scan (see Counter) made as records are
+    written, so that the counts stay current between the full scans.  The
+    write paths record the changes to the accumulators that follow from the
+    records alone (see get_person_count_names and get_note_count_names);
+    the full scans correct any drift.  The totals are never reset; instead,
+    each Counter saves the totals when its scan finishes, and
+    Counter.get_all_counts adds only what has changed since then.
+
+    Like UsageCounter, the deltas for a scan are spread across NUM_SHARDS
+    entities to avoid contention."""
+
+    # Number of shard entities per repository and scan.
+    NUM_SHARDS = 20
+
+    repo = db.StringProperty(required=True)
+    scan_name = db.StringProperty(required=True)
+
+    # Each CountDelta has a dynamic property for each accumulator, named
+    # like those on Counter.
+
+    @staticmethod
+    def get_key_name(repo, scan_name, shard):
+        return '%s:%s:%d' % (repo, scan_name, shard)
+
+    @classmethod
+    def get_totals(cls, repo, scan_name):
+        """Gets a dictionary of the deltas for a scan, summed over all the
+        shards and keyed by encoded count_name."""
+        key_names = [cls.get_key_name(repo, scan_name, shard)
+                     for shard in range(cls.NUM_SHARDS)]
+        totals = {}
+        for delta in filter(None, cls.get_by_key_name(key_names)):
+            for name in delta.dynamic_properties():
+                if name.startswith('count_'):
+                    totals[name[6:]] = (
+                        totals.get(name[6:], 0) + getattr(delta, name))
+        return totals
+
+    @classmethod
+    def add(cls, repo, scan_name, deltas):
+        """Adds deltas, a dictionary mapping count_names to amounts, to the
+        counts for a scan with a single transaction on one shard."""
+        deltas = dict((count_name, delta)
+                      for count_name, delta in deltas.items() if delta)
+        if deltas:
+            cls.add_to_shard(
+                repo, scan_name, random.randrange(cls.NUM_SHARDS), deltas)
+
+    @classmethod
+    @db.transactional
+    def add_to_shard(cls, repo, scan_name, shard, deltas):
+        key_name = cls.get_key_name(repo, scan_name, shard)
+        delta = cls.get_by_key_name(key_name)
+        if not delta:
+            delta = cls(key_name=key_name, repo=repo, scan_name=scan_name)
+        for count_name, amount in deltas.items():
+            prop_name = 'count_' + encode_count_name(count_name)
+            setattr(delta, prop_name, getattr(delta, prop_name, 0) + amount)
+        delta.put()
+
+
+def add_review_count_deltas(repo, changes):
+    """Records changes to the review states of Notes.  'changes' is a list
+    of (note, old_review_count_name) pairs, where old_review_count_name was
+    obtained from get_review_count_name before the Note was changed."""
+    deltas = {}
+    for note, old_count_name in changes:
+        new_count_name = get_review_count_name(note)
+        if not note.is_expired and new_count_name != old_count_name:
+            deltas[old_count_name] = deltas.get(old_count_name, 0) - 1
+            deltas[new_count_name] = deltas.get(new_count_name, 0) + 1
+    CountDelta.add(repo, 'note', deltas)
+
+
+def add_count_deltas(repo, added=(), removed=()):
+    """Records that the given Persons and Notes have been added to or
+    removed from the unexpired records of a repository, which the 'person'
+    and 'note' scans count."""
+    deltas = {'person': {}, 'note': {}}
+    for records, amount in [(added, 1), (removed, -1)]:
+        for record in records:
+            if isinstance(record, Person):
+                scan_deltas = deltas['person']
+                count_names = get_person_count_names(record)
+            elif isinstance(record, Note):
+                scan_deltas = deltas['note']
+                count_names = get_note_count_names(record)
+            else:
+                continue
+            for count_name in count_names:
+                scan_deltas[count_name] = (
+                    scan_deltas.get(count_name, 0) + amount)
+    for scan_name, scan_deltas in deltas.items():
+        CountDelta.add(repo, scan_name, scan_deltas)
+
+
 class Subscription(db.Model):
     """Subscription to notifications when a note is added to a person record"""
     repo = db.StringProperty(required=True)
@@ -1106,45 +1639,172 @@ class UserActionLog(db.Expando):
 
 
 class UniqueId(db.Model):
-    """This entity is used just to generate unique numeric IDs."""
+    """This entity is used just to generate unique numeric IDs.  No UniqueId
+    entities are stored: the IDs are reserved in blocks with db.allocate_ids,
+    which never gives out the same ID twice across instances, and each
+    process hands out the IDs in its current block from memory."""
+
+    # Number of IDs reserved by each datastore call in create_id.
+    BLOCK_SIZE = 100
+
+    # The next ID to hand out and the last ID in the current block.
+    _next_id = 1
+    _last_id = 0
+
+    _lock = threading.Lock()
+
     @staticmethod
-    def create_id():
+    def get_allocation_key():
+        """Gets the key whose ID sequence the IDs are allocated from."""
+        return db.Key.from_path('UniqueId', 1)
+
+    @classmethod
+    def create_id(cls):
         """Gets an integer ID that is guaranteed to be different from any ID
-        previously returned by this static method."""
-        unique_id = UniqueId()
-        unique_id.put()
-        return unique_id.key().id()
+        previously returned by create_id or create_ids, in any process.  This
+        only makes a datastore call once every BLOCK_SIZE IDs."""
+        with cls._lock:
+            if cls._next_id > cls._last_id:
+                # The block is reserved synchronously, as a datastore call
+                # can't outlive the request that started it.
+                cls._next_id, cls._last_id = db.allocate_ids(
+                    cls.get_allocation_key(), cls.BLOCK_SIZE)
+            unique_id = cls._next_id
+            cls._next_id += 1
+            return unique_id
+
+    @classmethod
+    def reset(cls):
+        """Discards the IDs reserved by this process.  Tests should call this
+        when they switch to a new datastore."""
+        with cls._lock:
+            cls._next_id, cls._last_id = 1, 0
+
+    @staticmethod
+    def create_ids(count):
+        """Gets a list of count integer IDs with a single datastore call.  The
+        IDs are guaranteed to be different from any ID previously returned by
+        create_id or create_ids."""
+        first, last = db.allocate_ids(UniqueId.get_allocation_key(), count)
+        return range(first, last + 1)
+
 
 class UsageCounter(db.Expando):
     """Counters which count the historical statistics for each repository.
     To see how this is used, check out admin_statistics.py.
     Unlike the Counter class, UsageCounter object increments when
     a new record or a new note is created, which means, the UsageCounter
-    will not decrement when a record/note is expired/deleted."""
+    will not decrement when a record/note is expired/deleted.
+
+    The counts for a repository are spread across NUM_SHARDS entities, and
+    each increment goes to a randomly chosen shard, so that records created
+    at the same time don't all contend for one entity group.  The entity
+    keyed by the bare repository name (written before the counters were
+    sharded) is counted as one more shard."""
+
+    # Number of shard entities per repository.
+    NUM_SHARDS = 20
+
+    # Seconds for which the summed counts are kept in memcache.
+    CACHE_SECONDS = 60
 
     # repo stored as a seperate property so it can be indexed and queried.
     repo = db.StringProperty(required=True)
 
     @classmethod
-    def create(cls, repo):
-        """Create a new counter"""
-        return UsageCounter(key_name=repo, repo=repo)
+    def create(cls, repo, shard=None):
+        """Create a new counter.  If shard is None, this creates the unsharded
+        counter for the repository."""
+        return UsageCounter(key_name=cls.get_key_name(repo, shard), repo=repo)
+
+    @staticmethod
+    def get_key_name(repo, shard=None):
+        if shard is None:
+            return repo
+        return '%s:%d' % (repo, shard)
+
+    @staticmethod
+    def get_cache_key(repo):
+        return 'usage_counter:' + repo
+
+    @classmethod
+    def get_shards(cls, repo):
+        """Gets all the existing counter entities for a repository."""
+        key_names = [cls.get_key_name(repo)] + [
+            cls.get_key_name(repo, shard) for shard in range(cls.NUM_SHARDS)]
+        return [counter for counter in cls.get_by_key_name(key_names)
+                if counter]
+
+    @classmethod
+    def sum_shards(cls, repo):
+        """Reads all the shards for a repository from the datastore and
+        returns a dictionary of the summed counts, keyed by counter name."""
+        totals = {}
+        for counter in cls.get_shards(repo):
+            for counter_name in counter.dynamic_properties():
+                totals[counter_name] = (
+                    totals.get(counter_name, 0) +
+                    getattr(counter, counter_name))
+        return totals
 
     @classmethod
     def get(cls, repo):
-        """Gets the entity with a given repository."""
-        return UsageCounter.get_by_key_name(repo)
+        """Gets an entity holding the counts for a given repository, summed
+        over all the shards, or None if nothing has been counted yet.  The
+        result is only for reading; don't put() it."""
+        totals = cls.sum_shards(repo)
+        if not totals:
+            return None
+        counter = cls.create(repo)
+        for counter_name, value in totals.items():
+            setattr(counter, counter_name, value)
+        return counter
+
+    @classmethod
+    def get_totals(cls, repo):
+        """Gets a dictionary of the counts for a given repository, keyed by
+        counter name.  The sums are cached in memcache for CACHE_SECONDS and
+        dropped from the cache whenever a counter entity is written."""
+        cache_key = cls.get_cache_key(repo)
+        totals = memcache.get(cache_key)
+        if totals is None:
+            totals = cls.sum_shards(repo)
+            memcache.set(cache_key, totals, cls.CACHE_SECONDS)
+        return totals
+
+    def put(self, *args, **kwargs):
+        result = super(UsageCounter, self).put(*args, **kwargs)
+        memcache.delete(self.get_cache_key(self.repo))
+        return result
 
     @classmethod
-    @db.transactional
     def increment_counter(cls, repo, counter_list, amount=1):
         """Increase the counter for the counter value
         based on the given amount. Each Counter has a dynamic property
         and is named based on a given counter_name."""
-        counter = cls.get(repo)
+        cls.increment_counters(
+            repo, dict((counter_name, amount) for counter_name in counter_list))
+
+    @classmethod
+    def increment_counters(cls, repo, amounts):
+        """Increases several counters at once with a single transaction on
+        one shard.  'amounts' is a dictionary mapping counter names to the
+        amounts to add.  Bulk writers should add up their increments and make
+        one call per batch rather than one per record."""
+        amounts = dict((counter_name, amount)
+                       for counter_name, amount in amounts.items() if amount)
+        if amounts:
+            cls.increment_shard(
+                repo, random.randrange(cls.NUM_SHARDS), amounts)
+
+    @classmethod
+    @db.transactional
+    def increment_shard(cls, repo, shard, amounts):
+        """Adds the given amounts to the counters in one shard."""
+        counter = cls.get_by_key_name(cls.get_key_name(repo, shard))
         if not counter:
-            counter = cls.create(repo)
-        for counter_name in counter_list:
+            counter = cls.create(repo, shard)
+        for counter_name, amount in amounts.items():
             counter_value = getattr(counter, counter_name, 0)
             setattr(counter, counter_name, counter_value + amount)
         counter.put()
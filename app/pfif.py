@@ -415,61 +415,95 @@ PFIF_DEFAULT_VERSION = '1.4'
 
 assert PFIF_DEFAULT_VERSION in PFIF_VERSIONS
 
-def check_pfif_tag(name, parent=None):
-    """Recognizes a PFIF XML tag from any version of PFIF."""
-    return PFIF_1_4.check_tag(name, parent) or \
-        PFIF_1_3.check_tag(name, parent) or \
-        PFIF_1_2.check_tag(name, parent) or \
-        PFIF_1_1.check_tag(name, parent)
+# Maps the namespace-qualified <person> and <note> tags of every version of
+# PFIF to the record type, 'person' or 'note'.
+PFIF_RECORD_TYPES = {}
+
+# Maps each record type and a namespace-qualified tag of a field of that type
+# of record, in any version of PFIF, to the field name.
+PFIF_FIELD_NAMES = {}
+
+for pfif_version in PFIF_VERSIONS.values():
+    for record_type in ['person', 'note']:
+        PFIF_RECORD_TYPES[(pfif_version.ns, record_type)] = record_type
+        for field in pfif_version.fields[record_type]:
+            PFIF_FIELD_NAMES[(record_type, (pfif_version.ns, field))] = field
 
 
 class Handler(xml.sax.handler.ContentHandler):
-    """SAX event handler for parsing PFIF documents."""
+    """SAX event handler for parsing PFIF documents.
+
+    Tags are looked up in PFIF_RECORD_TYPES and PFIF_FIELD_NAMES, and the text
+    of each child element of a <person> or <note> is collected in a list and
+    joined when the element ends."""
     def __init__(self, rename_fields=True):
         # Wether to attempt to rename fields based on RENAMED_FIELDS.
         self.rename_fields = rename_fields
-        self.tags = []
+        # For each open element: its tag, its record type if it's a <person>
+        # or <note>, and a list of its text chunks if its parent is one.
+        self.elements = []
         self.person = {}
         self.note = {}
         self.enclosed_notes = []  # Notes enclosed by the current <person>.
+        self.in_person = False  # Whether a <person> element is open.
         self.person_records = []
         self.note_records = []
 
     def startElementNS(self, tag, qname, attrs):
-        self.tags.append(tag)
-        if check_pfif_tag(tag) == 'person':
+        record_type = PFIF_RECORD_TYPES.get(tag)
+        parent_type = self.elements[-1][1] if self.elements else None
+        self.elements.append((tag, record_type, [] if parent_type else None))
+        if record_type == 'person':
             self.person = {}
             self.enclosed_notes = []
-        elif check_pfif_tag(tag) == 'note':
+            self.in_person = True
+        elif record_type == 'note':
             self.note = {}
 
     def endElementNS(self, tag, qname):
-        assert self.tags.pop() == tag
-        if check_pfif_tag(tag) == 'person':
+        start_tag, record_type, chunks = self.elements.pop()
+        assert start_tag == tag
+        if chunks:
+            parent_type = self.elements[-1][1]
+            record = self.person if parent_type == 'person' else self.note
+            self.append_to_field(record, tag, parent_type, u''.join(chunks))
+        if record_type == 'person':
             self.person_records.append(self.person)
+            self.in_person = False
             if 'person_record_id' in self.person:
                 # Copy the person's person_record_id to any enclosed notes.
                 for note in self.enclosed_notes:
                     note['person_record_id'] = self.person['person_record_id']
-        elif check_pfif_tag(tag) == 'note':
+        elif record_type == 'note':
             # Save all parsed notes (whether or not enclosed in <person>).
             self.note_records.append(self.note)
             self.enclosed_notes.append(self.note)
 
     def append_to_field(self, record, tag, parent, content):
-        field = check_pfif_tag(tag, parent)
+        field = PFIF_FIELD_NAMES.get((parent, tag))
         if field:
             record[field] = record.get(field, u'') + content
         elif content.strip():
             logging.warn('ignored tag %r with content %r', tag, content)
 
     def characters(self, content):
-        if content and len(self.tags) >= 2:
-            parent, tag = self.tags[-2], self.tags[-1]
-            if check_pfif_tag(parent) == 'person':
-                self.append_to_field(self.person, tag, 'person', content)
-            elif check_pfif_tag(parent) == 'note':
-                self.append_to_field(self.note, tag, 'note', content)
+        if content and self.elements:
+            chunks = self.elements[-1][2]
+            if chunks is not None:
+                chunks.append(content)
+
+    def pop_records(self):
+        """Removes and returns the lists of person records and note records
+        parsed so far, except the notes in a <person> element that hasn't
+        ended yet (they get the person's person_record_id when it ends)."""
+        num_notes = len(self.note_records)
+        if self.in_person:
+            num_notes -= len(self.enclosed_notes)
+        person_records = self.person_records
+        note_records = self.note_records[:num_notes]
+        self.person_records = []
+        self.note_records = self.note_records[num_notes:]
+        return person_records, note_records
 
 
 def rename_fields_to_latest(record):
@@ -483,12 +517,8 @@ def rename_fields_to_latest(record):
                 record[new] = maybe_convert_other_to_description(record[old])
             del record[old]
 
-def parse_file(pfif_utf8_file, rename_fields=True):
-    """Reads a UTF-8-encoded PFIF file to give a list of person records and a
-    list of note records.  Each record is a plain dictionary of strings,
-    with PFIF 1.4 field names as keys if rename_fields is True; otherwise,
-    the field names are kept as is in the input XML file."""
-    handler = Handler(rename_fields)
+def make_parser(handler):
+    """Makes a SAX parser for PFIF documents that sends events to handler."""
     parser = defusedxml.sax.make_parser()
     parser.setFeature(xml.sax.handler.feature_namespaces, True)
     # Below two are to avoid XML External Entity attacks:
@@ -496,8 +526,42 @@ def parse_file(pfif_utf8_file, rename_fields=True):
     parser.setFeature(xml.sax.handler.feature_external_pes, False)
     parser.setFeature(xml.sax.handler.feature_external_ges, False)
     parser.setContentHandler(handler)
-    parser.parse(pfif_utf8_file)
+    return parser
+
+def parse_file(pfif_utf8_file, rename_fields=True):
+    """Reads a UTF-8-encoded PFIF file to give a list of person records and a
+    list of note records.  Each record is a plain dictionary of strings,
+    with PFIF 1.4 field names as keys if rename_fields is True; otherwise,
+    the field names are kept as is in the input XML file."""
+    handler = Handler(rename_fields)
+    make_parser(handler).parse(pfif_utf8_file)
     if rename_fields:
         for record in handler.person_records + handler.note_records:
             rename_fields_to_latest(record)
     return handler.person_records, handler.note_records
+
+def parse_file_in_chunks(pfif_utf8_file, chunk_size, rename_fields=True,
+                         read_size=65536):
+    """Reads a UTF-8-encoded PFIF file incrementally, read_size bytes at a
+    time, and generates (person_records, note_records) pairs of lists as the
+    records are parsed, like parse_file does for the whole file.  A pair is
+    generated whenever at least chunk_size records are complete, and at the
+    end of the file, so only about chunk_size records are held at a time."""
+    handler = Handler(rename_fields)
+    parser = make_parser(handler)
+    while True:
+        data = pfif_utf8_file.read(read_size)
+        if data:
+            parser.feed(data)
+        else:
+            parser.close()
+        if (not data or len(handler.person_records) +
+            len(handler.note_records) >= chunk_size):
+            person_records, note_records = handler.pop_records()
+            if rename_fields:
+                for record in person_records + note_records:
+                    rename_fields_to_latest(record)
+            if person_records or note_records:
+                yield person_records, note_records
+        if not data:
+            break
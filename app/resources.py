@@ -24,6 +24,7 @@ Similar to App Engine's app versions, there is a concept of an "active bundle"
 from which resources are obtained.  Previewing or releasing a new set of
 resources is a matter of setting the active bundle."""
 
+import collections
 import datetime
 import logging
 import os
@@ -120,8 +121,19 @@ from google.appengine.ext import webapp
 
 
 class RamCache:
-    def __init__(self):
-        self.cache = {}
+    """An in-memory LRU cache whose entries expire after a given TTL.  When
+    the cache holds max_size entries, putting a new entry evicts the least
+    recently used one.  Misses can be cached too, by putting MISSING."""
+
+    # Put this to cache the fact that there's no value for a key.
+    MISSING = object()
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.cache = collections.OrderedDict()
+        self.hit_count = 0
+        self.miss_count = 0
+        self.evict_count = 0
 
     def clear(self):
         self.cache.clear()
@@ -129,13 +141,32 @@ class RamCache:
     def put(self, key, value, ttl_seconds):
         if ttl_seconds > 0:
             expiry = utils.get_utcnow() + datetime.timedelta(0, ttl_seconds)
+            self.cache.pop(key, None)
+            while len(self.cache) >= self.max_size:
+                self.cache.popitem(last=False)
+                self.evict_count += 1
             self.cache[key] = (value, expiry)
 
     def get(self, key):
-        if key in self.cache:
-            value, expiry = self.cache[key]
+        """Returns the cached value (possibly MISSING) or None if the key isn't
+        cached or has expired."""
+        entry = self.cache.pop(key, None)
+        if entry:
+            value, expiry = entry
             if utils.get_utcnow() < expiry:
+                # Re-inserting the entry marks it as the most recently used.
+                self.cache[key] = entry
+                self.hit_count += 1
                 return value
+            # Stale cache entry, already removed from the cache.
+            self.evict_count += 1
+        self.miss_count += 1
+
+    def stats(self):
+        logging.info("Hit Count - %r" % self.hit_count)
+        logging.info("Miss Count - %r" % self.miss_count)
+        logging.info("Items Count - %r" % len(self.cache))
+        logging.info("Eviction Count - %r" % self.evict_count)
 
 
 class ResourceBundle(db.Model):
@@ -209,7 +240,11 @@ class Resource(db.Model):
 
 
 LOCALIZED_CACHE = RamCache()  # contains Resource objects
-RENDERED_CACHE = RamCache()  # contains strings of rendered content
+# contains strings of rendered content
+RENDERED_CACHE = RamCache(max_size=2000)
+
+# How long to remember that there's no variant of a resource for a language.
+MISSING_CACHE_SECONDS = 10
 
 def clear_caches():
     LOCALIZED_CACHE.clear()
@@ -231,6 +266,8 @@ def get_localized(name, lang, bundle_name=None):
     bundle_name = bundle_name or active_bundle_name
     cache_key = (bundle_name, name, lang)
     resource = LOCALIZED_CACHE.get(cache_key)
+    if resource is RamCache.MISSING:
+        return None
     if not resource:
         if lang:
             resource = Resource.get(name + ':' + lang, bundle_name)
@@ -238,6 +275,9 @@ def get_localized(name, lang, bundle_name=None):
             resource = Resource.get(name, bundle_name)
         if resource:
             LOCALIZED_CACHE.put(cache_key, resource, resource.cache_seconds)
+        else:
+            LOCALIZED_CACHE.put(
+                cache_key, RamCache.MISSING, MISSING_CACHE_SECONDS)
     return resource
 
 def get_rendered(name, lang, extra_key=None,
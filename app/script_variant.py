@@ -18,6 +18,8 @@ import jautils
 
 from unidecode import unidecode
 
+import collections
+import functools
 import os.path
 import re
 import logging
@@ -53,6 +55,57 @@ def read_dictionary(file_name):
 JAPANESE_NAME_LOCATION_DICTIONARY = read_dictionary('japanese_name_location_dict.txt')
 CHINESE_FAMILY_NAME_DICTIONARY = read_dictionary('chinese_family_name_dict.txt')
 
+
+class RomanizationCache(object):
+    """A size-bounded LRU cache for the results of the romanize_* functions.
+
+    Indexing a person romanizes every name and location field with every
+    method in full_text_search.ROMANIZE_METHODS, and romanize_japanese_word
+    does two dictionary lookups per split point of a word, so reindexing a
+    repository or serving popular queries repeats the same work many times.
+    One cache is shared by all the memoized functions; entries are keyed by
+    the function name and its arguments."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hit_count = 0
+        self.miss_count = 0
+        self.evict_count = 0
+        self._entries = collections.OrderedDict()
+
+    def memoize(self, function):
+        """Decorates a function that returns a list so that its results are
+        cached.  Callers get a copy of the cached list, so they can modify
+        it freely."""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            key = (function.__name__, args, tuple(sorted(kwargs.items())))
+            result = self._entries.pop(key, None)
+            if result is None:
+                self.miss_count += 1
+                result = function(*args, **kwargs)
+                if len(self._entries) >= self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evict_count += 1
+            else:
+                self.hit_count += 1
+            # (Re-)inserting the entry marks it as the most recently used.
+            self._entries[key] = result
+            return list(result)
+        return wrapper
+
+    def flush(self):
+        self._entries.clear()
+
+    def stats(self):
+        logging.info("Hit Count - %r" % self.hit_count)
+        logging.info("Miss Count - %r" % self.miss_count)
+        logging.info("Items Count - %r" % len(self._entries))
+        logging.info("Eviction Count - %r" % self.evict_count)
+
+romanization_cache = RomanizationCache(max_size=20000)
+
+
 def has_kanji(word):
     """
     Returns whether word contains kanji or not.
@@ -62,6 +115,7 @@ def has_kanji(word):
     return re.match(ur'([\u3400-\u9fff])', word)
 
 
+@romanization_cache.memoize
 def romanize_single_japanese_word(word):
     """
     This method romanizes a single Japanese word using a dictionary.
@@ -85,6 +139,7 @@ def romanize_single_japanese_word(word):
     return [word]
 
 
+@romanization_cache.memoize
 def romanize_japanese_word(word, for_index=True):
     """
     This method romanizes a Japanese text chunk using a dictionary.
@@ -144,6 +199,7 @@ def romanize_japanese_word(word, for_index=True):
     return list(words)
 
 
+@romanization_cache.memoize
 def romanize_word_by_unidecode(word):
     """
     This method romanizes all languages by unidecode.
@@ -187,6 +243,7 @@ def split_chinese_name(word):
     return None, None
 
 
+@romanization_cache.memoize
 def romanize_chinese_name(word):
     """
     This method romanizes a chinese person name including family_name and given_name
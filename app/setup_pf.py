@@ -39,6 +39,7 @@ def wipe_datastore(delete=None, keep=None):
                    if delete is None or key.kind() in delete
                    if keep is None or key.kind() not in keep])
         keys = query.with_cursor(query.cursor()).fetch(1000)
+    repo_directory.invalidate()
 
 def reset_datastore():
     """Wipes everything in the datastore except Accounts,
@@ -52,6 +53,7 @@ def setup_repos():
             Repo(key_name='japan',
                  activation_status=Repo.ActivationStatus.ACTIVE),
             Repo(key_name='pakistan')])
+    repo_directory.invalidate()
 
 def setup_configs():
     """Installs configuration settings used for testing by server_tests."""
@@ -28,6 +28,8 @@ from google.appengine.ext import db
 import cloud_storage
 import config
 import const
+import full_text_search
+import importer
 import model
 import photo
 import pfif
@@ -113,11 +115,13 @@ class CleanUpInTestMode(utils.BaseHandler):
             person = query.get()
             # When the repository is no longer in test mode, aborts the
             # deletion.
+            index_writer = full_text_search.BatchIndexWriter()
             try:
                 while person and self.in_test_mode(self.repo):
                     if self.__listener:
                         self.__listener.before_deletion(person.key())
-                    person.delete_related_entities(delete_self=True)
+                    person.delete_related_entities(
+                        delete_self=True, index_writer=index_writer)
                     cursor = query.cursor()
                     person = query.get()
             except runtime.DeadlineExceededError:
@@ -126,11 +130,15 @@ class CleanUpInTestMode(utils.BaseHandler):
                 # This exception is sometimes raised, maybe when the query
                 # object live too long?
                 self.schedule_next_task(cursor, utcnow)
+            finally:
+                # Remove the deleted Persons from the full-text index.
+                index_writer.flush()
                 
         else:
-            for repo in model.Repo.list():
-                if self.in_test_mode(repo):
-                    self.add_task_for_repo(repo, self.task_name(), self.ACTION)
+            for info in model.repo_directory.get_repos():
+                if info.test_mode:
+                    self.add_task_for_repo(
+                        info.repo, self.task_name(), self.ACTION)
 
     def set_listener(self, listener):
         self.__listener = listener
@@ -146,7 +154,7 @@ def run_count(make_query, update_counter, counter):
         query = query.filter('__key__ >', db.Key(counter.last_key))
     entities = query.order('__key__').fetch(FETCH_LIMIT)
     if not entities:
-        counter.last_key = ''
+        counter.finish()
         return False
 
     # Pass the entities to the counting function.
@@ -173,8 +181,7 @@ class CountBase(utils.BaseHandler):
     def get(self):
         if self.repo:  # Do some counting.
             try:
-                counter = model.Counter.get_unfinished_or_create(
-                    self.repo, self.SCAN_NAME)
+                counter = self.get_counter()
                 entities_remaining = True
                 while entities_remaining:
                     # Batch the db updates.
@@ -184,6 +191,7 @@ class CountBase(utils.BaseHandler):
                         if not entities_remaining:
                             break
                     # And put the updates at once.
+                    self.finish_batch()
                     counter.put()
             except runtime.DeadlineExceededError:
                 # Continue counting in another task.
@@ -192,6 +200,13 @@ class CountBase(utils.BaseHandler):
             for repo in model.Repo.list():
                 self.add_task_for_repo(repo, self.SCAN_NAME, self.ACTION)
 
+    def get_counter(self):
+        """Subclasses may override this.  This will be called once at the
+        start of the task to get the Counter to continue or start counting
+        with."""
+        return model.Counter.get_unfinished_or_create(
+            self.repo, self.SCAN_NAME)
+
     def make_query(self):
         """Subclasses should implement this.  This will be called to get the
         datastore query; it should always return the same query."""
@@ -201,11 +216,59 @@ class CountBase(utils.BaseHandler):
         each entity that matches the query; it should call increment() on
         the counter object for whatever accumulators it wants to increment."""
 
+    def finish_batch(self):
+        """Subclasses may implement this.  This will be called before the
+        counter is saved with a new last_key; it should complete any work
+        that update_counter deferred for the entities scanned so far."""
+
+
+def count_note(counter, note):
+    """Increments the accumulators of a 'note' scan Counter for one Note."""
+    for count_name in model.get_note_count_names(note):
+        counter.increment(count_name)
+
+
+def get_last_record_id(counter):
+    """Gets the record ID of the last entity scanned for a Counter, or None
+    if the scan hasn't started or is finished."""
+    if counter.last_key:
+        repo, record_id = db.Key(counter.last_key).name().split(':', 1)
+        return record_id
+    return None
+
 
 class CountPerson(CountBase):
+    """Counts Persons and Notes in one pass.  Instead of querying for the
+    Notes on each Person, each batch of Persons (scanned in key order) is
+    followed by one scan of the Notes, ordered by person_record_id, whose
+    person_record_ids fall in the range of record IDs covered by the batch.
+    Those Notes give the num_notes and linked_persons counts of the Persons
+    and the counts for the 'note' scan, which is saved along with the
+    'person' scan."""
     SCAN_NAME = 'person'
+    NOTE_SCAN_NAME = 'note'
     ACTION = 'tasks/count/person'
 
+    def get_counter(self):
+        counter = super(CountPerson, self).get_counter()
+        self.note_counter = model.Counter.get_unfinished_or_create(
+            self.repo, self.NOTE_SCAN_NAME)
+        if self.note_counter.last_key != counter.last_key:
+            # A previous task stopped between saving the two counters, so
+            # they don't cover the same records; start both over.
+            counter = model.Counter.create(self.repo, self.SCAN_NAME)
+            self.note_counter = model.Counter.create(
+                self.repo, self.NOTE_SCAN_NAME)
+        if not self.note_counter.last_key:
+            # A new scan takes the review counts even if they are zero, so
+            # that api/stats can tell that they were taken.
+            self.note_counter.initialize(model.REVIEW_COUNT_NAMES)
+        self.counter = counter
+        # Notes on Persons up to this record ID have already been counted.
+        self.counted_person_id = get_last_record_id(counter)
+        self.person_ids = []  # IDs of the Persons scanned in this batch
+        return counter
+
     def make_query(self):
         return model.Person.all().filter('repo =', self.repo)
 
@@ -214,46 +277,57 @@ class CountPerson(CountBase):
         if person.latest_found is not None:
             found = person.latest_found and 'TRUE' or 'FALSE'
 
-        counter.increment('all')
-        counter.increment('original_domain=' + (person.original_domain or ''))
-        counter.increment('sex=' + (person.sex or ''))
-        counter.increment('home_country=' + (person.home_country or ''))
-        counter.increment('photo=' + (person.photo_url and 'present' or ''))
-        counter.increment('num_notes=%d' % len(person.get_notes()))
+        for count_name in model.get_person_count_names(person):
+            counter.increment(count_name)
         counter.increment('status=' + (person.latest_status or ''))
         counter.increment('found=' + found)
-        if person.author_email:  # author e-mail address present?
-            counter.increment('author_email')
-        if person.author_phone:  # author phone number present?
-            counter.increment('author_phone')
-        counter.increment(
-            'linked_persons=%d' % len(person.get_linked_persons()))
-
-
-class CountNote(CountBase):
-    SCAN_NAME = 'note'
-    ACTION = 'tasks/count/note'
-
-    def make_query(self):
-        return model.Note.all().filter('repo =', self.repo)
-
-    def update_counter(self, counter, note):
-        author_made_contact = ''
-        if note.author_made_contact is not None:
-            author_made_contact = note.author_made_contact and 'TRUE' or 'FALSE'
-
-        counter.increment('all')
-        counter.increment('status=' + (note.status or ''))
-        counter.increment('original_domain=' + (note.original_domain or ''))
-        counter.increment('author_made_contact=' + author_made_contact)
-        if note.last_known_location:  # last known location specified?
-            counter.increment('last_known_location')
-        if note.author_email:  # author e-mail address present?
-            counter.increment('author_email')
-        if note.author_phone:  # author phone number present?
-            counter.increment('author_phone')
-        if note.linked_person_record_id:  # linked to another person?
-            counter.increment('linked_person')
+        # num_notes and linked_persons are counted in finish_batch.
+        self.person_ids.append(person.record_id)
+
+    def finish_batch(self):
+        # The Persons are scanned in key order, so the batch covers the
+        # record IDs after the last batch up to the last key scanned, or all
+        # the rest if the scan is done.
+        end_person_id = get_last_record_id(self.counter)
+        query = model.Note.all_in_repo(self.repo)
+        if self.counted_person_id is not None:
+            query.filter('person_record_id >', self.counted_person_id)
+        if end_person_id is not None:
+            query.filter('person_record_id <=', end_person_id)
+        query.order('person_record_id')
+
+        num_notes = dict((person_id, 0) for person_id in self.person_ids)
+        linked_person_ids = dict(
+            (person_id, []) for person_id in self.person_ids)
+        for note in query.run(batch_size=FETCH_LIMIT * 5):
+            count_note(self.note_counter, note)
+            if note.person_record_id in num_notes:
+                num_notes[note.person_record_id] += 1
+                if note.linked_person_record_id:
+                    linked_person_ids[note.person_record_id].append(
+                        note.linked_person_record_id)
+
+        # Look up all the linked Persons of the batch at once.
+        all_linked_person_ids = set()
+        for ids in linked_person_ids.values():
+            all_linked_person_ids.update(ids)
+        existing_person_ids = set(
+            person.record_id for person in model.Person.get_all(
+                self.repo, list(all_linked_person_ids)))
+        for person_id in self.person_ids:
+            self.counter.increment('num_notes=%d' % num_notes[person_id])
+            self.counter.increment('linked_persons=%d' % len(
+                [linked_id for linked_id in linked_person_ids[person_id]
+                 if linked_id in existing_person_ids]))
+
+        # Save the note counts with the same progress as the person counts.
+        if self.counter.last_key:
+            self.note_counter.last_key = self.counter.last_key
+        else:
+            self.note_counter.finish()
+        self.note_counter.put()
+        self.counted_person_id = end_person_id
+        self.person_ids = []
 
 
 class AddReviewedProperty(CountBase):
@@ -307,13 +381,20 @@ class Reindex(CountBase):
     SCAN_NAME = 'reindex'
     ACTION = 'tasks/count/reindex'
 
+    def __init__(self, *args, **kwargs):
+        super(Reindex, self).__init__(*args, **kwargs)
+        self.index_writer = full_text_search.BatchIndexWriter()
+
     def make_query(self):
         return model.Person.all().filter('repo =', self.repo)
 
     def update_counter(self, counter, person):
-        person.update_index(['old', 'new'])
+        person.update_index(['old', 'new'], index_writer=self.index_writer)
         person.put()
 
+    def finish_batch(self):
+        self.index_writer.flush()
+
 
 class NotifyManyUnreviewedNotes(utils.BaseHandler):
     """This task sends email notification when the number of unreviewed notes
@@ -397,6 +478,39 @@ class ThumbnailPreparer(utils.BaseHandler):
                 self.add_task_for_repo(repo, 'prepare-thumbnails', self.ACTION)
 
 
+class ProcessImport(utils.BaseHandler):
+    """Imports a file uploaded to api/import in the background (see
+    importer.run_import_job).  Each task imports records until
+    MAX_PROCESS_TIME has passed, then queues another task that resumes from
+    the last checkpoint."""
+
+    ACTION = importer.BACKGROUND_IMPORT_ACTION
+
+    # App Engine issues HTTP requests to tasks.
+    https_required = False
+
+    # Lifetime of a single task is 10 min.
+    MAX_PROCESS_TIME = datetime.timedelta(minutes=8)
+
+    def schedule_next_task(self, job):
+        self.add_task_for_repo(
+            self.repo, 'process-import-%s' % job.job_id, self.ACTION,
+            id=job.job_id)
+
+    def get(self):
+        job = model.ImportJob.get(self.repo, self.params.id)
+        if not job or job.status != model.ImportJob.Status.PENDING:
+            return
+        time_limit = utils.get_utcnow() + self.MAX_PROCESS_TIME
+        try:
+            if not importer.run_import_job(job, time_limit):
+                self.schedule_next_task(job)
+        except runtime.DeadlineExceededError:
+            # The records imported since the last checkpoint are imported
+            # again, with the same record IDs, which overwrites them.
+            self.schedule_next_task(job)
+
+
 class DumpCSV(utils.BaseHandler):
     """Dumps a CSV file containing all the records in each repository to Google
     Cloud Storage.
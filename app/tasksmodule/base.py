@@ -16,6 +16,10 @@
 import logging
 
 import django.http
+from google.appengine import runtime
+from google.appengine.api import datastore
+from google.appengine.api import datastore_errors
+from google.appengine.ext import db
 
 import model
 import utils
@@ -73,3 +77,142 @@ class PerRepoTaskBaseView(TasksBaseView):
         """Carries out task operations."""
         del request, args, kwargs  # unused
         raise NotImplementedError()
+
+
+class ShardedScanTaskBaseView(PerRepoTaskBaseView):
+    """Base class for tasks that go over all of a repo's entities of a kind.
+
+    When started without a cursor, the task samples the kind's keys to split
+    the repo's key range into up to NUM_SHARDS ranges, and schedules a task for
+    each range so that the ranges are scanned in parallel. Each of those tasks
+    keeps its own cursor and reschedules itself if it runs out of time. Repos
+    that are too small to be worth splitting are scanned by the first task.
+
+    The entities are passed to process_batch BATCH_SIZE at a time, so that
+    subclasses can do any lookups they need for a whole batch at once.
+
+    Subclasses should set SCAN_MODEL, implement process_batch, and implement
+    schedule_task to add a task with the params from get_scan_params (plus a
+    shard suffix on the task name, since the shard tasks are scheduled
+    together).
+    """
+
+    # The model class to scan. Should be set by subclasses.
+    SCAN_MODEL = None
+
+    # The maximum number of key ranges to scan in parallel.
+    NUM_SHARDS = 8
+
+    # The number of entities to pass to process_batch at a time.
+    BATCH_SIZE = 100
+
+    # The number of sampled keys to read per key range. The datastore keeps a
+    # __scatter__ property on a small random subset of entities, so each
+    # sample stands for a lot of entities.
+    OVERSAMPLING_FACTOR = 32
+
+    # The number of sampled keys in the repo's key range needed for each key
+    # range. Repos with too few samples for two ranges are scanned in one.
+    SAMPLES_PER_SHARD = 8
+
+    def setup(self, request, *args, **kwargs):
+        super(ShardedScanTaskBaseView, self).setup(request, *args, **kwargs)
+        self.params.read_values(post_params={'cursor': utils.strip,
+                                             'shard': utils.validate_int,
+                                             'start_key': utils.strip,
+                                             'end_key': utils.strip})
+
+    def get_scan_params(self, **kwargs):
+        """Gets the task params for a scan, given the keyword arguments that
+        were passed to schedule_task."""
+        params = {'cursor': kwargs.get('cursor', '')}
+        if kwargs.get('shard'):
+            params['shard'] = kwargs['shard']
+            params['start_key'] = str(kwargs['start_key'])
+            params['end_key'] = str(kwargs['end_key'])
+        return params
+
+    def get_query(self):
+        """Gets the query for the entities to scan."""
+        return db.Query(self.SCAN_MODEL).filter('repo =', self.env.repo)
+
+    def get_split_keys(self, start_key, end_key):
+        """Gets keys that split the range from start_key to end_key into
+        parts with roughly equal numbers of entities."""
+        num_samples = self.NUM_SHARDS * self.OVERSAMPLING_FACTOR
+        query = datastore.Query(self.SCAN_MODEL.kind(), keys_only=True)
+        query.Order('__scatter__')
+        # The __scatter__ property can't be combined with other filters, so
+        # this samples the whole kind and keeps the keys in this repo's range.
+        # A repo that is small compared to the others gets few samples, and
+        # isn't worth splitting anyway.
+        samples = [key for key in query.Run(limit=num_samples,
+                                            batch_size=num_samples)
+                   if start_key <= key < end_key]
+        samples.sort()
+        num_ranges = min(self.NUM_SHARDS,
+                         len(samples) // self.SAMPLES_PER_SHARD)
+        if num_ranges < 2:
+            logging.info('Not splitting the scan of %s in %s: found %d '
+                         'sampled keys, %d needed per key range' % (
+                             self.SCAN_MODEL.kind(), self.env.repo,
+                             len(samples), self.SAMPLES_PER_SHARD))
+            return []
+        return [samples[len(samples) * i // num_ranges]
+                for i in range(1, num_ranges)]
+
+    def get_key_ranges(self):
+        """Gets a list of (start_key, end_key) pairs that split the repo's
+        entities of SCAN_MODEL into ranges to scan in parallel."""
+        kind = self.SCAN_MODEL.kind()
+        # All the key names in a repo start with the repo ID and a colon, and
+        # ';' is the character after ':'.
+        start_key = db.Key.from_path(kind, self.env.repo + ':')
+        end_key = db.Key.from_path(kind, self.env.repo + ';')
+        bounds = ([start_key] + self.get_split_keys(start_key, end_key) +
+                  [end_key])
+        return zip(bounds[:-1], bounds[1:])
+
+    def process_batch(self, entities):
+        """Processes a batch of entities. Should be implemented by
+        subclasses."""
+        del self, entities  # unused
+        raise NotImplementedError()
+
+    def scan(self, start_key=None, end_key=None):
+        """Scans the entities from self.cursor, and between start_key and
+        end_key if given, a batch at a time."""
+        query = self.get_query()
+        if start_key:
+            query.filter('__key__ >=', start_key)
+        if end_key:
+            query.filter('__key__ <', end_key)
+        while True:
+            query.with_cursor(self.cursor or None)
+            entities = query.fetch(self.BATCH_SIZE)
+            if entities:
+                self.process_batch(entities)
+                self.cursor = query.cursor()
+            if len(entities) < self.BATCH_SIZE:
+                break
+
+    def post(self, request, *args, **kwargs):
+        del request, args, kwargs  # unused
+        # Where to continue from if this task runs out of time.
+        self.cursor = self.params.cursor
+        shard = self.params.shard
+        start_key = self.params.start_key and db.Key(self.params.start_key)
+        end_key = self.params.end_key and db.Key(self.params.end_key)
+        if not (shard or self.cursor):
+            key_ranges = self.get_key_ranges()
+            if len(key_ranges) > 1:
+                for i, (start_key, end_key) in enumerate(key_ranges):
+                    self.schedule_task(self.env.repo, shard=i + 1,
+                                       start_key=start_key, end_key=end_key)
+                return django.http.HttpResponse('')
+        try:
+            self.scan(start_key, end_key)
+        except (runtime.DeadlineExceededError, datastore_errors.Timeout):
+            self.schedule_task(self.env.repo, cursor=self.cursor, shard=shard,
+                               start_key=start_key, end_key=end_key)
+        return django.http.HttpResponse('')
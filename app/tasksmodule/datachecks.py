@@ -21,9 +21,6 @@ expected to be true.
 import datetime
 import time
 
-import django.http
-from google.appengine import runtime
-from google.appengine.api import datastore_errors
 from google.appengine.api import taskqueue
 
 import tasksmodule.base
@@ -36,21 +33,18 @@ class DatacheckException(Exception):
     pass
 
 
-class DatachecksBaseTask(tasksmodule.base.PerRepoTaskBaseView):
-
-    def setup(self, request, *args, **kwargs):
-        super(DatachecksBaseTask, self).setup(request, *args, **kwargs)
-        self.params.read_values(post_params={'cursor': utils.strip})
+class DatachecksBaseTask(tasksmodule.base.ShardedScanTaskBaseView):
 
     def schedule_task(self, repo, **kwargs):
         name = '%s-%s-%s' % (repo, self.BASE_NAME, int(time.time()*1000))
+        if kwargs.get('shard'):
+            name += '-%d' % kwargs['shard']
         path = self.build_absolute_path('/%s/tasks/%s' % (repo, self.TASK_PATH))
-        cursor = kwargs.get('cursor', '')
         # TODO(nworden): figure out why setting task_retry_limit isn't working
         retry_options = taskqueue.taskqueue.TaskRetryOptions(task_retry_limit=1)
         taskqueue.add(name=name, method='POST', url=path,
                       queue_name='datachecks', retry_options=retry_options,
-                      params={'cursor': cursor})
+                      params=self.get_scan_params(**kwargs))
 
     def alert(self, msg):
         """Alerts developers of an error.
@@ -65,6 +59,7 @@ class PersonDataValidityCheckTask(DatachecksBaseTask):
 
     BASE_NAME = 'person_data_validity_check'
     TASK_PATH = 'check_person_data_validity'
+    SCAN_MODEL = model.Person
 
     def _check_person(self, person):
         if not person.entry_date:
@@ -81,23 +76,9 @@ class PersonDataValidityCheckTask(DatachecksBaseTask):
                 'A person record has an invalid author_email value (%s).'
                 % person.record_id)
 
-    def post(self, request, *args, **kwargs):
-        del request, args, kwargs  # unused
-        query = model.Person.all(filter_expired=False).filter(
-            'repo =', self.env.repo)
-        cursor = self.params.cursor
-        if cursor:
-            query.with_cursor(cursor)
-        try:
-            for person in query:
-                next_cursor = query.cursor()
-                self._check_person(person)
-                cursor = next_cursor
-        except runtime.DeadlineExceededError:
-            self.schedule_task(self.env.repo, cursor=cursor)
-        except datastore_errors.Timeout:
-            self.schedule_task(self.env.repo, cursor=cursor)
-        return django.http.HttpResponse('')
+    def process_batch(self, persons):
+        for person in persons:
+            self._check_person(person)
 
 
 class NoteDataValidityCheckTask(DatachecksBaseTask):
@@ -105,8 +86,9 @@ class NoteDataValidityCheckTask(DatachecksBaseTask):
 
     BASE_NAME = 'note_data_validity_check'
     TASK_PATH = 'check_note_data_validity'
+    SCAN_MODEL = model.Note
 
-    def _check_note(self, note):
+    def _check_note(self, note, person_record_ids):
         if not note.entry_date:
             self.alert(
                 'A note record is missing an entry_date value (%s).' %
@@ -128,28 +110,21 @@ class NoteDataValidityCheckTask(DatachecksBaseTask):
             self.alert(
                 'A note record has an invalid email_of_found_person value (%s).'
                 % note.record_id)
-        if not model.Person.get(self.env.repo, note.person_record_id):
+        if note.person_record_id not in person_record_ids:
             self.alert(
                 'A note record\'s associated person record is missing (%s).' %
                 note.record_id)
 
-    def post(self, request, *args, **kwargs):
-        del request, args, kwargs  # unused
-        query = model.Note.all(filter_expired=False).filter(
-            'repo =', self.env.repo)
-        cursor = self.params.cursor
-        if cursor:
-            query.with_cursor(cursor)
-        try:
-            for note in query:
-                next_cursor = query.cursor()
-                self._check_note(note)
-                cursor = next_cursor
-        except runtime.DeadlineExceededError:
-            self.schedule_task(self.env.repo, cursor=cursor)
-        except datastore_errors.Timeout:
-            self.schedule_task(self.env.repo, cursor=cursor)
-        return django.http.HttpResponse('')
+    def process_batch(self, notes):
+        # Look up the associated person records for the whole batch at once.
+        persons = model.Person.get_all(
+            self.env.repo,
+            set(note.person_record_id for note in notes
+                if note.person_record_id),
+            filter_expired=True)
+        person_record_ids = set(person.record_id for person in persons)
+        for note in notes:
+            self._check_note(note, person_record_ids)
 
 
 class ExpiredPersonRecordCheckTask(DatachecksBaseTask):
@@ -157,6 +132,7 @@ class ExpiredPersonRecordCheckTask(DatachecksBaseTask):
 
     BASE_NAME = 'expired_person_record_check'
     TASK_PATH = 'check_expired_person_records'
+    SCAN_MODEL = model.Person
 
     def _check_person(self, person):
         # Check things that were expired yesterday, just in case this job is
@@ -173,19 +149,6 @@ class ExpiredPersonRecordCheckTask(DatachecksBaseTask):
                         'An expired person record still has data (%s, %s).' %
                         (person.record_id, name))
 
-    def post(self, request, *args, **kwargs):
-        query = model.Person.all(filter_expired=False).filter(
-            'repo =', self.env.repo)
-        cursor = self.params.cursor
-        if cursor:
-            query.with_cursor(cursor)
-        try:
-            for person in query:
-                next_cursor = query.cursor()
-                self._check_person(person)
-                cursor = next_cursor
-        except runtime.DeadlineExceededError:
-            self.schedule_task(self.env.repo, cursor=cursor)
-        except datastore_errors.Timeout:
-            self.schedule_task(self.env.repo, cursor=cursor)
-        return django.http.HttpResponse('')
+    def process_batch(self, persons):
+        for person in persons:
+            self._check_person(person)
@@ -17,9 +17,6 @@
 import datetime
 import time
 
-import django.http
-from google.appengine import runtime
-from google.appengine.api import datastore_errors
 from google.appengine.ext import db
 from google.appengine.api import taskqueue
 
@@ -34,10 +31,11 @@ _EXPIRED_TTL = datetime.timedelta(delete.EXPIRED_TTL_DAYS, 0, 0)
 _STRAY_CLEANUP_TTL = datetime.timedelta(30, 0, 0)
 
 
-class ProcessExpirationsTask(tasksmodule.base.PerRepoTaskBaseView):
+class ProcessExpirationsTask(tasksmodule.base.ShardedScanTaskBaseView):
     """The handler for clearing expired records.
 
-    This task goes over all Person records, and will:
+    This task goes over the Person records that are past due (see
+    Person.past_due_records), and will:
     - If a record is expired and is a clone of a record from another source,
       deletes it immediately.
     - If a record is an original record from this site and expired recently
@@ -46,62 +44,88 @@ class ProcessExpirationsTask(tasksmodule.base.PerRepoTaskBaseView):
     - Once an original record has been expired for three days, we clear it and
       delete associated content (leaving a tombstone record with metadata like
       record ID and expiration date, so that API users can see it's expired).
+
+    The repo's Person records are scanned in key ranges in parallel (see
+    ShardedScanTaskBaseView), and the past-due records are picked out of each
+    batch; the expiry_date can't be filtered on in a query that also
+    filters on the key.  All the shard tasks use the time the first task
+    started as the current time, so that they agree on which records are
+    past due.
     """
 
     ACTION_ID = 'tasks/process_expirations'
+    SCAN_MODEL = model.Person
 
     def setup(self, request, *args, **kwargs):
         super(ProcessExpirationsTask, self).setup(request, *args, **kwargs)
-        self.params.read_values(post_params={'cursor': utils.strip})
+        self.params.read_values(post_params={'now': utils.validate_datetime})
+        self.now = None
+
+    def get_now(self):
+        """Gets the time the scan started."""
+        if not self.now:
+            self.now = self.params.now or utils.get_utcnow()
+        return self.now
+
+    def get_scan_params(self, **kwargs):
+        params = super(ProcessExpirationsTask, self).get_scan_params(**kwargs)
+        if kwargs.get('shard') or kwargs.get('cursor'):
+            params['now'] = utils.format_utc_datetime(self.get_now())
+        return params
 
     def schedule_task(self, repo, **kwargs):
         name = '%s-process_expirations-%s' % (repo, int(time.time()*1000))
+        if kwargs.get('shard'):
+            name += '-%d' % kwargs['shard']
         path = self.build_absolute_path('/%s/tasks/process_expirations' % repo)
-        cursor = kwargs.get('cursor', '')
         taskqueue.add(name=name, method='POST', url=path, queue_name='expiry',
-                      params={'cursor': cursor})
-
-    def post(self, request, *args, **kwargs):
-        del request, args, kwargs  # unused
-        q = model.Person.all(filter_expired=False).filter(
-            'repo =', self.env.repo)
-        cursor = self.params.get('cursor', '')
-        if cursor:
-            q.with_cursor(cursor)
-        try:
-            now = utils.get_utcnow()
-            for person in q:
-                next_cursor = q.cursor()
-                was_expired = person.is_expired
-                person.put_expiry_flags()
-                if (now - person.get_effective_expiry_date() > _EXPIRED_TTL):
-                    # Only original records should get to this point, since
-                    # other records should have been deleted altogether as soon
-                    # as they expired. Just in case the deletion task has failed
-                    # for three days though, check that it's an original record
-                    # to ensure we don't change the contents of a non-original
-                    # record.
-                    if person.is_original():
-                        person.wipe_contents()
-                    else:
-                        person.delete_related_entities(delete_self=True)
-                elif person.is_expired and not was_expired:
-                    # Since we're not sending notices, handler isn't really
-                    # needed.
-                    # TODO(nworden): check with Product about whether we want to
-                    # send notices for expirations. The current language
-                    # indicates it was designed for cases where someone manually
-                    # requested deletion of the record.
-                    delete.delete_person(None, person, send_notices=False)
-                cursor = next_cursor
-        except runtime.DeadlineExceededError:
-            self.schedule_task(self.env.repo, cursor=cursor)
-        except datastore_errors.Timeout:
-            self.schedule_task(self.env.repo, cursor=cursor)
-        return django.http.HttpResponse('')
-
-
-class CleanupStrayItemsTaskView(tasksmodule.base.PerRepoTaskBaseView):
+                      params=self.get_scan_params(**kwargs))
+
+    def process_batch(self, persons):
+        """Expires, wipes, or deletes the past-due records in a batch of
+        Person records as needed."""
+        now = self.get_now()
+        persons = [person for person in persons
+                   if not person.expiry_date or person.expiry_date <= now]
+        if not persons:
+            return
+        notes_by_person_record_id = model.Note.get_by_person_record_ids(
+            self.env.repo, [person.record_id for person in persons],
+            filter_expired=False)
+        batch = model.WriteBatch()
+        for person in persons:
+            notes = notes_by_person_record_id[person.record_id]
+            was_expired = person.is_expired
+            person.put_expiry_flags(notes=notes, batch=batch)
+            if (now - person.get_effective_expiry_date() > _EXPIRED_TTL):
+                # Only original records should get to this point, since
+                # other records should have been deleted altogether as soon
+                # as they expired. Just in case the deletion task has failed
+                # for three days though, check that it's an original record
+                # to ensure we don't change the contents of a non-original
+                # record.
+                if person.is_original():
+                    person.wipe_contents(notes=notes, batch=batch)
+                else:
+                    person.delete_related_entities(
+                        delete_self=True, notes=notes, batch=batch)
+            elif person.is_expired and not was_expired:
+                # This is what delete.delete_person does without sending
+                # notices, except that an original record keeps its
+                # expiry_date (so its grace period runs from the time it
+                # expired): original records stay expired (as marked above)
+                # and clones are deleted right away.
+                # TODO(nworden): check with Product about whether we want to
+                # send notices for expirations. The current language
+                # indicates it was designed for cases where someone manually
+                # requested deletion of the record.
+                if not person.is_original():
+                    person.delete_related_entities(
+                        delete_self=True, notes=notes, batch=batch)
+        batch.commit()
+
+
+class CleanupStrayItemsTaskView(tasksmodule.base.ShardedScanTaskBaseView):
     """A base handler for cleaning up data unassociated with any person record.
 
     It's possible for data that's unassociated with a Person record we have to
@@ -120,14 +144,6 @@ class CleanupStrayItemsTaskView(tasksmodule.base.PerRepoTaskBaseView):
         del self, repo, kwargs  # unusued
         raise NotImplementedError()
 
-    def get_query(self):
-        """Gets the query for items to possibly delete.
-
-        Should be implemented by subclasses.
-        """
-        del self  # unused
-        raise NotImplementedError()
-
     def get_person_record_id(self, item):
         """Gets the ID of the Person record the item is associated with.
 
@@ -144,50 +160,37 @@ class CleanupStrayItemsTaskView(tasksmodule.base.PerRepoTaskBaseView):
         del item  # unused
         raise NotImplementedError()
 
-    def setup(self, request, *args, **kwargs):
-        super(CleanupStrayItemsTaskView, self).setup(request, *args, **kwargs)
-        self.params.read_values(post_params={'cursor': utils.strip})
-
-    def post(self, request, *args, **kwargs):
-        del request, args, kwargs  # unused
-        q = self.get_query()
-        cursor = self.params.get('cursor', '')
-        if cursor:
-            q.with_cursor(cursor)
-        try:
-            now = utils.get_utcnow()
-            for item in q:
-                next_cursor = q.cursor()
-                associated_person = model.Person.get(
-                    self.env.repo, self.get_person_record_id(item))
-                if not associated_person:
-                    if now - self.get_base_timestamp(item) > _STRAY_CLEANUP_TTL:
-                        db.delete(item)
-                cursor = next_cursor
-        except runtime.DeadlineExceededError:
-            self.schedule_task(self.env.repo, cursor=cursor)
-        except datastore_errors.Timeout:
-            self.schedule_task(self.env.repo, cursor=cursor)
-        return django.http.HttpResponse('')
+    def process_batch(self, items):
+        now = utils.get_utcnow()
+        # Look up the associated person records for the whole batch at once.
+        persons = model.Person.get_all(
+            self.env.repo,
+            set(self.get_person_record_id(item) for item in items),
+            filter_expired=True)
+        person_record_ids = set(person.record_id for person in persons)
+        stray_items = [
+            item for item in items
+            if self.get_person_record_id(item) not in person_record_ids and
+            now - self.get_base_timestamp(item) > _STRAY_CLEANUP_TTL]
+        if stray_items:
+            db.delete(stray_items)
 
 
 class CleanupStrayNotesTask(CleanupStrayItemsTaskView):
     """Cleanup task handler for unassociated notes."""
 
     ACTION_ID = 'tasks/cleanup_stray_notes'
+    SCAN_MODEL = model.Note
 
     def schedule_task(self, repo, **kwargs):
         name = '%s-cleanup_stray_notes-%s' % (
             repo, int(time.time()*1000))
+        if kwargs.get('shard'):
+            name += '-%d' % kwargs['shard']
         path = self.build_absolute_path(
             '/%s/tasks/cleanup_stray_notes' % repo)
-        cursor = kwargs.get('cursor', '')
         taskqueue.add(name=name, method='POST', url=path, queue_name='expiry',
-                      params={'cursor': cursor})
-
-    def get_query(self):
-        return model.Note.all(filter_expired=False).filter(
-            'repo =', self.env.repo)
+                      params=self.get_scan_params(**kwargs))
 
     def get_person_record_id(self, note):
         return note.person_record_id
@@ -200,18 +203,17 @@ class CleanupStraySubscriptionsTask(CleanupStrayItemsTaskView):
     """Cleanup task handler for unassociated subscriptions."""
 
     ACTION_ID = 'tasks/cleanup_stray_subscriptions'
+    SCAN_MODEL = model.Subscription
 
     def schedule_task(self, repo, **kwargs):
         name = '%s-cleanup_stray_subscriptions-%s' % (
             repo, int(time.time()*1000))
+        if kwargs.get('shard'):
+            name += '-%d' % kwargs['shard']
         path = self.build_absolute_path(
             '/%s/tasks/cleanup_stray_subscriptions' % repo)
-        cursor = kwargs.get('cursor', '')
         taskqueue.add(name=name, method='POST', url=path, queue_name='expiry',
-                      params={'cursor': cursor})
-
-    def get_query(self):
-        return model.Subscription.all().filter('repo =', self.env.repo)
+                      params=self.get_scan_params(**kwargs))
 
     def get_person_record_id(self, subscription):
         return subscription.person_record_id
@@ -772,6 +772,7 @@ class BaseHandler(webapp.RequestHandler):
         'contact_name': strip,
         'content_id': strip,
         'context': strip,
+        'continuation': strip,
         'cursor': strip,
         'date_of_birth': validate_approximate_date,
         'description': strip,
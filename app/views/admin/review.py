@@ -167,15 +167,19 @@ class AdminReviewView(views.admin.base.AdminBaseView):
         self.enforce_xsrf(self.ACTION_ID)
 
         notes = []
+        review_changes = []  # (note, review count name before the change)
         for param_key, value in self.request.POST.items():
             if param_key.startswith('note.'):
                 note = model.Note.get(self.env.repo, param_key[5:])
                 if note:
+                    review_changes.append(
+                        (note, model.get_review_count_name(note)))
                     if value in ['accept', 'flag']:
                         note.reviewed = True
                     if value == 'flag':
                         note.hidden = True
                     notes.append(note)
         db.put(notes)
+        model.add_review_count_deltas(self.env.repo, review_changes)
 
         return django.shortcuts.redirect(self.build_absolute_path())
@@ -62,15 +62,17 @@ def _get_repo_usage(repo):
         the number of persons, and the number of notes. E.g.:
         {'repo': haiti, 'num_persons': 10, 'num_notes': 5, ...etc.}
     """
-    counters = model.UsageCounter.get(repo)
+    # The counters are sharded; get_totals sums the shards and caches the
+    # sums in memcache.
+    counters = model.UsageCounter.get_totals(repo)
     repo_usage = {
         'repo': repo,
-        'num_persons': getattr(counters, 'person', 0),
-        'num_notes': getattr(counters, 'note', 0)
+        'num_persons': counters.get('person', 0),
+        'num_notes': counters.get('note', 0)
     }
     for note_status in const.NOTE_STATUS_TEXT:
         if not note_status:
             note_status = 'unspecified'
-        repo_usage['num_notes_' + note_status] = (getattr(
-            counters, note_status, 0))
+        repo_usage['num_notes_' + note_status] = (
+            counters.get(note_status, 0))
     return repo_usage
@@ -0,0 +1,201 @@
+# encoding=utf-8
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A micro-benchmark comparing indexing.rank_and_order, which sorts with
+precomputed keys, against the cmp-based comparator it replaced.
+
+Usage:
+  $ tools/benchmark ranking [--candidates=400] [--rounds=20]
+
+For each round it generates a result set of Latin and CJK names that all
+share some words with the query (like the up to 400 candidates fetched by
+indexing.search), sorts it both ways, checks that the orderings are
+identical, and reports the average time per sort.
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+os.environ.setdefault('APPLICATION_ID', 'personfinder-benchmark')
+
+import indexing
+import model
+from text_query import TextQuery
+
+LATIN_WORDS = ['Bryan', 'Smith', 'Ana', 'Maria', 'Lee', 'Jean', 'Pierre',
+               'Garcia', 'Kim', 'Nguyen', 'Silva', 'John', 'Paul']
+CJK_WORDS = [u'山田', u'太郎', u'田中', u'花子', u'李', u'王', u'明', u'佐藤']
+
+QUERIES = [u'Bryan Smith', u'Maria Garcia', u'Lee', u'山田 太郎', u'李明']
+
+
+class LegacyCmpResults():
+    """The cmp-based comparator that indexing.rank_and_order used to sort
+    with, kept here as the reference implementation."""
+
+    def __init__(self, query):
+        self.query = query
+        self.query_words_set = set(query.words)
+
+    def __call__(self, p1, p2):
+        if ((p1.primary_full_name and
+             p1.primary_full_name == p2.primary_full_name) or
+            ((p1.given_name or p1.family_name) and
+             p1.given_name == p2.given_name and
+             p1.family_name == p2.family_name)):
+            return 0
+        self.set_ranking_attr(p1)
+        self.set_ranking_attr(p2)
+        r1 = self.rank(p1)
+        r2 = self.rank(p2)
+
+        if r1 == r2:
+            return cmp(p1._normalized_full_name.normalized,
+                       p2._normalized_full_name.normalized)
+        else:
+            return cmp(r2, r1)
+
+    def set_ranking_attr(self, person):
+        if not hasattr(person, '_normalized_given_name'):
+            person._normalized_given_name = TextQuery(person.given_name)
+            person._normalized_family_name = TextQuery(person.family_name)
+            person._normalized_full_name = TextQuery(person.full_name)
+            person._name_words = set(person._normalized_full_name.words)
+            person._alt_name_words = set(
+                    TextQuery(person.alternate_names).words)
+
+    def rank(self, person):
+        ordered_words = self.query.normalized.split()
+        if (ordered_words ==
+            person._normalized_given_name.words +
+            person._normalized_family_name.words):
+            return 10
+        if (re.match(ur'^[\u3400-\u9fff]$', person.family_name) and
+            ordered_words in [
+                [person.family_name + person.given_name],
+                [person.family_name, person.given_name]
+            ]):
+            return 10
+        if (re.match(ur'^[\u3400-\u9fff]+$', person.family_name) and
+            ordered_words in [
+                [person.family_name + person.given_name],
+                [person.family_name, person.given_name]
+            ]):
+            return 9.5
+        if (ordered_words ==
+            person._normalized_family_name.words +
+            person._normalized_given_name.words):
+            return 9
+        if (re.match(ur'^[\u3400-\u9fff]$', person.given_name) and
+            ordered_words in [
+                    [person.given_name + person.family_name],
+                    [person.given_name, person.family_name]
+            ]):
+            return 9
+        if (re.match(ur'^[\u3400-\u9fff]+$', person.given_name) and
+            ordered_words in [
+                    [person.given_name + person.family_name],
+                    [person.given_name, person.family_name]
+            ]):
+            return 8.5
+        if person._name_words == self.query_words_set:
+            return 8
+        if self.query.normalized in [
+            person._normalized_given_name.normalized,
+            person._normalized_family_name.normalized,
+        ]:
+            return 7
+        if person._name_words.issuperset(self.query_words_set):
+            return 6
+        matched_words = person._name_words.union(
+            person._alt_name_words).intersection(self.query_words_set)
+        return min(5, 1 + len(matched_words))
+
+
+def generate_candidates(rng, count):
+    """Generates Persons with distinct full names, so that the legacy
+    comparator's shortcut for identical names never applies."""
+    persons = []
+    full_names = set()
+    while len(persons) < count:
+        words = CJK_WORDS if rng.random() < 0.3 else LATIN_WORDS
+        given_name = rng.choice(words)
+        family_name = rng.choice(words)
+        if rng.random() < 0.2:
+            given_name += ' ' + rng.choice(words)
+        separator = '' if words is CJK_WORDS else ' '
+        full_name = separator.join([given_name, family_name])
+        if full_name in full_names or given_name == family_name:
+            continue
+        full_names.add(full_name)
+        persons.append(model.Person.create_original_with_record_id(
+            'benchmark', 'benchmark/%d' % len(persons),
+            given_name=given_name,
+            family_name=family_name,
+            full_name=full_name,
+            alternate_names=rng.choice(words),
+            entry_date=None))
+    return persons
+
+
+def record_ids(persons):
+    return [person.record_id for person in persons]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--candidates', type=int, default=400)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    legacy_time = 0.0
+    keyed_time = 0.0
+    for round in xrange(args.rounds):
+        query = TextQuery(QUERIES[round % len(QUERIES)])
+        candidates = generate_candidates(rng, args.candidates)
+
+        legacy_results = list(candidates)
+        start_time = time.time()
+        legacy_results.sort(LegacyCmpResults(query))
+        legacy_time += time.time() - start_time
+
+        keyed_results = list(candidates)
+        start_time = time.time()
+        indexing.rank_and_order(keyed_results, query, len(keyed_results))
+        keyed_time += time.time() - start_time
+
+        if record_ids(legacy_results) != record_ids(keyed_results):
+            print 'Orderings differ for query %r' % query.query
+            sys.exit(1)
+
+    print 'Candidates per sort:               %d' % args.candidates
+    print 'Rounds:                            %d' % args.rounds
+    print 'Legacy comparator (ms per sort):   %.3f' % (
+        legacy_time * 1000 / args.rounds)
+    print 'Key-based ranking (ms per sort):   %.3f' % (
+        keyed_time * 1000 / args.rounds)
+    print 'Speedup:                           %.1fx' % (
+        legacy_time / keyed_time)
+    print 'All orderings identical.'
+
+
+if __name__ == '__main__':
+    main()
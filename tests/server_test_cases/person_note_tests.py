@@ -3355,6 +3355,25 @@ _feed_profile_url2</pfif:profile_urls>
         doc = self.go('/haiti/feeds/person?skip=12&max_results=5')
         assert_ids(8, 7, 6, 5, 4)
 
+        # Continue from the feed's link to the next page.
+        doc = self.go('/haiti/feeds/person?max_results=5')
+        assert_ids(20, 19, 18, 17, 16)
+        next_url = re.search(
+            r'<link rel="next">([^<]*)</link>', doc.content).group(1)
+        doc = self.s.go(next_url.replace('&amp;', '&'))
+        assert_ids(15, 14, 13, 12, 11)
+
+        doc = self.go('/haiti/feeds/person?max_results=20')
+        assert '<link rel="next">' in doc.content
+        next_url = re.search(
+            r'<link rel="next">([^<]*)</link>', doc.content).group(1)
+        doc = self.s.go(next_url.replace('&amp;', '&'))
+        assert_ids()
+        assert '<link rel="next">' not in doc.content
+
+        doc = self.go('/haiti/feeds/person?continuation=notatoken')
+        assert self.s.status == 400
+
         # Should get records in forward chronological order with min_entry_date.
         doc = self.go('/haiti/feeds/person' +
                       '?min_entry_date=2000-01-01T18:18:18Z')
@@ -3425,6 +3444,15 @@ _feed_profile_url2</pfif:profile_urls>
         doc = self.go('/haiti/feeds/note?skip=12&max_results=5')
         assert_ids(8, 7, 6, 5, 4)
 
+        # Continue from the feed's link to the next page.
+        doc = self.go('/haiti/feeds/note' +
+                      '?min_entry_date=2000-01-01T03:03:03Z&max_results=5')
+        assert_ids(3, 4, 5, 6, 7)
+        next_url = re.search(
+            r'<link rel="next">([^<]*)</link>', doc.content).group(1)
+        doc = self.s.go(next_url.replace('&amp;', '&'))
+        assert_ids(8, 9, 10, 11, 12)
+
         # Should get records in forward chronological order.
         doc = self.go('/haiti/feeds/note' +
                       '?min_entry_date=2000-01-01T18:18:18Z')
@@ -18,6 +18,7 @@ import os
 
 from google.appengine import runtime
 from google.appengine.api import taskqueue
+from google.appengine.ext import db
 import mock
 import mox
 
@@ -32,6 +33,10 @@ def deadline_exceeded_side_effect(*args, **kwargs):
     raise runtime.DeadlineExceededError()
 
 
+def note_key(key_name):
+    return db.Key.from_path('Note', key_name)
+
+
 def _test_deadline_exceeded(run_task_func, task_url):
     mox_obj = mox.Mox()
     mox_obj.StubOutWithMock(taskqueue, 'add')
@@ -61,6 +66,7 @@ class PersonDataValidityCheckTaskTests(task_tests_base.TaskTestsBase):
     def init_testbed_stubs(self):
         self.testbed.init_user_stub()
         self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
         path_to_app = os.path.join(os.path.dirname(__file__), '../../app')
         self.testbed.init_taskqueue_stub(root_path=path_to_app)
 
@@ -106,6 +112,7 @@ class NoteDataValidityCheckTaskTests(task_tests_base.TaskTestsBase):
     def init_testbed_stubs(self):
         self.testbed.init_user_stub()
         self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
         path_to_app = os.path.join(os.path.dirname(__file__), '../../app')
         self.testbed.init_taskqueue_stub(root_path=path_to_app)
 
@@ -151,6 +158,86 @@ class NoteDataValidityCheckTaskTests(task_tests_base.TaskTestsBase):
             self.run_task,
             '/haiti/tasks/check_note_data_validity', method='POST')
 
+    def test_sharded_scan(self):
+        """Tests that the notes are split into key ranges scanned by separate
+        tasks, each of which only checks its own range."""
+        self.data_generator.note(
+            person_id=self.person.record_id,
+            record_id='haiti.personfinder.google.org/note.1')
+        bad_note = self.data_generator.note(
+            person_id='not-an-existing-person-record',
+            record_id='haiti.personfinder.google.org/note.2')
+
+        shard_params = []
+        mox_obj = mox.Mox()
+        mox_obj.StubOutWithMock(taskqueue, 'add')
+        for _ in range(2):
+            taskqueue.add(
+                method='POST',
+                url='/haiti/tasks/check_note_data_validity',
+                params=mox.IgnoreArg(),
+                queue_name='datachecks',
+                retry_options=mox.IsA(taskqueue.taskqueue.TaskRetryOptions),
+                name=mox.IsA(unicode)).WithSideEffects(
+                    lambda **kwargs: shard_params.append(kwargs['params']))
+        mox_obj.ReplayAll()
+        with mock.patch('tasksmodule.datachecks.NoteDataValidityCheckTask.'
+                        'get_split_keys') as mock_get_split_keys:
+            mock_get_split_keys.return_value = [bad_note.key()]
+            self.run_task(
+                '/haiti/tasks/check_note_data_validity', method='POST')
+        mox_obj.VerifyAll()
+        mox_obj.UnsetStubs()
+
+        assert [params['shard'] for params in shard_params] == [1, 2]
+        # Only the second shard has the note with the missing person record.
+        self.run_task('/haiti/tasks/check_note_data_validity',
+                      data=shard_params[0], method='POST')
+        self.assertRaises(
+            tasksmodule.datachecks.DatacheckException,
+            self.run_task,
+            '/haiti/tasks/check_note_data_validity',
+            data=shard_params[1], method='POST')
+
+    def get_split_keys(self, keys):
+        """Gets the split keys for the Notes in the haiti repo, given the keys
+        that the datastore samples."""
+        view = tasksmodule.datachecks.NoteDataValidityCheckTask()
+        view.env = utils.Struct(repo='haiti')
+        start_key, end_key = note_key('haiti:'), note_key('haiti;')
+        with mock.patch('google.appengine.api.datastore.Query') as mock_query:
+            mock_query.return_value.Run.side_effect = (
+                lambda limit, batch_size: iter(keys[:limit]))
+            split_keys = view.get_split_keys(start_key, end_key)
+        # Only a bounded number of sampled keys is read.
+        mock_query.return_value.Run.assert_called_once_with(
+            limit=256, batch_size=256)
+        assert split_keys == sorted(split_keys)
+        assert all(start_key <= key < end_key for key in split_keys)
+        return split_keys
+
+    def test_get_split_keys(self):
+        """Tests that the sampled keys in a repo's range split it into up to
+        NUM_SHARDS ranges."""
+        keys = []
+        for i in range(2000):
+            keys.append(note_key('other:test.google.com/note.%d' % i))
+            keys.append(note_key('haiti:test.google.com/note.%d' % i))
+        # The 128 sampled keys in the repo are enough for 8 ranges.
+        assert len(self.get_split_keys(keys)) == 7
+
+    def test_get_split_keys_for_small_repo(self):
+        """Tests that a repo with a small share of the sampled keys isn't
+        split."""
+        # Most of the sampled keys are in another repo.
+        keys = []
+        for i in range(2000):
+            keys.append(note_key('other:test.google.com/note.%d' % i))
+            if i % 20 == 0:
+                keys.append(note_key('haiti:test.google.com/note.%d' % i))
+        # The 13 sampled keys in the repo aren't enough for two ranges.
+        assert self.get_split_keys(keys) == []
+
     def test_deadline_exceeded(self):
         person = self.data_generator.person()
         self.data_generator.note(
@@ -172,6 +259,7 @@ class ExpiredPersonRecordCheckTaskTest(task_tests_base.TaskTestsBase):
     def init_testbed_stubs(self):
         self.testbed.init_user_stub()
         self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
         path_to_app = os.path.join(os.path.dirname(__file__), '../../app')
         self.testbed.init_taskqueue_stub(root_path=path_to_app)
 
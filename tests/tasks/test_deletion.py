@@ -215,6 +215,55 @@ class ProcessExpirationsTaskTests(task_tests_base.TaskTestsBase):
         self.mox.UnsetStubs()
 
 
+    def test_task_sharding(self):
+        """Tests that the past-due records are split among shard tasks."""
+        # Advance past the grace periods of both self.p1 and self.p2.
+        utils.set_utcnow_for_test(datetime.datetime(2010, 3, 15))
+
+        shard_params = []
+        self.mox = mox.Mox()
+        self.mox.StubOutWithMock(taskqueue, 'add')
+        for _ in range(2):
+            taskqueue.add(name=mox.IsA(unicode),
+                          method='POST',
+                          url='/haiti/tasks/process_expirations',
+                          queue_name='expiry',
+                          params=mox.IgnoreArg()).WithSideEffects(
+                              lambda **kwargs: shard_params.append(
+                                  kwargs['params']))
+        self.mox.ReplayAll()
+        with mock.patch('tasksmodule.deletion.ProcessExpirationsTask.'
+                        'get_split_keys') as mock_get_split_keys:
+            mock_get_split_keys.return_value = [
+                max(self.key_p1, self.key_p2)]
+            self.run_task('/haiti/tasks/process_expirations',
+                          data={}, method='POST')
+        self.mox.VerifyAll()
+        self.mox.UnsetStubs()
+
+        # Nothing is processed until the shard tasks run, and they all use
+        # the time the first task ran.
+        assert [params['shard'] for params in shard_params] == [1, 2]
+        assert [params['now'] for params in shard_params] == [
+            '2010-03-15T00:00:00Z', '2010-03-15T00:00:00Z']
+        assert db.get(self.key_p1).is_expired is False
+        # A record that expires after the scan started is left for the next
+        # scan.
+        utils.set_utcnow_for_test(datetime.datetime(2010, 5, 1))
+        self.p3 = self.data_generator.person(
+            expiry_date=datetime.datetime(2010, 4, 1))
+        for params in shard_params:
+            self.run_task('/haiti/tasks/process_expirations',
+                          data=params, method='POST')
+
+        assert model.Person.all().count() == 0
+        assert db.get(self.key_p1).given_name is None
+        assert db.get(self.key_p2).given_name is None
+        assert db.get(self.n1_1.key()) is None
+        assert db.get(self.photo_key) is None
+        assert db.get(self.p3.key()).is_expired is False
+
+
 class CleanupStrayNotesTaskTests(task_tests_base.TaskTestsBase):
     """Tests the stray notes cleanup task."""
 
@@ -19,9 +19,13 @@ __author__ = 'ichikawa@google.com (Hiroshi Ichikawa)'
 import datetime
 import unittest
 
+import mock
+
 import api
+import importer
 import model
 import test_handler
+from testutils import pfif_stream
 
 from google.appengine.ext import testbed
 
@@ -65,3 +69,135 @@ class APITests(unittest.TestCase):
             home_state='California',
             entry_date=datetime.datetime(2010, 1, 1))
         assert handler.render_person(person) == 'John Smith / From: California'
+
+
+class WriteTests(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_user_stub()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_search_stub()
+        model.UniqueId.reset()
+        model.Repo(key_name='haiti').put()
+        model.Authorization.create(
+            'haiti', 'test_key',
+            domain_write_permission='test.google.com').put()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+        model.UniqueId.reset()
+
+    def post(self, body):
+        handler = test_handler.initialize_handler(
+            api.Write, 'api/write', params={'key': 'test_key'},
+            environ={'REQUEST_METHOD': 'POST', 'wsgi.url_scheme': 'https'})
+        handler.request.body = body
+        handler.post()
+        return handler.response
+
+    def make_document(self, num_persons, elements=''):
+        reader = pfif_stream.PfifReader(0, description_size=500)
+        return ('<pfif xmlns="http://zesty.ca/pfif/1.4">\n' + elements +
+                ''.join(map(reader.get_person_xml, range(num_persons))) +
+                '</pfif>\n')
+
+    def test_write_in_chunks(self):
+        # A Note ahead of its Person, a Note on no Person, and a Person in
+        # another domain, followed by more records than one read of the body.
+        elements = '''
+<note>
+  <note_record_id>test.google.com/note.early</note_record_id>
+  <person_record_id>test.google.com/person.149</person_record_id>
+  <source_date>2010-01-01T00:00:00Z</source_date>
+  <text>_test_text</text>
+</note>
+<note>
+  <note_record_id>test.google.com/note.orphan</note_record_id>
+  <person_record_id>test.google.com/person.missing</person_record_id>
+  <source_date>2010-01-01T00:00:00Z</source_date>
+  <text>_test_text</text>
+</note>
+<person>
+  <person_record_id>other.google.com/person.1</person_record_id>
+  <source_date>2010-01-01T00:00:00Z</source_date>
+  <full_name>_test_full_name</full_name>
+</person>
+'''
+        body = self.make_document(150, elements)
+        assert len(body) > 65536
+        with mock.patch.object(api, 'WRITE_CHUNK_SIZE', 2):
+            response = self.post(body)
+
+        assert response.status_int == 200
+        assert model.Person.all().count() == 150
+        assert model.Note.all().count() == 151
+        assert model.Note.get('haiti', 'test.google.com/note.early')
+        status = response.body.split('</status:write>')
+        assert '<status:parsed>151</status:parsed>' in status[0]
+        assert '<status:written>150</status:written>' in status[0]
+        assert 'other.google.com/person.1' in status[0]
+        assert '<status:parsed>152</status:parsed>' in status[1]
+        assert '<status:written>151</status:written>' in status[1]
+        assert 'test.google.com/note.orphan' in status[1]
+        assert 'test.google.com/note.early' not in status[1]
+
+    def test_write_note_before_stored_person(self):
+        # A Note on a stored Person, which the upload overwrites later.
+        model.Person.create_original_with_record_id(
+            'haiti', 'test.google.com/person.149',
+            full_name='_test_full_name',
+            entry_date=datetime.datetime(2010, 1, 1)).put()
+        elements = '''
+<note>
+  <note_record_id>test.google.com/note.early</note_record_id>
+  <person_record_id>test.google.com/person.149</person_record_id>
+  <source_date>2010-01-01T00:00:00Z</source_date>
+  <status>believed_alive</status>
+  <text>_test_text</text>
+</note>
+'''
+        body = self.make_document(150, elements)
+        assert len(body) > 65536
+        with mock.patch.object(api, 'WRITE_CHUNK_SIZE', 2):
+            response = self.post(body)
+
+        assert response.status_int == 200
+        person = model.Person.get('haiti', 'test.google.com/person.149')
+        assert person.description == 'x' * 500
+        assert person.latest_status == 'believed_alive'
+
+    def test_write_invalid_xml(self):
+        # The error is near the end, after more records than one read of the
+        # body; the chunks before the error are written.
+        body = self.make_document(150).replace('</pfif>', '</person></pfif>')
+        assert len(body) > 65536
+        with mock.patch.object(api, 'WRITE_CHUNK_SIZE', 2):
+            response = self.post(body)
+        assert response.status_int == 400
+        assert 'Invalid XML' in response.body
+        assert 0 < model.Person.all().count() < 150
+        assert model.Note.all().count() == model.Person.all().count()
+
+    def test_write_memory(self):
+        """Tests that memory use stays flat while importing a large upload:
+        the records held at each import are bounded by the chunk size and
+        the size of one read of the body, not by the size of the upload."""
+        live_record_counts = []
+        import_records = importer.import_records
+        def count_and_import_records(repo, domain, converter, *args, **kw):
+            if converter == importer.create_person:
+                live_record_counts.append(pfif_stream.count_live_records())
+            return import_records(repo, domain, converter, *args, **kw)
+
+        with mock.patch.object(api, 'WRITE_CHUNK_SIZE', 50):
+            with mock.patch.object(
+                importer, 'import_records', new=count_and_import_records):
+                response = self.post(self.make_document(1000))
+
+        assert response.status_int == 200
+        assert model.Person.all().count() == 1000
+        assert len(live_record_counts) >= 20
+        # 2000 records are imported in all.
+        assert max(live_record_counts) < 400, live_record_counts
@@ -0,0 +1,97 @@
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for config.py."""
+
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import config
+import utils
+
+
+class ConfigTests(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        config.cache.flush()
+
+    def tearDown(self):
+        utils.set_utcnow_for_test(None)
+        self.testbed.deactivate()
+
+    def put_entry_directly(self, key_name, value):
+        db.put(config.ConfigEntry(key_name=key_name, value=value))
+
+    def test_get_uses_cache(self):
+        config.set(analytics_id='abc')
+        assert config.get('analytics_id') == 'abc'
+        # Entries written behind the cache's back aren't visible until the
+        # cache is flushed.
+        self.put_entry_directly('*:analytics_id', '"def"')
+        assert config.get('analytics_id') == 'abc'
+        assert config.Configuration('*').analytics_id == 'abc'
+        config.cache.flush()
+        assert config.get('analytics_id') == 'def'
+
+    def test_set_invalidates_cache(self):
+        config.set(analytics_id='abc')
+        config.set_for_repo('haiti', test_mode=True)
+        assert config.Configuration('haiti').analytics_id == 'abc'
+        assert config.Configuration('haiti').test_mode
+        config.set_for_repo('haiti', test_mode=False)
+        config.set(analytics_id='def')
+        assert config.Configuration('haiti').analytics_id == 'def'
+        assert not config.Configuration('haiti').test_mode
+        assert config.get_for_repo('haiti', 'analytics_id') == 'def'
+
+    def test_version_change_invalidates_cache(self):
+        config.set(analytics_id='abc')
+        assert config.get('analytics_id') == 'abc'
+        self.put_entry_directly('*:analytics_id', '"def"')
+        # Another instance modifying the config bumps the shared version.
+        config.cache.delete('xyz')
+        assert config.get('analytics_id') == 'def'
+
+    def test_no_datastore_reads_when_cached(self):
+        config.set(analytics_id='abc')
+        config.Configuration('haiti')
+        miss_count = config.cache.miss_count
+        for _ in range(3):
+            config.Configuration('haiti')
+            config.get_for_repo('haiti', 'analytics_id')
+        assert config.cache.miss_count == miss_count
+
+    def test_version_checked_once_per_interval(self):
+        utils.set_utcnow_for_test(1000)
+        config.set(analytics_id='abc')
+        assert config.get('analytics_id') == 'abc'
+        # Simulate another instance changing the config.
+        self.put_entry_directly('*:analytics_id', '"def"')
+        memcache.set(config.cache.VERSION_MEMCACHE_KEY, 'xyz')
+        # The version in memcache isn't read again right away.
+        utils.set_utcnow_for_test(1004)
+        assert config.get('analytics_id') == 'abc'
+        utils.set_utcnow_for_test(1006)
+        assert config.get('analytics_id') == 'def'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -414,3 +414,94 @@ class FullTextSearchTests(unittest.TestCase):
         full_text_search.delete_record_from_index(self.p4)
         results = full_text_search.search('haiti',  {'name': 'Miki'}, 5)
         assert not results
+
+    def test_batch_index_writer(self):
+        persons = [self.p1, self.p2, self.p3, self.p4, self.p5]
+        db.put(persons)
+        original_batch_size = full_text_search.MAX_DOCUMENTS_PER_BATCH
+        full_text_search.MAX_DOCUMENTS_PER_BATCH = 2
+        try:
+            writer = full_text_search.BatchIndexWriter()
+            for person in persons:
+                writer.add(person)
+            # Full batches are written as soon as they fill up.
+            results = full_text_search.search('haiti', {'name': 'Yayoi'}, 5)
+            assert set([r.record_id for r in results]) == \
+                set(['haiti/0325', 'haiti/1202'])
+            results = full_text_search.search('haiti', {'name': 'Ami'}, 5)
+            assert not results
+            writer.flush()
+            results = full_text_search.search('haiti', {'name': 'Ami'}, 5)
+            assert set([r.record_id for r in results]) == set(['haiti/0522'])
+
+            with full_text_search.BatchIndexWriter() as writer:
+                writer.delete(self.p2)
+                writer.delete(self.p5)
+            results = full_text_search.search('haiti', {'name': 'Yayoi'}, 5)
+            assert set([r.record_id for r in results]) == set(['haiti/1202'])
+            results = full_text_search.search('haiti', {'name': 'Ami'}, 5)
+            assert not results
+        finally:
+            full_text_search.MAX_DOCUMENTS_PER_BATCH = original_batch_size
+
+    def test_create_document_deduplicates_values(self):
+        document = full_text_search.create_document(self.p6)
+        romanized_values = [
+            field.value.lower() for field in document.fields
+            if '_romanized_by_' in field.name and
+            not field.name.startswith('names_romanized_by_') and
+            not field.name.startswith('full_location_romanized_by_')]
+        # Latin text romanizes the same way with every method, but each
+        # value is indexed only once.
+        assert len(romanized_values) == len(set(romanized_values))
+        assert 'arao' in romanized_values
+        assert 'chihayakisaragi' in romanized_values
+        assert not [field for field in document.fields
+                    if '_for_rank_' in field.name]
+
+    def test_get_match_rank(self):
+        variants = full_text_search.get_query_word_variants('Rin Shibuya')
+        # A record with the query words in its name ranks higher than
+        # a record with one of them only in its location.
+        name_rank = full_text_search.get_match_rank(
+            variants, ['Rin:Shibuya'], ['shinjuku'])
+        location_rank = full_text_search.get_match_rank(
+            variants, ['Rin:Tosaka'], ['Shibuya'])
+        assert name_rank > location_rank
+
+    def test_search_with_many_location_matches(self):
+        # More Persons match the query only in their location than there
+        # are results wanted, but the one whose name matches is still found.
+        persons = []
+        for index, name in enumerate(['Haruka', 'Chihaya', 'Makoto']):
+            persons.append(model.Person.create_original_with_record_id(
+                'haiti', 'haiti/%d' % index, given_name=name,
+                family_name='Amami', full_name=name + ' Amami',
+                home_city='Kyoto', entry_date=TEST_DATETIME))
+        persons.append(model.Person.create_original_with_record_id(
+            'haiti', 'haiti/kyoto', given_name='Kyoto',
+            family_name='Hagiwara', full_name='Kyoto Hagiwara',
+            home_city='Tokyo', entry_date=TEST_DATETIME))
+        db.put(persons)
+        for person in persons:
+            full_text_search.add_record_to_index(person)
+
+        results = full_text_search.search('haiti', {'name': 'Kyoto'}, 2)
+        assert [r.record_id for r in results] == ['haiti/kyoto']
+
+        # The extra candidates are cut to max_results after ranking.
+        results = full_text_search.search(
+            'haiti', {'name': 'Amami', 'location': 'Kyoto'}, 2)
+        assert len(results) == 2
+        assert set(r.record_id for r in results) < set(
+            ['haiti/0', 'haiti/1', 'haiti/2'])
+
+    def test_query_matcher(self):
+        matcher = full_text_search.QueryMatcher('Rin Shibuya')
+        assert matcher.matches(['Rin:Shibuya', 'Tokyo'])
+        assert matcher.matches(['SHIBUYA', 'rin'])
+        assert not matcher.matches(['Rin:Tosaka'])
+        # An empty query matches everything.
+        assert full_text_search.QueryMatcher('').matches(['Rin:Tosaka'])
+        assert (full_text_search.is_query_match('Rin', ['Rin:Tosaka']) ==
+                full_text_search.QueryMatcher('Rin').matches(['Rin:Tosaka']))
@@ -18,7 +18,9 @@ import datetime
 import unittest
 
 from google.appengine.ext import db
+from google.appengine.ext import testbed
 from pytest import raises
+import mock
 
 import model
 import importer
@@ -44,6 +46,8 @@ class ImporterTests(unittest.TestCase):
     def tearDown(self):
         db.delete(model.Person.all())
         db.delete(model.Note.all())
+        db.delete(model.UsageCounter.all())
+        db.delete(model.CountDelta.all())
 
     def test_strip(self):
         assert importer.strip('') == ''
@@ -146,6 +150,98 @@ class ImporterTests(unittest.TestCase):
         assert note.record_id.startswith('haiti.%s/note.' % model.HOME_DOMAIN)
         assert note.person_record_id == 'test_domain/person_1'
 
+    def test_batch_writer_retries_failed_batches(self):
+        class FakeRpc(object):
+            def __init__(self, error):
+                self.error = error
+            def get_result(self):
+                if self.error:
+                    raise self.error
+
+        put_batches = []
+        def put_async(batch):
+            put_batches.append(list(batch))
+            # The first put of batch 'b' fails.
+            fail = batch == ['b'] and put_batches.count(['b']) == 1
+            return FakeRpc(db.Timeout('timeout') if fail else None)
+
+        original_put_async = importer.db.put_async
+        importer.db.put_async = put_async
+        try:
+            written_batches = []
+            writer = importer.BatchWriter(max_in_flight=2, backoff_seconds=0)
+            for batch in [['a'], ['b'], ['c'], ['d', 'e']]:
+                writer.put(batch, lambda batch=batch:
+                           written_batches.append(batch))
+            assert writer.flush() == 5
+        finally:
+            importer.db.put_async = original_put_async
+        # Only the failed batch is put again.
+        assert put_batches == [['a'], ['b'], ['c'], ['b'], ['d', 'e']]
+        assert sorted(written_batches) == [['a'], ['b'], ['c'], ['d', 'e']]
+        assert writer.retry_count == 1
+        assert writer.failed == 0
+
+    def test_import_context(self):
+        context = importer.ImportContext('haiti')
+        ids = [context.create_id() for _ in range(7)]
+        assert len(set(ids)) == 7
+        assert model.UniqueId.create_id() not in ids
+
+        # Original records get distinct IDs from the context.
+        records = [{'given_name': 'given_name_%d' % i,
+                    'family_name': 'family_name_%d' % i} for i in range(5)]
+        written, skipped, total = importer.import_records(
+            'haiti', 'haiti.' + model.HOME_DOMAIN, importer.create_person,
+            records, context=context)
+        assert written == 5
+        assert not skipped
+        record_ids = [p.record_id for p in model.Person.all()]
+        assert len(set(record_ids)) == 5
+        for record_id in record_ids:
+            assert record_id.startswith(
+                'haiti.%s/person.' % model.HOME_DOMAIN)
+
+    def test_import_increments_usage_counters(self):
+        domain = 'haiti.' + model.HOME_DOMAIN
+        persons = [{'given_name': 'given_name_%d' % i,
+                    'family_name': 'family_name_%d' % i} for i in range(3)]
+        # A record with a record ID isn't a new original record.
+        persons.append({'given_name': 'given_name',
+                        'family_name': 'family_name',
+                        'person_record_id': domain + '/person.123',
+                        'source_date': '2010-01-01T01:23:45Z'})
+        importer.import_records(
+            'haiti', domain, importer.create_person, persons)
+        person_record_id = model.Person.all().get().record_id
+        notes = [{'person_record_id': person_record_id,
+                  'source_date': '2010-01-01T01:23:45Z',
+                  'status': status}
+                 for status in ['believed_alive', 'believed_alive', '']]
+        importer.import_records(
+            'haiti', domain, importer.create_note, notes)
+        counter = model.UsageCounter.get('haiti')
+        assert counter.person == 3
+        assert counter.note == 3
+        assert counter.believed_alive == 2
+        assert counter.unspecified == 1
+
+    def test_import_records_count_deltas(self):
+        records = [{'given_name': 'given_name',
+                    'family_name': 'family_name',
+                    'sex': sex,
+                    'person_record_id': 'test_domain/person.1',
+                    'source_date': '2010-01-01T01:23:45Z'}
+                   for sex in ['female', 'male']]
+        for record in records:
+            importer.import_records(
+                'haiti', 'test_domain', importer.create_person, [record])
+        # The second import replaced the first record.
+        deltas = model.CountDelta.get_totals('haiti', 'person')
+        assert deltas['all'] == 1
+        assert deltas['sex=female'] == 0
+        assert deltas['sex=male'] == 1
+
     def test_import_person_records(self):
         records = []
         for i in range(20):
@@ -458,5 +554,178 @@ class ImporterTests(unittest.TestCase):
         assert total == 1
         assert model.Note.all().count() == 0
 
+    def test_import_duplicate_note_records(self):
+        put_dummy_person_record('haiti', 'test_domain/person_0')
+        put_dummy_person_record('haiti', 'test_domain/person_1')
+        records = [{
+            'person_record_id': 'test_domain/person_%d' % (i % 2),
+            'note_record_id': 'test_domain/record_%d' % i,
+            'source_date': '2010-01-01T01:23:45Z',
+            'text': 'text_%d' % (i % 3),
+        } for i in range(6)]
+        written, skipped, total = importer.import_records(
+            'haiti', 'test_domain', importer.create_note, records[:3])
+        assert written == 3
+
+        # Only the note with a new person and text combination is written.
+        new_records = [dict(record, note_record_id=record['note_record_id'] +
+                            '_new') for record in records]
+        written, skipped, total = importer.import_records(
+            'haiti', 'test_domain', importer.create_note, new_records,
+            omit_duplicate_notes=True)
+        assert total == 6
+        assert len(skipped) == 3
+        assert all(message == 'This is a duplicate of an existing note'
+                   for message, fields in skipped)
+        assert written == 3
+        assert model.Note.all().count() == 6
+
+    def test_filter_new_notes(self):
+        put_dummy_person_record('haiti', 'test_domain/person_0')
+        note = importer.create_note('haiti', {
+            'person_record_id': 'test_domain/person_0',
+            'note_record_id': 'test_domain/record_0',
+            'source_date': '2010-01-01T01:23:45Z'})
+        note.put()
+        new_note = importer.create_note('haiti', {
+            'person_record_id': 'test_domain/person_0',
+            'note_record_id': 'test_domain/record_1',
+            'source_date': '2010-01-01T01:23:45Z'})
+        new_notes = importer.filter_new_notes([note, new_note], 'haiti')
+        assert [n.record_id for n in new_notes] == ['test_domain/record_1']
+
+
+class BackgroundImportTests(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_user_stub()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_search_stub()
+        model.UniqueId.reset()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+        model.UniqueId.reset()
+
+    def test_line_reader(self):
+        lines = importer.LineReader(['a,b\nc', ',d\n\ne,', 'f'])
+        assert lines.next() == 'a,b\n'
+        assert lines.offset == 4
+        assert list(lines) == ['c,d\n', '\n', 'e,f']
+        assert lines.offset == 12
+
+    def test_find_header_end(self):
+        content = 'time_zone_offset\n9\nperson_record_id,full_name\nx,y\n'
+        assert importer.find_header_end(content) == content.index('x,y')
+
+    def test_run_import_job(self):
+        rows = ['person_record_id,full_name,source_date']
+        for i in range(5):
+            rows.append('test.domain/person_%d,Name %d,2010-01-01T00:00:00Z' %
+                        (i, i))
+        content = '\n'.join(rows) + '\n'
+
+        original_chunk_size = model.ImportJob.CHUNK_SIZE
+        original_chunks_per_put = model.ImportJob.CHUNKS_PER_PUT
+        original_batch_size = importer.BACKGROUND_IMPORT_BATCH_SIZE
+        # Exercise writing the chunks in several puts, and reading across
+        # chunk boundaries.
+        model.ImportJob.CHUNK_SIZE = 16
+        model.ImportJob.CHUNKS_PER_PUT = 2
+        importer.BACKGROUND_IMPORT_BATCH_SIZE = 2
+        try:
+            job = model.ImportJob.create(
+                'haiti', content, format='persons',
+                source_domain='test.domain',
+                header_end=importer.find_header_end(content))
+            assert model.ImportJobChunk.all().count() == (
+                len(content) + 15) // 16
+
+            # Import two records, then stop as if the task ran out of time.
+            assert not importer.run_import_job(job, datetime.datetime.min)
+            job = model.ImportJob.get('haiti', job.job_id)
+            assert job.persons_written == 2
+            assert job.offset == content.index('test.domain/person_2')
+
+            # Resume from the checkpoint.
+            assert importer.run_import_job(job, datetime.datetime.max)
+        finally:
+            model.ImportJob.CHUNK_SIZE = original_chunk_size
+            model.ImportJob.CHUNKS_PER_PUT = original_chunks_per_put
+            importer.BACKGROUND_IMPORT_BATCH_SIZE = original_batch_size
+        job = model.ImportJob.get('haiti', job.job_id)
+        assert job.status == model.ImportJob.Status.DONE
+        assert job.persons_written == 5
+        assert job.total == 5
+        assert not job.skipped
+        assert model.Person.all().count() == 5
+        assert not model.ImportJobChunk.all().count()
+
+    def test_run_import_job_notes_after_persons(self):
+        rows = ['person_record_id,full_name,source_date,note_record_id,text']
+        # A Note on a Person that comes later in the file.
+        rows.append('test.domain/person_4,,2010-01-01T00:00:00Z,'
+                    'test.domain/note_0,Found')
+        for i in range(5):
+            rows.append('test.domain/person_%d,Name %d,'
+                        '2010-01-01T00:00:00Z,,' % (i, i))
+        content = '\n'.join(rows) + '\n'
+        with mock.patch.object(importer, 'BACKGROUND_IMPORT_BATCH_SIZE', 2):
+            job = model.ImportJob.create(
+                'haiti', content, format='persons',
+                source_domain='test.domain',
+                header_end=importer.find_header_end(content))
+            assert importer.run_import_job(job, datetime.datetime.max)
+        job = model.ImportJob.get('haiti', job.job_id)
+        assert job.status == model.ImportJob.Status.DONE
+        assert job.persons_written == 5
+        assert job.notes_written == 1
+        assert not job.skipped
+        note = model.Note.get('haiti', 'test.domain/note_0')
+        assert note.person_record_id == 'test.domain/person_4'
+
+    def test_run_import_job_retried_batch(self):
+        put_dummy_person_record('haiti', 'test.domain/person_0')
+        rows = ['person_record_id,source_date,text']
+        for i in range(3):
+            rows.append(
+                'test.domain/person_0,2010-01-01T00:00:00Z,Note %d' % i)
+        content = '\n'.join(rows) + '\n'
+        job = model.ImportJob.create(
+            'haiti', content, format='notes', source_domain='test.domain',
+            header_end=importer.find_header_end(content))
+
+        # The task is interrupted after writing the Notes, but before the
+        # checkpoint.
+        import_records = importer.import_records
+        def import_records_and_fail(*args, **kwargs):
+            import_records(*args, **kwargs)
+            if args[2] == importer.create_note:
+                raise ImportInterrupted()
+        with mock.patch.object(
+            importer, 'import_records', new=import_records_and_fail):
+            with raises(ImportInterrupted):
+                importer.run_import_job(job, datetime.datetime.max)
+        assert model.Note.all().count() == 3
+        job = model.ImportJob.get('haiti', job.job_id)
+        assert job.notes_written == 0
+        assert len(job.batch_ids) == 3
+
+        # The Notes imported again get the same record IDs, so they
+        # overwrite the Notes already written instead of adding more.
+        assert importer.run_import_job(job, datetime.datetime.max)
+        job = model.ImportJob.get('haiti', job.job_id)
+        assert job.status == model.ImportJob.Status.DONE
+        assert job.notes_written == 3
+        assert not job.skipped
+        assert model.Note.all().count() == 3
+
+
+class ImportInterrupted(Exception):
+    pass
+
+
 if __name__ == "__main__":
     unittest.main()
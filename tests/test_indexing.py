@@ -18,9 +18,11 @@
 __author__ = 'eyalf@google.com (Eyal Fink)'
 
 from google.appengine.ext import db
+import config
 import datetime
 import indexing
 import logging
+import mock
 import model
 import sys
 import unittest
@@ -81,6 +83,25 @@ class IndexingTests(unittest.TestCase):
         assert ['%s %s'%(p.given_name, p.family_name) for p in sorted] == \
             ['abc efg', 'ABC EFG', 'ABC efghij']
 
+    def test_rank_and_order_same_names(self):
+        # Persons with the same name are ranked as equal, and stay together
+        # in their original order, even if one of them has an alternate name
+        # that would rank it higher on its own.
+        res = [create_person(given_name='Bryan', family_name='abc'),
+               create_person(given_name='Bryan', family_name='efg'),
+               create_person(given_name='Bryan', family_name='abc'),
+               create_person(given_name='Bryan', family_name='abc')]
+        res[2].alternate_names = 'efg'
+        ids = [p.record_id for p in res]
+
+        sorted = indexing.rank_and_order(list(res), TextQuery('efg'), 100)
+        assert [p.record_id for p in sorted] == [
+            ids[1], ids[0], ids[2], ids[3]]
+
+        sorted = indexing.rank_and_order(list(res), TextQuery('Bryan'), 100)
+        assert [p.record_id for p in sorted] == [
+            ids[0], ids[2], ids[3], ids[1]]
+
     def test_cjk_ranking_1(self):
         # This is Jackie Chan's Chinese name.  His family name is CHAN and given
         # name is KONG + SANG; the usual Chinese order is CHAN + KONG + SANG.
@@ -246,6 +267,90 @@ class IndexingTests(unittest.TestCase):
         assert self.get_matches(u'\u4f59\u5609\u5e73') == \
             [(u'\u5609\u5e73', u'\u4f59')]
 
+    def test_name_index_lookup(self):
+        index = indexing.NameIndex('test')
+        index.update('a', ['x', 'y', 'z'])
+        index.update('b', ['y', 'z'])
+        index.update('c', ['z'])
+        assert index.lookup(['z']) == ['a', 'b', 'c']
+        assert index.lookup(['y', 'z']) == ['a', 'b']
+        assert index.lookup(['x', 'y', 'z']) == ['a']
+        assert index.lookup(['w', 'z']) == []
+        assert index.lookup([]) == []
+
+        # Updates replace the previously indexed tokens.
+        index.update('a', ['w'])
+        assert index.lookup(['z']) == ['b', 'c']
+        assert index.lookup(['w']) == ['a']
+        index.remove('b')
+        assert index.lookup(['y']) == []
+        assert index.lookup(['z']) == ['c']
+
+    def test_search_with_name_index(self):
+        config.set(enable_name_index=True)
+        try:
+            self.add_persons(
+                create_person(given_name='Bryan', family_name='abc'),
+                create_person(given_name='abc', family_name='Bryan'),
+                create_person(given_name=u'\u4f59\u5609\u5e73',
+                              family_name='foo'))
+            assert self.get_matches('Bryan abc') == [
+                ('Bryan', 'abc'), ('abc', 'Bryan')]
+            assert self.get_matches(u'\u5e73\u5609') == \
+                [(u'\u4f59\u5609\u5e73', 'foo')]
+
+            # Records written after the index was built are picked up.
+            person = create_person(given_name='Bryan', family_name='xyz')
+            self.add_persons(person)
+            assert self.get_matches('Bryan xyz') == [('Bryan', 'xyz')]
+
+            # Deleted records no longer match.
+            db.delete(person)
+            assert self.get_matches('Bryan xyz') == []
+        finally:
+            config.set(enable_name_index=False)
+            indexing._name_indexes.clear()
+
+    def test_search_while_building_name_index(self):
+        config.set(enable_name_index=True)
+        try:
+            self.add_persons(
+                create_person(given_name='Bryan', family_name='abc'),
+                create_person(given_name='abc', family_name='Bryan'),
+                create_person(given_name='Bryan', family_name='xyz'))
+            with mock.patch.object(
+                indexing.NameIndex, 'REFRESH_BATCH_SIZE', 1):
+                with mock.patch.object(
+                    indexing.NameIndex, 'MAX_REFRESH_BATCHES_PER_SEARCH', 1):
+                    # Each search reads one more Person into the index, and
+                    # the datastore is searched until the index is complete.
+                    for i in range(3):
+                        assert self.get_matches('Bryan abc') == [
+                            ('Bryan', 'abc'), ('abc', 'Bryan')]
+                        index = indexing._name_indexes['test']
+                        assert len(index.lookup(['BRYAN'])) == i + 1
+                    # The next refresh finds that the index has caught up.
+                    assert indexing.get_name_index('test') is index
+                    assert len(index.lookup(['BRYAN'])) == 3
+        finally:
+            config.set(enable_name_index=False)
+            indexing._name_indexes.clear()
+
+    def test_name_index_too_large(self):
+        config.set(enable_name_index=True)
+        try:
+            self.add_persons(
+                create_person(given_name='Bryan', family_name='abc'),
+                create_person(given_name='abc', family_name='Bryan'))
+            with mock.patch.object(indexing.NameIndex, 'MAX_PERSONS', 1):
+                assert self.get_matches('Bryan abc') == [
+                    ('Bryan', 'abc'), ('abc', 'Bryan')]
+                assert indexing.get_name_index('test') is None
+                assert indexing._name_indexes['test'].too_large
+        finally:
+            config.set(enable_name_index=False)
+            indexing._name_indexes.clear()
+
     def test_no_query_terms(self):
         # Regression test (this used to throw an exception).
         assert indexing.search('test', TextQuery(''), 100) == []
@@ -15,8 +15,14 @@
 """Tests for model.py."""
 
 from datetime import datetime
+from google.appengine.api import memcache
 from google.appengine.ext import db
+import threading
 import unittest
+
+import mock
+
+import config
 import model
 from utils import get_utcnow, set_utcnow_for_test
 
@@ -276,6 +282,49 @@ class ModelTests(unittest.TestCase):
         assert p1_linked_ids == p2_linked_ids
         assert p1_linked_ids == p3_linked_ids
 
+    def test_get_notes_by_person_record_ids(self):
+        # A note entered later but with an earlier source_date comes first.
+        n1_0 = model.Note.create_original(
+            'haiti',
+            person_record_id=self.p1.record_id,
+            entry_date=get_utcnow(),
+            source_date=datetime(1999, 1, 1))
+        db.put(n1_0)
+        self.to_delete.append(n1_0)
+
+        record_ids = [self.p1.record_id, self.p2.record_id,
+                      'haiti.personfinder.google.org/x']
+        # Run the queries in more than one group.
+        with mock.patch.object(model.Note, 'MAX_PARALLEL_QUERIES', 2):
+            notes = model.Note.get_by_person_record_ids('haiti', record_ids)
+        assert sorted(notes.keys()) == sorted(record_ids)
+        # The notes for each person are the same as, and in the same order
+        # as, the ones from get_by_person_record_id.
+        for record_id in record_ids:
+            assert [note.key() for note in notes[record_id]] == [
+                note.key() for note in
+                model.Note.get_by_person_record_id('haiti', record_id)]
+        assert notes[self.p1.record_id][0].key() == n1_0.key()
+        assert notes['haiti.personfinder.google.org/x'] == []
+
+    def test_get_all(self):
+        record_ids = [self.p3.record_id, 'haiti.personfinder.google.org/x',
+                      self.p1.record_id, self.p2.record_id]
+        # Results come back in the requested order, without missing records,
+        # even when they are fetched in several batches.
+        for limit in [1, 2, 200]:
+            persons = model.Person.get_all('haiti', record_ids, limit=limit)
+            assert [p.record_id for p in persons] == [
+                self.p3.record_id, self.p1.record_id, self.p2.record_id]
+
+        self.p1.is_expired = True
+        db.put(self.p1)
+        persons = model.Person.get_all(
+            'haiti', record_ids, filter_expired=True)
+        assert [p.record_id for p in persons] == [
+            self.p3.record_id, self.p2.record_id]
+        assert len(model.Person.get_all('haiti', record_ids)) == 3
+
 
     def test_subscription(self):
         sd = 'haiti'
@@ -369,6 +418,171 @@ class ModelTests(unittest.TestCase):
         counter.increment(u'arbitrary \xef characters \u5e73 here')
         counter.put()  # without encode_count_name, this threw an exception
 
+    def test_counter_initialize(self):
+        counter = model.Counter.create('haiti', 'note')
+        counter.initialize(model.REVIEW_COUNT_NAMES)
+        counter.increment('hidden=TRUE')
+        # Initializing again doesn't reset existing counts.
+        counter.initialize(model.REVIEW_COUNT_NAMES)
+        counter.finish()
+        counter.put()
+        self.to_delete.append(counter)
+
+        counter = model.Counter.get_latest_finished('haiti', 'note')
+        assert counter.get('hidden=TRUE') == 1
+        assert counter.get('hidden=FALSE,reviewed=TRUE') == 0
+        assert all(counter.has(name) for name in model.REVIEW_COUNT_NAMES)
+        assert not counter.has('status=believed_alive')
+
+    def test_count_deltas(self):
+        def get_deltas(scan_name):
+            return model.CountDelta.get_totals('haiti', scan_name)
+        person_deltas = get_deltas('person')
+        note_deltas = get_deltas('note')
+        def get_change(scan_name, count_name):
+            before = {'person': person_deltas, 'note': note_deltas}[scan_name]
+            return (get_deltas(scan_name).get(count_name, 0) -
+                    before.get(count_name, 0))
+
+        # A Counter saves the deltas as of the end of its scan.
+        counter = model.Counter.get_unfinished_or_create('haiti', 'person')
+        counter.increment('all')
+        counter.finish()
+        counter.put()
+        self.to_delete.append(counter)
+
+        person = model.Person.create_original(
+            'haiti',
+            given_name='New',
+            family_name='Person',
+            sex='female',
+            author_email='new.person@example.com',
+            entry_date=datetime(2010, 1, 1),
+            expiry_date=datetime(2010, 2, 1))
+        person.put_new()
+        note = model.Note.create_original(
+            'haiti',
+            person_record_id=person.record_id,
+            status=u'believed_alive',
+            entry_date=datetime(2010, 1, 2),
+            source_date=datetime(2010, 1, 2))
+        note.put_new()
+        self.to_delete += [person, note]
+        self.to_delete.extend(model.UsageCounter.get_shards('haiti'))
+        assert get_change('person', 'all') == 1
+        assert get_change('person', 'sex=female') == 1
+        assert get_change('person', 'author_email') == 1
+        assert get_change('note', 'all') == 1
+        assert get_change('note', 'status=believed_alive') == 1
+        assert get_change('note', 'hidden=FALSE,reviewed=FALSE') == 1
+
+        # Changes to the review state move the Note between counts.
+        review_count_name = model.get_review_count_name(note)
+        note.reviewed = True
+        note.put()
+        model.add_review_count_deltas('haiti', [(note, review_count_name)])
+        assert get_change('note', 'hidden=FALSE,reviewed=FALSE') == 0
+        assert get_change('note', 'hidden=FALSE,reviewed=TRUE') == 1
+
+        # The finished scan's counts are adjusted by the deltas since the
+        # scan finished.
+        memcache.flush_all()
+        assert model.Counter.get_count('haiti', 'person.all') == 2
+
+        # Expired records are no longer counted.
+        set_utcnow_for_test(datetime(2010, 2, 3))
+        person.put_expiry_flags()
+        assert get_change('person', 'all') == 0
+        assert get_change('person', 'sex=female') == 0
+        assert get_change('note', 'all') == 0
+        assert get_change('note', 'hidden=FALSE,reviewed=TRUE') == 0
+
+        # Deleting the expired records doesn't change the counts.
+        person.delete_related_entities(delete_self=True)
+        assert get_change('person', 'all') == 0
+        assert get_change('note', 'all') == 0
+        self.to_delete.extend(model.CountDelta.all())
+
+    def test_repo_directory(self):
+        haiti = model.Repo(key_name='haiti',
+                           activation_status=model.Repo.ActivationStatus.ACTIVE)
+        haiti.put()
+        self.to_delete.append(haiti)
+        config.set_for_repo('haiti', repo_titles={'en': 'Haiti'},
+                            test_mode=True)
+        assert 'haiti' in model.Repo.list()
+        assert 'haiti' in model.Repo.list_launched()
+        [info] = [info for info in model.repo_directory.get_repos()
+                  if info.repo == 'haiti']
+        assert info.get_title('fr') == 'Haiti'
+        assert info.test_mode
+
+        # Writing a Repo refreshes the directory.
+        haiti.activation_status = model.Repo.ActivationStatus.DEACTIVATED
+        haiti.put()
+        assert 'haiti' in model.Repo.list()
+        assert 'haiti' not in model.Repo.list_active()
+        assert 'haiti' not in model.Repo.list_launched()
+
+        # Changing the config refreshes the directory.
+        config.set_for_repo('haiti', test_mode=False)
+        [info] = [info for info in model.repo_directory.get_repos()
+                  if info.repo == 'haiti']
+        assert not info.test_mode
+        db.delete(config.ConfigEntry.get_by_key_name(
+            ['haiti:repo_titles', 'haiti:test_mode']))
+        config.cache.flush()
+
+        haiti.delete()
+        self.to_delete.remove(haiti)
+        assert 'haiti' not in model.Repo.list()
+
+    def test_usage_counter(self):
+        assert model.UsageCounter.get('haiti') is None
+        assert model.UsageCounter.get_totals('haiti') == {}
+
+        # The counter written before sharding is summed with the shards.
+        counter = model.UsageCounter.create('haiti')
+        counter.person = 2
+        counter.put()
+        for _ in range(10):
+            model.UsageCounter.increment_counter('haiti', ['person'])
+        model.UsageCounter.increment_counters(
+            'haiti', {'note': 3, 'believed_alive': 3, 'unspecified': 0})
+        shards = model.UsageCounter.get_shards('haiti')
+        self.to_delete.extend(shards)
+        assert len(shards) > 1
+        assert model.UsageCounter.get('haiti').person == 12
+        assert model.UsageCounter.get_totals('haiti') == {
+            'person': 12, 'note': 3, 'believed_alive': 3}
+
+        # Incrementing drops the cached totals.
+        model.UsageCounter.increment_counter('haiti', ['person'])
+        self.to_delete.extend(model.UsageCounter.get_shards('haiti'))
+        assert model.UsageCounter.get_totals('haiti')['person'] == 13
+
+    def test_unique_id_concurrent_create_id(self):
+        ids = []
+        def create_ids():
+            for _ in range(50):
+                ids.append(model.UniqueId.create_id())
+
+        # Use small blocks so that the threads share and refill many of them.
+        with mock.patch.object(model.UniqueId, 'BLOCK_SIZE', 7):
+            model.UniqueId.reset()
+            threads = [threading.Thread(target=create_ids) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert len(ids) == 400
+            assert len(set(ids)) == 400
+            # IDs allocated directly never overlap the ones handed out.
+            assert not set(model.UniqueId.create_ids(10)) & set(ids)
+            assert model.UniqueId.create_id() not in ids
+        # No entities are written to get the IDs.
+        assert model.UniqueId.all().count() == 0
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -22,6 +22,8 @@ import pprint
 import sys
 import unittest
 
+from testutils import pfif_stream
+
 # utility function duplicated here from server_tests.
 # TODO(lschumacher): find a happy place to share this.
 def text_diff(expected, actual):
@@ -849,6 +851,33 @@ TEST_CASES.append((
 </pfif:pfif>
 ''', [PERSON_RECORD_WITH_NON_ASCII], [])))
 
+# A PFIF document with elements from another namespace.  The text of elements
+# that aren't PFIF fields is ignored, including elements nested in fields.
+TEST_CASES.append((
+    'PFIF 1.4 with unknown elements',
+    PFIFTestCase('1.4', '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<pfif:pfif xmlns:pfif="http://zesty.ca/pfif/1.4" xmlns:x="http://example.com/x">
+  <pfif:person>
+    <pfif:person_record_id>test.google.com/person.456</pfif:person_record_id>
+    <pfif:full_name>first &amp; <x:b>ignored</x:b>second</pfif:full_name>
+    <x:extension>ignored</x:extension>
+    <pfif:note>
+      <pfif:note_record_id>test.google.com/note.789</pfif:note_record_id>
+      <pfif:text>line one
+line two</pfif:text>
+    </pfif:note>
+  </pfif:person>
+</pfif:pfif>
+''', [{
+    u'person_record_id': u'test.google.com/person.456',
+    u'full_name': u'first & second',
+}], [{
+    u'note_record_id': u'test.google.com/note.789',
+    u'person_record_id': u'test.google.com/person.456',
+    u'text': u'line one\nline two',
+}], do_write_test=False)))
+
 
 class PfifTests(unittest.TestCase):
     """Iterates over the TestCases and tests reading, writing, and parsing."""
@@ -893,6 +922,44 @@ class PfifTests(unittest.TestCase):
             assert note_records == test_case.note_records, (test_name +
                 ':\n' + pprint_diff(test_case.note_records, note_records))
 
+    def test_parse_file_in_chunks(self):
+        """Tests that parsing in chunks gives the same records as parse_file,
+        wherever the reads happen to split the XML."""
+        for test_name, test_case in TEST_CASES:
+            if not test_case.do_parse_test:
+                continue
+            for chunk_size, read_size in [(1, 7), (2, 64), (100, 65536)]:
+                person_records, note_records = [], []
+                for persons, notes in pfif.parse_file_in_chunks(
+                    StringIO.StringIO(test_case.xml), chunk_size,
+                    read_size=read_size):
+                    assert persons or notes
+                    person_records += persons
+                    note_records += notes
+                assert person_records == test_case.person_records, (
+                    test_name + ':\n' +
+                    pprint_diff(test_case.person_records, person_records))
+                assert note_records == test_case.note_records, (
+                    test_name + ':\n' +
+                    pprint_diff(test_case.note_records, note_records))
+
+    def test_parse_file_in_chunks_memory(self):
+        """Tests that memory use stays flat while parsing a large file in
+        chunks, as long as the caller lets go of each chunk."""
+        live_record_counts = []
+        num_records = 0
+        for persons, notes in pfif.parse_file_in_chunks(
+            pfif_stream.PfifReader(5000), 100, read_size=4096):
+            assert len(persons) + len(notes) < 200
+            num_records += len(persons) + len(notes)
+            del persons, notes
+            if len(live_record_counts) < num_records / 2500:
+                live_record_counts.append(pfif_stream.count_live_records())
+        assert num_records == 10000
+        assert len(live_record_counts) == 4
+        # Only records not yet handed out in a chunk are kept.
+        assert max(live_record_counts) < 200, live_record_counts
+
     def test_write_file(self):
         """Tests writing of XML files for each test case."""
         for test_name, test_case in TEST_CASES:
@@ -58,6 +58,26 @@ class RamCacheTests(unittest.TestCase):
         cache.clear()
         assert cache.get('a') is None
 
+    def test_least_recently_used_evicted(self):
+        cache = resources.RamCache(max_size=2)
+        cache.put('a', 'b', 10)
+        cache.put('c', 'd', 10)
+        assert cache.get('a') == 'b'
+        cache.put('e', 'f', 10)
+        assert cache.get('c') is None
+        assert cache.get('a') == 'b'
+        assert cache.get('e') == 'f'
+        assert cache.evict_count == 1
+        assert cache.hit_count == 3
+        assert cache.miss_count == 1
+
+    def test_missing_is_cached(self):
+        cache = resources.RamCache()
+        cache.put('a', resources.RamCache.MISSING, 10)
+        assert cache.get('a') is resources.RamCache.MISSING
+        utils.set_utcnow_for_test(10.01)
+        assert cache.get('a') is None
+
 
 class ResourcesTests(unittest.TestCase):
     def setUp(self):
@@ -206,6 +226,22 @@ class ResourcesTests(unittest.TestCase):
         assert get_localized('static.html', 'fr').content == 'bonjour'
         assert self.fetched == []
 
+    def test_get_localized_caches_misses(self):
+        get_localized = resources.get_localized
+        self.fetched = []
+        assert get_localized('nonexistent.html', 'fr') is None
+        assert self.fetched == ['nonexistent.html:fr', 'nonexistent.html']
+
+        # The miss should be cached, and shouldn't touch the datastore.
+        self.fetched = []
+        assert get_localized('nonexistent.html', 'fr') is None
+        assert self.fetched == []
+
+        # A new resource is picked up once the cached miss expires.
+        self.put_resource('1', 'nonexistent.html', 10, 'found')
+        utils.set_utcnow_for_test(resources.MISSING_CACHE_SECONDS + 1)
+        assert get_localized('nonexistent.html', 'fr').content == 'found'
+
     def test_get_rendered(self):
         get_rendered = resources.get_rendered
         eq = self.assertEquals
@@ -50,6 +50,32 @@ class ScriptVariantTests(unittest.TestCase):
             [u'KIKUCHIMAKOTO'])
         assert script_variant.romanize_word_by_unidecode(u'') == [u'']
 
+    def test_romanization_cache(self):
+        cache = script_variant.RomanizationCache(max_size=2)
+        calls = []
+        @cache.memoize
+        def romanize(word):
+            calls.append(word)
+            return [word.upper()]
+
+        assert romanize(u'a') == [u'A']
+        assert romanize(u'a') == [u'A']
+        assert calls == [u'a']
+        assert (cache.hit_count, cache.miss_count) == (1, 1)
+
+        # Callers can modify the returned list without affecting the cache.
+        romanize(u'a').append(u'B')
+        assert romanize(u'a') == [u'A']
+
+        # The least recently used entry is evicted when the cache is full.
+        romanize(u'b')
+        romanize(u'a')
+        romanize(u'c')
+        assert cache.evict_count == 1
+        romanize(u'a')
+        romanize(u'b')
+        assert calls == [u'a', u'b', u'c', u'b']
+
     def test_romanize_search_query(word):
         results = script_variant.romanize_search_query(u'天海')
         # Two possible Japanese romanizations.
@@ -54,6 +54,7 @@ class TasksTests(unittest.TestCase):
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_memcache_stub()
         self.testbed.init_taskqueue_stub()
+        model.UniqueId.reset()
         model.Repo(key_name='haiti').put()
 
         logging.basicConfig(level=logging.INFO, stream=sys.stderr)
@@ -111,6 +112,7 @@ class TasksTests(unittest.TestCase):
 
     def tearDown(self):
         self.testbed.deactivate()
+        model.UniqueId.reset()
         db.delete(self.to_delete)
         if self.mox:
             self.mox.UnsetStubs()
@@ -252,6 +254,51 @@ class TasksTests(unittest.TestCase):
         self.mox.UnsetStubs()
         self.mox.VerifyAll()
 
+    def test_count_person(self):
+        """Tests that CountPerson counts Persons and Notes in one pass."""
+        n1_2 = model.Note.create_original(
+            'haiti',
+            person_record_id=self.p1.record_id,
+            status=u'believed_alive',
+            entry_date=get_utcnow(),
+            source_date=datetime.datetime(2010, 1, 3))
+        # A Note on a Person that doesn't exist is counted only as a Note.
+        n3_1 = model.Note.create_original(
+            'haiti',
+            person_record_id=self.p1.record_id + '0',
+            entry_date=get_utcnow(),
+            source_date=datetime.datetime(2010, 1, 3))
+        db.put([n1_2, n3_1])
+        self.to_delete += [n1_2, n3_1]
+
+        handler = test_handler.initialize_handler(
+            tasks.CountPerson, tasks.CountPerson.ACTION)
+        # Scan one Person per batch, so that the Notes are counted in
+        # several ranges of person_record_id.
+        original_fetch_limit = tasks.FETCH_LIMIT
+        tasks.FETCH_LIMIT = 1
+        try:
+            counter = handler.get_counter()
+            while tasks.run_count(
+                handler.make_query, handler.update_counter, counter):
+                handler.finish_batch()
+                counter.put()
+            handler.finish_batch()
+            counter.put()
+        finally:
+            tasks.FETCH_LIMIT = original_fetch_limit
+
+        def get_count(name):
+            return model.Counter.get_count('haiti', name)
+        assert get_count('person.all') == 2
+        assert get_count('person.num_notes=2') == 1
+        assert get_count('person.num_notes=0') == 1
+        assert get_count('person.linked_persons=1') == 1
+        assert get_count('person.linked_persons=0') == 1
+        assert get_count('note.all') == 3
+        assert get_count('note.status=believed_alive') == 1
+        assert get_count('note.linked_person') == 1
+
     def ignore_call_to_send_delete_notice(self):
         """Replaces delete.send_delete_notice() with empty implementation."""
         self.mox.StubOutWithMock(delete, 'send_delete_notice')
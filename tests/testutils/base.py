@@ -20,6 +20,7 @@ import django
 import django.test
 from google.appengine.ext import testbed
 
+import model
 from testutils import data_generator
 
 
@@ -40,6 +41,9 @@ class ServerTestsBase(unittest.TestCase):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
         self.init_testbed_stubs()
+        # IDs reserved from another test's datastore aren't reserved in this
+        # one.
+        model.UniqueId.reset()
         os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
         django.setup()
         django.test.utils.setup_test_environment()
@@ -47,4 +51,5 @@ class ServerTestsBase(unittest.TestCase):
 
     def tearDown(self):
         self.testbed.deactivate()
+        model.UniqueId.reset()
         django.test.utils.teardown_test_environment()
@@ -0,0 +1,68 @@
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Utilities for testing the streaming of large PFIF documents."""
+
+import gc
+
+
+class PfifReader(object):
+    """A file-like object that makes up a PFIF 1.4 document as it is read,
+    so that the document itself is never held in memory.  Each Person has
+    one enclosed Note, and a description of description_size characters."""
+
+    def __init__(self, num_persons, domain='test.google.com',
+                 description_size=10):
+        self.num_persons = num_persons
+        self.domain = domain
+        self.description = 'x' * description_size
+        self.count = 0
+        self.buffer = '<pfif xmlns="http://zesty.ca/pfif/1.4">\n'
+
+    def get_person_xml(self, index):
+        return (
+            '<person>\n'
+            '  <person_record_id>%(domain)s/person.%(index)d'
+            '</person_record_id>\n'
+            '  <source_date>2010-01-01T00:00:00Z</source_date>\n'
+            '  <full_name>_test_full_name</full_name>\n'
+            '  <description>%(description)s</description>\n'
+            '  <note>\n'
+            '    <note_record_id>%(domain)s/note.%(index)d</note_record_id>\n'
+            '    <source_date>2010-01-01T00:00:00Z</source_date>\n'
+            '    <text>_test_text</text>\n'
+            '  </note>\n'
+            '</person>\n' % {'domain': self.domain, 'index': index,
+                             'description': self.description})
+
+    def read(self, size):
+        while len(self.buffer) < size and self.count < self.num_persons:
+            self.buffer += self.get_person_xml(self.count)
+            self.count += 1
+            if self.count == self.num_persons:
+                self.buffer += '</pfif>\n'
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def count_live_records():
+    """Counts the parsed PFIF record dictionaries that are still referenced
+    from anywhere.  Dictionaries of strings aren't tracked by the garbage
+    collector, so they are found through the objects that refer to them."""
+    gc.collect()
+    return len(set(
+        id(referent) for container in gc.get_objects()
+        for referent in gc.get_referents(container)
+        if type(referent) is dict and 'person_record_id' in referent))
@@ -52,6 +52,7 @@ class ApiKeyManagementViewTests(view_tests_base.ViewTestsBase):
     def init_testbed_stubs(self):
         self.testbed.init_user_stub()
         self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
 
     def setUp(self):
         super(ApiKeyManagementViewTests, self).setUp()
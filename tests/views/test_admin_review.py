@@ -167,3 +167,7 @@ class AdminReviewViewTests(view_tests_base.ViewTestsBase):
         note = model.Note.get('haiti', note.record_id)
         self.assertIs(note.reviewed, True)
         self.assertIs(note.hidden, True)
+        # The change is reflected in the note counts.
+        deltas = model.CountDelta.get_totals('haiti', 'note')
+        self.assertEqual(deltas['hidden=FALSE,reviewed=FALSE'], -1)
+        self.assertEqual(deltas['hidden=TRUE'], 1)
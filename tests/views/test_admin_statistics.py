@@ -47,6 +47,14 @@ class AdminStatisticsViewTests(view_tests_base.ViewTestsBase):
         assert doc.cssselect_one('#haiti-notes').text == '5'
         assert doc.cssselect_one('#haiti-num_notes_unspecified').text == '5'
 
+    def test_sharded_counters(self):
+        self.counter.person = 2
+        self.counter.put()
+        for _ in range(5):
+            model.UsageCounter.increment_counter('haiti', ['person'])
+        doc = self.get_page_doc()
+        assert doc.cssselect_one('#haiti-persons').text == '7'
+
     def test_is_note_author_counter(self):
         self.counter.note = 1
         self.counter.is_note_author = 1
@@ -34,6 +34,7 @@ class MetaSetupDatastoreHandlerTests(unittest.TestCase):
         self.testbed.activate()
         self.testbed.init_user_stub()
         self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
         os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
         django.setup()
         django.test.utils.setup_test_environment()
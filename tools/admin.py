@@ -129,6 +129,7 @@ def delete_repo(repo):
     entities += list(config.ConfigEntry.all().filter('__key__ >', min_key
                                             ).filter('__key__ <', max_key))
     db.delete(entities)
+    repo_directory.invalidate()
 
 def get_all_resources():
     """Gets all the Resource entities and returns a dictionary of the contents.
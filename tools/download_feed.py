@@ -20,8 +20,10 @@ import csv
 import optparse
 import os
 import re
+import StringIO
 import sys
 import time
+from xml.sax import saxutils
 
 # This script is in a tools directory below the root project directory.
 TOOLS_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -39,6 +41,9 @@ PFIF = pfif.PFIF_VERSIONS[pfif.PFIF_DEFAULT_VERSION]
 
 quiet_mode = False
 
+# Matches the link to the next page of a Person Finder feed.
+NEXT_LINK_RE = re.compile(r'<link rel="next">([^<]*)</link>')
+
 
 def log(message):
     """Optionally prints a status message to sys.stderr."""
@@ -73,21 +78,26 @@ writers = {
 
 
 def fetch_records(parser, url, **params):
-    """Fetches and parses one batch of records from an Atom feed."""
+    """Fetches and parses one batch of records from an Atom feed.  Returns the
+    records and the URL of the next page of the feed (None if the feed has no
+    link to a next page)."""
     query = urllib.urlencode(dict((k, v) for k, v in params.items() if v))
     if query:
         url += ('?' in url and '&' or '?') + query
     for attempt in range(5):
         try:
-            return parser.parse_file(urllib.urlopen(url))
+            feed = urllib.urlopen(url).read()
+            records = parser.parse_file(StringIO.StringIO(feed))
         except:
             continue
+        match = NEXT_LINK_RE.search(feed)
+        return records, match and saxutils.unescape(match.group(1))
     raise RuntimeError('Failed to fetch %r after 5 attempts' % url)
 
 def download_file(type, parser, writer, url, key=None):
     """Fetches and writes one batch of records."""
     start_time = time.time()
-    records = fetch_records(parser, url, key=key)
+    records, _ = fetch_records(parser, url, key=key)
     writer.write(records)
     speed = len(records)/float(time.time() - start_time)
     log('Fetched %d %s record%s (%.1f rec/s).\n' %
@@ -95,21 +105,31 @@ def download_file(type, parser, writer, url, key=None):
 
 def download_since(type, parser, writer, url, min_entry_date, key=None):
     """Fetches and writes batches of records repeatedly until all records
-    with an entry_date >= min_entry_date are retrieved."""
+    with an entry_date >= min_entry_date are retrieved.  Follows the feed's
+    links to the next page when it has them; otherwise, pages through the
+    records with the min_entry_date and skip parameters."""
     start_time = time.time()
     total = skip = 0
     last_min_entry_date = None
+    next_url = None
     while True:
         log('%s records with entry_date >= %s: ' %
             (type.capitalize(), min_entry_date))
-        records = fetch_records(parser, url, key=key, max_results=200,
-                                min_entry_date=min_entry_date, skip=skip)
+        following_link = bool(next_url)
+        if following_link:
+            records, next_url = fetch_records(parser, next_url)
+        else:
+            records, next_url = fetch_records(
+                parser, url, key=key, max_results=200,
+                min_entry_date=min_entry_date, skip=skip)
         if not records:
             break
         writer.write(records)
         total += len(records)
         speed = total/float(time.time() - start_time)
         log('%d (total %d, %.1f rec/s).\n' % (len(records), total, speed))
+        if following_link and not next_url:
+            break  # That was the last page.
         min_entry_date = max(r['entry_date'] for r in records)
         next_skip = len([r for r in records if r['entry_date'] == min_entry_date])
         if min_entry_date == last_min_entry_date:
@@ -0,0 +1,167 @@
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reports the average size of the full-text search documents for a sample of
+the person records in a repository, as built by the current
+full_text_search.create_document and by the previous document builder (which
+repeated every romanized name 5 times for ranking and did not deduplicate
+values produced by different romanizers).
+
+Example:
+  $ tools/full_text_document_size mypersonfinder.appspot.com \\
+    --repo=myrepo --sample_size=1000
+
+Documents are built locally; nothing is written to the search index.
+"""
+
+import optparse
+import sys
+
+from google.appengine.api import search as appengine_search
+
+import full_text_search
+import model
+import remote_api
+
+# The number of Persons to fetch per datastore request.
+FETCH_BATCH_SIZE = 100
+
+LEGACY_REPEAT_COUNT_FOR_RANK = 5
+
+
+def legacy_create_fields_for_rank(field_name, values):
+    fields = []
+    for index, value in enumerate(values or []):
+        for x in xrange(LEGACY_REPEAT_COUNT_FOR_RANK):
+            fields.append(appengine_search.TextField(
+                name='%s_%d_for_rank_%d' % (field_name, index, x),
+                value=value))
+    return fields
+
+
+def legacy_create_romanized_name_fields(romanize_method, **kwargs):
+    fields = []
+    romanized_names_list = []
+    method_name = romanize_method.__name__
+    for field_name, field_value in kwargs.iteritems():
+        romanized_names = romanize_method(field_value)
+        for index, romanized_name in enumerate(romanized_names):
+            fields.extend(legacy_create_fields_for_rank(
+                '%s_romanized_by_%s_%d' % (field_name, method_name, index),
+                romanized_name))
+        romanized_names_list.extend(romanized_names)
+    full_names = full_text_search.create_full_name_list_without_space(
+        romanize_method(kwargs['given_name']),
+        romanize_method(kwargs['family_name']))
+    for index, full_name in enumerate(full_names):
+        fields.append(appengine_search.TextField(
+            name='no_space_full_name_romanized_by_%s_%d' % (
+                method_name, index),
+            value=full_name))
+    romanized_names_list.extend(full_names)
+    fields.append(appengine_search.TextField(
+        name='names_romanized_by_' + method_name,
+        value=':'.join([name for name in romanized_names_list if name])))
+    return fields
+
+
+def legacy_create_romanized_location_fields(romanize_method, **kwargs):
+    fields = []
+    method_name = romanize_method.__name__
+    for field in kwargs:
+        for index, location in enumerate(romanize_method(kwargs[field])):
+            fields.append(appengine_search.TextField(
+                name='%s_romanized_by_%s_%d' % (field, method_name, index),
+                value=location))
+    fields.append(appengine_search.TextField(
+        name='full_location_romanized_by_' + method_name,
+        value=':'.join(field.value for field in fields if field.value)))
+    return fields
+
+
+def legacy_create_fields(person):
+    """Returns the fields the previous document builder created."""
+    fields = [appengine_search.TextField(name='repo', value=person.repo),
+              appengine_search.TextField(
+                  name='record_id', value=person.record_id)]
+    names = dict(given_name=person.given_name,
+                 family_name=person.family_name,
+                 full_name=person.full_name,
+                 alternate_names=person.alternate_names)
+    locations = dict(home_city=person.home_city,
+                     home_state=person.home_state,
+                     home_postal_code=person.home_postal_code,
+                     home_neighborhood=person.home_neighborhood,
+                     home_country=person.home_country)
+    for name, value in dict(names, **locations).iteritems():
+        fields.append(appengine_search.TextField(name=name, value=value))
+    for romanize_method in full_text_search.ROMANIZE_METHODS:
+        fields.extend(legacy_create_romanized_name_fields(
+            romanize_method, **names))
+        fields.extend(legacy_create_romanized_location_fields(
+            romanize_method, **locations))
+    return fields
+
+
+def get_size(fields):
+    """Returns the number of fields and the total size in bytes of the field
+    names and values."""
+    return len(fields), sum(
+        len(field.name) + len((field.value or u'').encode('utf-8'))
+        for field in fields)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] <appserver_url>')
+    parser.add_option('--repo',
+                      help='Name of the Person Finder repository.')
+    parser.add_option('--sample_size', type='int', default=1000,
+                      help='The number of person records to sample.')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Just one argument must be given.')
+    if not options.repo:
+        parser.error('--repo is missing.')
+
+    remote_api.connect(args[0])
+
+    legacy_fields = legacy_bytes = fields = bytes = count = 0
+    query = model.Person.all_in_repo(options.repo)
+    persons = query.fetch(min(FETCH_BATCH_SIZE, options.sample_size))
+    while persons and count < options.sample_size:
+        for person in persons[:options.sample_size - count]:
+            num_fields, num_bytes = get_size(legacy_create_fields(person))
+            legacy_fields += num_fields
+            legacy_bytes += num_bytes
+            num_fields, num_bytes = get_size(
+                full_text_search.create_document(person).fields)
+            fields += num_fields
+            bytes += num_bytes
+            count += 1
+        query.with_cursor(query.cursor())
+        persons = query.fetch(FETCH_BATCH_SIZE)
+
+    if not count:
+        print 'No person records found in %s.' % options.repo
+        sys.exit(1)
+    print 'Sampled person records:   %d' % count
+    print '                          before     after'
+    print 'Fields per document:      %6.1f    %6.1f' % (
+        float(legacy_fields) / count, float(fields) / count)
+    print 'Bytes per document:       %6.1f    %6.1f' % (
+        float(legacy_bytes) / count, float(bytes) / count)
+
+
+if __name__ == '__main__':
+    main()